@@ -0,0 +1,141 @@
+"""
+Аналитика: почасовые и подневные сводки событий
+
+/stats раньше при каждом вызове считал COUNT(*) и SUM по таблицам целиком
+и не мог ответить, сколько генераций было за день или сколько
+пользователей пополнили баланс после бесплатной генерации.
+
+Database увеличивает счетчики stats_rollups в той же транзакции, что и
+само событие (bump): для каждого события - строка часа, дня и итога за
+все время. /stats [период] читает только строки сводки нужного периода -
+не больше 168 часов или 366 дней на метрику, сколько бы ни было записей
+в исходных таблицах. Таблица сводок создается и заполняется по уже
+накопленным данным миграцией migrations/0003_stats_rollups.py.
+"""
+import re
+import sqlite3
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from prompt_templates import decode_params
+
+# Метрики сводок
+NEW_USERS = "new_users"
+FREE_TRIALS = "free_trials"
+TRIAL_CONVERSIONS = "trial_conversions"  # пополнили баланс после бесплатной генерации
+CREDITS = "credits"  # начислено генераций пополнениями
+GENERATIONS = "generations"  # по категории GenderType
+EDITS = "edits"  # по категории GenderType
+DELIVERIES = "deliveries"
+REFUNDS = "refunds"  # по причине REFUND_*
+FAILURES = "failures"  # возвраты из-за ошибок генерации
+BALANCE = "balance"  # изменение суммарного баланса (осмысленно только за все время)
+
+REFUND_CANCELLED = "cancelled"
+REFUND_RESTART = "restart"
+REFUND_ERROR = "error"
+
+# Границы периодов /stats
+MAX_HOURS = 168
+MAX_DAYS = 366
+
+_BUMP_SQL = '''
+    INSERT INTO stats_rollups (period, bucket, metric, dim, value) VALUES
+        ('hour', strftime('%Y-%m-%d %H:00', 'now'), ?1, ?2, ?3),
+        ('day', date('now'), ?1, ?2, ?3),
+        ('total', '', ?1, ?2, ?3)
+    ON CONFLICT (period, bucket, metric, dim) DO UPDATE SET value = value + excluded.value
+'''
+
+_PERIOD_RE = re.compile(r"^(\d+)([hd])$")
+
+
+def bump(cursor: sqlite3.Cursor, metric: str, amount: int = 1, dim: str = ""):
+    """Увеличивает счетчик текущего часа, дня и итог; вызывать в транзакции события"""
+    if amount:
+        cursor.execute(_BUMP_SQL, (metric, dim, amount))
+
+
+def category(params: str) -> str:
+    """Категория (имя GenderType) из строки параметров генерации; '' - неизвестна"""
+    gender = decode_params(params).get("gender") if params else None
+    return gender.name if gender is not None else ""
+
+
+def refund_reason(error: Optional[str]) -> str:
+    """Причина возврата по тексту ошибки задания"""
+    if error == "cancelled by user":
+        return REFUND_CANCELLED
+    if error in ("cancelled on shutdown", "interrupted by restart"):
+        return REFUND_RESTART
+    return REFUND_ERROR
+
+
+@dataclass
+class StatsReport:
+    """Сводка за период"""
+    period: str  # "all", "<N>h" или "<N>d"
+    by_dim: Dict[str, Dict[str, int]] = field(default_factory=dict)  # метрика -> измерение -> значение
+    by_bucket: Dict[str, Dict[str, int]] = field(default_factory=dict)  # день/час -> метрика -> значение
+
+    def total(self, metric: str) -> int:
+        return sum(self.by_dim.get(metric, {}).values())
+
+
+def parse_period(text: Optional[str]) -> Tuple[str, Optional[int]]:
+    """
+    Период /stats: "all" (по умолчанию), "<N>h" или "<N>d", "today".
+
+    Returns:
+        (гранулярность сводки: "total", "hour" или "day", число интервалов)
+
+    Raises:
+        ValueError: неизвестный или слишком длинный период
+    """
+    text = (text or "all").strip().lower()
+    if text == "all":
+        return "total", None
+    if text == "today":
+        return "day", 1
+    match = _PERIOD_RE.match(text)
+    if not match:
+        raise ValueError(f"Неизвестный период: {text}")
+    count, unit = int(match.group(1)), match.group(2)
+    limit = MAX_HOURS if unit == "h" else MAX_DAYS
+    if not 1 <= count <= limit:
+        raise ValueError(f"Период должен быть от 1 до {limit}{unit}")
+    return ("hour" if unit == "h" else "day"), count
+
+
+def period_start(cursor: sqlite3.Cursor, granularity: str, count: Optional[int]) -> Optional[str]:
+    """Начало периода parse_period: первый час или день; None - за все время"""
+    if granularity == "total":
+        return None
+    if granularity == "hour":
+        cursor.execute("SELECT strftime('%Y-%m-%d %H:00', 'now', ?)", (f"-{count - 1} hours",))
+    else:
+        cursor.execute("SELECT date('now', ?)", (f"-{count - 1} days",))
+    return cursor.fetchone()[0]
+
+
+def read_report(cursor: sqlite3.Cursor, text: Optional[str]) -> StatsReport:
+    """Сводка за период; читает только stats_rollups"""
+    granularity, count = parse_period(text)
+    report = StatsReport("all" if count is None else (text or "").strip().lower())
+    since = period_start(cursor, granularity, count)
+    if since is None:
+        cursor.execute(
+            "SELECT bucket, metric, dim, value FROM stats_rollups WHERE period = 'total'"
+        )
+    else:
+        cursor.execute(
+            'SELECT bucket, metric, dim, value FROM stats_rollups WHERE period = ? AND bucket >= ?',
+            (granularity, since)
+        )
+    for bucket, metric, dim, value in cursor.fetchall():
+        dims = report.by_dim.setdefault(metric, {})
+        dims[dim] = dims.get(dim, 0) + value
+        if bucket:
+            metrics = report.by_bucket.setdefault(bucket, {})
+            metrics[metric] = metrics.get(metric, 0) + value
+    return report
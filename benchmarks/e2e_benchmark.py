@@ -0,0 +1,324 @@
+"""
+Сквозной бенчмарк: синтетические апдейты через настоящий Dispatcher и роутеры
+
+Прогоняет сценарий start → gender → photo → анкета → confirm_generate → edit
+для множества пользователей против локальных фейковых Bot API и Gemini API.
+Работает офлайн; пороги --max-p95-ms / --min-updates-per-sec позволяют
+использовать его как проверку регрессий перед деплоем.
+
+Запуск из корня проекта:
+    python -m benchmarks.e2e_benchmark --users 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+# Окружение должно быть готово до импорта модулей бота
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("METRICS_PORT", "0")
+# Синтетические пользователи проходят сценарий без пауз: ограничение частоты
+# остается включенным (его накладные расходы входят в замер), но не срабатывает
+os.environ.setdefault("THROTTLE_BURST", "1000")
+_BENCH_DIR = tempfile.mkdtemp(prefix="bench_")
+os.environ["DATABASE_PATH"] = os.path.join(_BENCH_DIR, "bench.db")
+os.environ["MEDIA_STORE_DIR"] = os.path.join(_BENCH_DIR, "media")
+
+from benchmarks.fake_servers import (  # noqa: E402
+    FakeBehavior,
+    FakeGeminiServer,
+    FakeServersThread,
+    FakeTelegramServer
+)
+
+BOT_ID = 123456
+FIRST_USER_ID = 10_000
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class UpdateFactory:
+    """Строит синтетические Update для одного бота"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _base_message(self, user_id: int) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+
+    def _build(self, payload: dict):
+        from aiogram.types import Update
+
+        payload["update_id"] = next(self._update_ids)
+        return Update.model_validate(payload, context={"bot": self.bot})
+
+    def text(self, user_id: int, text: str):
+        return self._build({"message": {**self._base_message(user_id), "text": text}})
+
+    def photo(self, user_id: int):
+        sizes = [
+            {"file_id": f"small{user_id}", "file_unique_id": f"s{user_id}", "width": 90, "height": 120},
+            {"file_id": f"photo{user_id}", "file_unique_id": f"p{user_id}", "width": 768, "height": 1024},
+        ]
+        return self._build({"message": {**self._base_message(user_id), "photo": sizes}})
+
+    def callback(self, user_id: int, data: str, message_id: int = None):
+        message = {**self._base_message(user_id), "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"}}
+        if message_id is not None:
+            message["message_id"] = message_id
+        return self._build({"callback_query": {
+            "id": str(next(self._message_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        }})
+
+    def repeat_tap(self, update):
+        """Повторное нажатие той же кнопки того же сообщения"""
+        query = update.callback_query
+        return self.callback(query.from_user.id, query.data, query.message.message_id)
+
+
+EDIT_INSTRUCTIONS = ["Сделайте фон светлее", "Добавьте мягкие тени", "Сделайте кадр чуть теплее"]
+
+
+def user_scenario(factory: UpdateFactory, user_id: int, edits: int = 1):
+    """Шаги сценария: (метка, апдейт). Метки confirm/edit замеряют time-to-image"""
+    steps = [
+        ("start", factory.text(user_id, "/start")),
+        ("accept_terms", factory.callback(user_id, "accept_terms")),
+        ("create_photo", factory.callback(user_id, "create_photo")),
+        ("gender", factory.callback(user_id, "gender_women")),
+        ("photo", factory.photo(user_id)),
+        ("height", factory.text(user_id, "175")),
+        ("length", factory.callback(user_id, "length_skip")),
+        ("location", factory.callback(user_id, "location_street")),
+        ("age", factory.callback(user_id, "age_22-28")),
+        ("size", factory.callback(user_id, "size_42_46")),
+        ("style", factory.callback(user_id, "style_regular")),
+        ("pose", factory.callback(user_id, "pose_standing")),
+        ("view", factory.callback(user_id, "view_front")),
+        ("confirm", factory.callback(user_id, "confirm_generate")),
+    ]
+    # Каждая следующая правка продолжает предыдущий результат (сессия правок)
+    for index in range(edits):
+        steps.append(("after_gen_edit", factory.callback(user_id, "after_gen_edit")))
+        steps.append(("edit", factory.text(user_id, EDIT_INSTRUCTIONS[index % len(EDIT_INSTRUCTIONS)])))
+    return steps
+
+
+async def run_benchmark(args) -> Dict[str, float]:
+    from aiogram.client.telegram import TelegramAPIServer
+
+    telegram = FakeTelegramServer(FakeBehavior(
+        median_ms=args.telegram_latency_ms,
+        sigma=0.3,
+        uplink_kbps=args.uplink_kbps
+    ))
+    gemini = FakeGeminiServer(FakeBehavior(
+        median_ms=args.gemini_latency_ms,
+        sigma=args.gemini_sigma,
+        error_429_rate=args.gemini_429_rate,
+        error_500_rate=args.gemini_500_rate,
+        text_rate=args.gemini_text_rate,
+    ), file_ttl=args.gemini_file_ttl)
+    servers = FakeServersThread(telegram, gemini)
+    servers.start()
+    # Модули бота импортируются после старта серверов, чтобы config подхватил URL
+    os.environ["GEMINI_API_BASE"] = servers.gemini_url
+    os.environ["GEMINI_BACKEND"] = args.backend
+    os.environ["DEMO_LATENCY_MEDIAN_MS"] = str(args.gemini_latency_ms)
+    os.environ["DEMO_LATENCY_SIGMA"] = str(args.gemini_sigma)
+    from bot import create_bot, create_dispatcher
+    from database import Database
+    from gemini_api import close_session
+    import tracing
+
+    # config настраивает logging при импорте: глушим INFO, чтобы не мерить вывод логов
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    if args.trace:
+        tracing.setup(f"file:{args.trace}")
+
+    bot = create_bot(TelegramAPIServer.from_base(servers.telegram_url))
+    db = Database()
+    dp = create_dispatcher(bot, db)
+    factory = UpdateFactory(bot)
+
+    # Баланс на генерацию и одну правку для каждого пользователя
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+    for user_id in user_ids:
+        db.update_user_balance(user_id, 5)
+
+    scenarios = {user_id: user_scenario(factory, user_id, args.edits) for user_id in user_ids}
+    time_to_image: Dict[str, List[float]] = {"confirm": [], "edit": []}
+    step_latency: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    updates_done = 0
+    double_taps = 0
+    cancels = 0
+    rng = random.Random(42)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def double_tap(update):
+        """Нетерпеливый пользователь нажимает кнопку еще раз во время генерации"""
+        nonlocal double_taps
+        double_taps += 1
+        await asyncio.sleep(args.double_tap_delay_ms / 1000)
+        await dp.feed_update(bot, factory.repeat_tap(update))
+
+    async def cancel_tap(user_id: int):
+        """Пользователь нажимает "Отменить" во время генерации"""
+        nonlocal cancels
+        cancels += 1
+        await asyncio.sleep(args.cancel_delay_ms / 1000)
+        await dp.feed_update(bot, factory.callback(user_id, "generation_cancel"))
+
+    async def run_user(user_id: int):
+        nonlocal updates_done
+        async with semaphore:
+            for label, update in scenarios[user_id]:
+                photos_before = len(telegram.photos_sent[user_id])
+                started = time.perf_counter()
+                try:
+                    if label == "confirm" and rng.random() < args.double_tap_rate:
+                        await asyncio.gather(dp.feed_update(bot, update), double_tap(update))
+                    elif label in time_to_image and rng.random() < args.cancel_rate:
+                        await asyncio.gather(dp.feed_update(bot, update), cancel_tap(user_id))
+                    else:
+                        await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[f"{label}: {type(e).__name__}"] = errors.get(f"{label}: {type(e).__name__}", 0) + 1
+                step_latency.setdefault(label, []).append(time.perf_counter() - started)
+                updates_done += 1
+                if label in time_to_image:
+                    sent = telegram.photos_sent[user_id][photos_before:]
+                    if sent:
+                        time_to_image[label].append(sent[0] - started)
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    wall_started = time.perf_counter()
+    await asyncio.gather(*(run_user(user_id) for user_id in user_ids))
+    wall = time.perf_counter() - wall_started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else 0
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    conn = db._get_connection()
+    try:
+        refunded_jobs = conn.execute("SELECT COUNT(*) FROM generation_jobs WHERE state = 'refunded'").fetchone()[0]
+    finally:
+        conn.close()
+
+    await bot.session.close()
+    await close_session()
+    servers.stop()
+    tracing.shutdown()
+
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    images = time_to_image["confirm"] + time_to_image["edit"]
+    report = {
+        "users": args.users,
+        "updates": updates_done,
+        "wall_seconds": round(wall, 3),
+        "updates_per_sec": round(updates_done / wall, 1) if wall else 0.0,
+        "images_delivered": len(images),
+        "double_taps": double_taps,
+        "cancels": cancels,
+        "jobs_refunded": refunded_jobs,
+        "tti_p50_ms": round(percentile(images, 50) * 1000, 1),
+        "tti_p95_ms": round(percentile(images, 95) * 1000, 1),
+        "tti_p99_ms": round(percentile(images, 99) * 1000, 1),
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+        "peak_traced_mb": round(traced_peak / 1024 ** 2, 1),
+        "errors": errors,
+        "gemini_outcomes": dict(gemini.outcomes),
+        "gemini_uploads": gemini.uploads,
+        "gemini_request_kb_p50": round(percentile(gemini.request_bytes, 50) / 1024, 1),
+        "gemini_request_mb_total": round(sum(gemini.request_bytes) / 1024 ** 2, 2),
+        "step_p95_ms": {
+            label: round(percentile(values, 95) * 1000, 1)
+            for label, values in step_latency.items()
+        },
+    }
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк Fashion Bot")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременно активных пользователей")
+    parser.add_argument("--think-ms", type=float, default=0, help="Пауза пользователя между шагами")
+    parser.add_argument(
+        "--backend", choices=("gemini", "demo"), default="gemini",
+        help="gemini - фейковый HTTP-сервер Gemini, demo - встроенный демо-бэкенд"
+    )
+    parser.add_argument("--telegram-latency-ms", type=float, default=5)
+    parser.add_argument("--uplink-kbps", type=float, default=0, help="Имитация медленного канала загрузки")
+    parser.add_argument("--gemini-latency-ms", type=float, default=50)
+    parser.add_argument("--gemini-sigma", type=float, default=0.5)
+    parser.add_argument("--gemini-429-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-500-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-text-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-file-ttl", type=float, default=48 * 3600, help="Срок жизни файлов File API, с")
+    parser.add_argument("--edits", type=int, default=1, help="Правок подряд после генерации")
+    parser.add_argument("--double-tap-rate", type=float, default=0.0, help="Доля повторных нажатий confirm")
+    parser.add_argument("--double-tap-delay-ms", type=float, default=30)
+    parser.add_argument("--cancel-rate", type=float, default=0.0, help="Доля генераций, отмененных кнопкой")
+    parser.add_argument("--cancel-delay-ms", type=float, default=20)
+    parser.add_argument("--trace", help="Писать трассы генераций в файл (JSON-строки)")
+    parser.add_argument("--tracemalloc", action="store_true", help="Пиковая память Python (замедляет прогон)")
+    parser.add_argument("--json", dest="json_path", help="Сохранить отчет в JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="Порог регрессии для p95 time-to-image")
+    parser.add_argument("--min-updates-per-sec", type=float, help="Порог регрессии для пропускной способности")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if args.max_p95_ms is not None and report["tti_p95_ms"] > args.max_p95_ms:
+        print(f"REGRESSION: p95 time-to-image {report['tti_p95_ms']} мс > {args.max_p95_ms} мс", file=sys.stderr)
+        failed = True
+    if args.min_updates_per_sec is not None and report["updates_per_sec"] < args.min_updates_per_sec:
+        print(f"REGRESSION: {report['updates_per_sec']} апдейтов/с < {args.min_updates_per_sec}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Локальные фейковые Telegram Bot API и Gemini API для офлайн-бенчмарков
+
+Оба сервера работают в отдельном потоке со своим event loop, чтобы синхронные
+вызовы бота (например, requests) не блокировали собственные ответы серверов.
+"""
+import asyncio
+import base64
+import io
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+
+@dataclass
+class FakeBehavior:
+    """
+    Распределение задержек и ошибок фейкового сервера.
+
+    Задержка логнормальная: median_ms - медиана, sigma - разброс (0 - константа).
+    Доли ошибок задаются независимо и проверяются по порядку.
+    """
+    median_ms: float = 20
+    sigma: float = 0.5
+    uplink_kbps: float = 0  # Пропускная способность канала бота (0 - без ограничения)
+    error_429_rate: float = 0.0
+    error_500_rate: float = 0.0
+    text_rate: float = 0.0
+    unsupported_location_rate: float = 0.0
+
+    def sample_delay(self, rng: random.Random) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return self.median_ms / 1000
+        return rng.lognormvariate(0, self.sigma) * self.median_ms / 1000
+
+    def transfer_delay(self, size_bytes: int) -> float:
+        if self.uplink_kbps <= 0:
+            return 0.0
+        return size_bytes * 8 / (self.uplink_kbps * 1000)
+
+    def sample_outcome(self, rng: random.Random) -> str:
+        roll = rng.random()
+        for outcome, rate in (
+            ("429", self.error_429_rate),
+            ("500", self.error_500_rate),
+            ("text", self.text_rate),
+            ("location", self.unsupported_location_rate),
+        ):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+
+def _render_jpeg(size=(768, 1024), color=(180, 160, 140)) -> bytes:
+    """Однотонный фон с полосатым "товаром": детали нужны проверке качества фото"""
+    img = Image.new("RGB", size, color=color)
+    width, height = size
+    draw = ImageDraw.Draw(img)
+    for y in range(height // 4, height * 3 // 4, 12):
+        draw.line((width // 4, y, width * 3 // 4, y), fill=(60, 80, 140), width=4)
+    stream = io.BytesIO()
+    img.save(stream, format="JPEG", quality=85)
+    return stream.getvalue()
+
+
+class FakeTelegramServer:
+    """Минимальная эмуляция Bot API: методы, которые вызывают хэндлеры бота"""
+
+    def __init__(self, behavior: FakeBehavior = None, seed: int = 1):
+        self.behavior = behavior or FakeBehavior()
+        self.rng = random.Random(seed)
+        self.photo_bytes = _render_jpeg()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.photos_sent: Dict[int, List[float]] = defaultdict(list)
+        self._message_id = 0
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        delay = self.behavior.sample_delay(self.rng)
+        delay += self.behavior.transfer_delay(request.content_length or 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        chat_id = int(form.get("chat_id", 0) or 0)
+        result = True
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=str(form.get("text", "")))
+        elif method in ("sendPhoto", "sendDocument"):
+            self.photos_sent[chat_id].append(time.perf_counter())
+            photo = [{"file_id": "out", "file_unique_id": "out", "width": 1024, "height": 1024}]
+            result = self._message(chat_id, photo=photo)
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id)]
+        elif method == "getFile":
+            file_id = str(form.get("file_id", "photo"))
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench"}
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls["download"] += 1
+        return web.Response(body=self.photo_bytes, content_type="image/jpeg")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        return app
+
+
+class FakeGeminiServer:
+    """Эмуляция generateContent и File API с настраиваемыми задержками и ошибками"""
+
+    def __init__(self, behavior: FakeBehavior = None, seed: int = 2, file_ttl: float = 48 * 3600):
+        self.behavior = behavior or FakeBehavior(median_ms=500)
+        self.rng = random.Random(seed)
+        self.image_b64 = base64.b64encode(_render_jpeg((1024, 1024), (90, 110, 140))).decode()
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.file_ttl = file_ttl
+        self.files: Dict[str, float] = {}  # uri -> unix time истечения
+        self.uploads = 0
+        self.request_bytes: List[int] = []
+        self._upload_sessions: Dict[str, int] = {}
+        self._ids = itertools.count(1)
+
+    def _missing_file(self, body: bytes) -> Optional[str]:
+        """URI из fileData, которого нет среди загруженных (или он истек)"""
+        if b'"fileData"' not in body:
+            return None
+        for content in json.loads(body).get("contents", []):
+            for part in content.get("parts", []):
+                uri = part.get("fileData", {}).get("fileUri")
+                if uri and self.files.get(uri, 0) <= time.time():
+                    return uri
+        return None
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        """Resumable upload: start выдает X-Goog-Upload-URL, upload/finalize принимает байты"""
+        upload_id = request.query.get("upload_id")
+        if upload_id is None:
+            await request.read()
+            upload_id = str(next(self._ids))
+            self._upload_sessions[upload_id] = int(request.headers.get("X-Goog-Upload-Header-Content-Length", 0))
+            upload_url = f"{request.url.origin()}/upload/v1beta/files?upload_id={upload_id}"
+            return web.Response(headers={"X-Goog-Upload-URL": upload_url, "X-Goog-Upload-Status": "active"})
+
+        data = await request.read()
+        await asyncio.sleep(self.behavior.sample_delay(self.rng) / 4)
+        if self._upload_sessions.pop(upload_id, None) != len(data):
+            return web.json_response({"error": {"code": 400, "message": "Bad upload"}}, status=400)
+        self.uploads += 1
+        name = f"files/fake{upload_id}"
+        uri = f"{request.url.origin()}/v1beta/{name}"
+        expires_at = time.time() + self.file_ttl
+        self.files[uri] = expires_at
+        expiration = datetime.fromtimestamp(expires_at, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        return web.json_response({"file": {
+            "name": name,
+            "uri": uri,
+            "mimeType": "image/jpeg",
+            "sizeBytes": str(len(data)),
+            "expirationTime": expiration,
+            "state": "ACTIVE",
+        }})
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        if not request.match_info["tail"].endswith(":generateContent"):
+            return web.json_response({"error": {"code": 404}}, status=404)
+        body = await request.read()
+        self.request_bytes.append(len(body))
+        missing = self._missing_file(body)
+        if missing:
+            self.outcomes["missing_file"] += 1
+            return web.json_response(
+                {"error": {"code": 403, "message": f"You do not have permission to access the File {missing} "
+                                                   "or it may not exist.", "status": "PERMISSION_DENIED"}},
+                status=403
+            )
+        outcome = self.behavior.sample_outcome(self.rng)
+        self.outcomes[outcome] += 1
+        await asyncio.sleep(self.behavior.sample_delay(self.rng))
+
+        if outcome == "429":
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}},
+                status=429
+            )
+        if outcome == "500":
+            return web.json_response(
+                {"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}},
+                status=500
+            )
+        if outcome == "location":
+            return web.json_response(
+                {"error": {"code": 400, "message": "User location is not supported for the API use.",
+                           "status": "FAILED_PRECONDITION"}},
+                status=400
+            )
+        if outcome == "text":
+            parts = [{"text": "I can't generate this image, but here is a description instead."}]
+        else:
+            parts = [{"inlineData": {"mimeType": "image/jpeg", "data": self.image_b64}}]
+        return web.json_response({
+            "candidates": [{"content": {"parts": parts, "role": "model"}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 1290, "candidatesTokenCount": 1290, "totalTokenCount": 2580},
+            "modelVersion": "gemini-2.5-flash-image",
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1beta/models/{tail:.+}", self.handle_generate)
+        app.router.add_post("/upload/v1beta/files", self.handle_upload)
+        return app
+
+
+class FakeServersThread:
+    """Запускает фейковые серверы в отдельном потоке и отдает их базовые URL"""
+
+    def __init__(self, telegram: FakeTelegramServer, gemini: FakeGeminiServer, host: str = "127.0.0.1"):
+        self.telegram = telegram
+        self.gemini = gemini
+        self.host = host
+        self.telegram_url: Optional[str] = None
+        self.gemini_url: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runners: List[web.AppRunner] = []
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fake-servers", daemon=True)
+
+    async def _start_app(self, app: web.Application) -> str:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, 0)
+        await site.start()
+        self._runners.append(runner)
+        port = runner.addresses[0][1]
+        return f"http://{self.host}:{port}"
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self.telegram_url = self._loop.run_until_complete(self._start_app(self.telegram.app()))
+        self.gemini_url = self._loop.run_until_complete(self._start_app(self.gemini.app()))
+        self._ready.set()
+        self._loop.run_forever()
+        for runner in self._runners:
+            self._loop.run_until_complete(runner.cleanup())
+        self._loop.close()
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait(timeout=10)
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
@@ -0,0 +1,96 @@
+"""
+Бенчмарк холодного старта
+
+Запускает чистый интерпретатор несколько раз и замеряет время до готовности
+принимать апдейты: импорт модулей бота, открытие БД со схемой и сборку
+диспетчера. Отдельно замеряется фоновый прогрев (Pillow), который не должен
+входить в критический путь.
+
+Запуск из корня проекта:
+    python -m benchmarks.startup_benchmark --runs 10 --max-ms 1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Код, выполняемый в дочернем процессе: печатает JSON с фазами запуска
+CHILD_CODE = r"""
+import json, time
+t0 = time.perf_counter()
+import bot
+t_import = time.perf_counter()
+from database import Database
+db = Database()
+t_db = time.perf_counter()
+dp = bot.create_dispatcher(bot.create_bot(), db)
+t_dp = time.perf_counter()
+from startup import _import_pillow
+_import_pillow()
+t_pil = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t_import - t0) * 1000,
+    "database_ms": (t_db - t_import) * 1000,
+    "dispatcher_ms": (t_dp - t_db) * 1000,
+    "prewarm_pillow_ms": (t_pil - t_dp) * 1000,
+}))
+"""
+
+
+def run_once(env: dict) -> dict:
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD_CODE],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    phases = json.loads(completed.stdout.strip().splitlines()[-1])
+    phases["ready_ms"] = phases["import_ms"] + phases["database_ms"] + phases["dispatcher_ms"]
+    phases["process_wall_ms"] = wall_ms
+    return phases
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта Fashion Bot")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", help="Сохранить отчет в JSON")
+    parser.add_argument("--max-ms", type=float, help="Порог регрессии для медианы ready_ms")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    env["METRICS_PORT"] = "0"
+    env["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="startup_"), "bench.db")
+
+    # Первый прогон создает схему и байткод, в статистику не входит
+    run_once(env)
+    runs = [run_once(env) for _ in range(args.runs)]
+
+    report = {
+        key: {
+            "median": round(statistics.median(run[key] for run in runs), 1),
+            "min": round(min(run[key] for run in runs), 1),
+            "max": round(max(run[key] for run in runs), 1),
+        }
+        for key in runs[0]
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.max_ms is not None and report["ready_ms"]["median"] > args.max_ms:
+        print(f"REGRESSION: медиана ready_ms {report['ready_ms']['median']} мс > {args.max_ms} мс", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
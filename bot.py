@@ -2,49 +2,166 @@
 Fashion AI Generator Bot - Главный модуль
 """
 import asyncio
+import sys
 
+# startup импортируется первым: от него отсчитывается время запуска
+import startup
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN, logger
+from config import BOT_TOKEN, METRICS_HOST, METRICS_PORT, PROFILER_OUTPUT, logger
 from handlers import admin_handlers, user_handlers, creation_handlers
+from metrics import (
+    TelegramMetricsMiddleware,
+    handler_metrics_middleware,
+    update_metrics_middleware,
+    start_metrics_server,
+    health
+)
+from database import Database
+from gemini_api import close_session
+from generation_archive import run_generation_archiver
+from journal import recover_unfinished_jobs
+from lifecycle import lifecycle
+from media_store import run_media_sweeper
+from payload_prep import payload_preparer
+from session_reaper import session_reaper
+from source_uploads import source_uploads
+from throttling import throttler
+import tracing
+from profiler import profiler
 
+startup.timer.mark("imports")
 
-async def main():
-    """Основная функция запуска бота"""
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN не установлен. Завершение работы.")
-        return
 
-    # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
+def create_bot(api_server=None) -> Bot:
+    """
+    Создает экземпляр бота с метриками вызовов Bot API.
+
+    Args:
+        api_server: TelegramAPIServer (например, локальный или фейковый для бенчмарка)
+    """
+    session = AiohttpSession(api=api_server) if api_server else None
+    bot = Bot(token=BOT_TOKEN, session=session)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+def create_dispatcher(bot: Bot, db: Database) -> Dispatcher:
+    """
+    Собирает диспетчер со всеми роутерами и middleware.
+
+    Роутеры - синглтоны модулей, поэтому вызывать один раз на процесс.
+    Единственный экземпляр Database передается в хэндлеры через middleware.
+    """
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
 
     # Регистрация роутеров
     dp.include_router(admin_handlers.router)
     dp.include_router(user_handlers.router)
-    
+
+    # Ограничение частоты - первым: отклоненный апдейт не доходит ни до БД, ни до хэндлера
+    if throttler:
+        dp.message.middleware(throttler.middleware)
+        dp.callback_query.middleware(throttler.middleware)
+
+    # Трасса, привязанная хэндлером, живет до конца обработки апдейта
+    dp.message.middleware(tracing.middleware)
+    dp.callback_query.middleware(tracing.middleware)
+
     # Для creation_handlers нужно передать bot в контекст
-    # Добавляем middleware для передачи bot в хэндлеры
+    # Добавляем middleware для передачи bot и общей БД в хэндлеры
     @dp.message.middleware()
     async def bot_middleware(handler, event, data):
         data['bot'] = bot
+        data['db'] = db
         return await handler(event, data)
-    
+
     @dp.callback_query.middleware()
     async def bot_callback_middleware(handler, event, data):
         data['bot'] = bot
+        data['db'] = db
         return await handler(event, data)
-    
+
+    # Отметка активности для очистки брошенных сценариев
+    if session_reaper:
+        dp.message.middleware(session_reaper.middleware)
+        dp.callback_query.middleware(session_reaper.middleware)
+
+    # Метрики: задержки хэндлеров и число апдейтов в обработке
+    dp.message.middleware(handler_metrics_middleware)
+    dp.callback_query.middleware(handler_metrics_middleware)
+    dp.update.outer_middleware(update_metrics_middleware)
+
+    # Профилировщик (opt-in через PROFILER_ENABLED)
+    if profiler:
+        dp.message.middleware(profiler.middleware)
+        dp.callback_query.middleware(profiler.middleware)
+
     dp.include_router(creation_handlers.router)
 
+    dp.startup.register(health.mark_ready)
+    dp.startup.register(startup.mark_ready)
+    dp.shutdown.register(health.mark_not_ready)
+    # Дожидаемся генераций до закрытия сессии бота (start_polling закрывает ее после хуков)
+    dp.shutdown.register(lifecycle.shutdown)
+    lifecycle.register_flush(payload_preparer.cancel_all)
+    lifecycle.register_flush(source_uploads.cancel_all)
+    return dp
+
+
+async def main():
+    """Основная функция запуска бота"""
+    if not BOT_TOKEN:
+        logger.error("❌ BOT_TOKEN не установлен в .env файле")
+        sys.exit(1)
+
+    # Логи и трассы пишет фоновый поток
+    tracing.setup()
+
+    # Инициализация бота, БД (схема проверяется один раз) и диспетчера
+    bot = create_bot()
+    db = Database()
+    # Незавершенные задания прошлого запуска: новые появятся только после начала polling
+    unfinished_jobs = db.get_unfinished_jobs()
+    startup.timer.mark("database")
+    dp = create_dispatcher(bot, db)
+
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if profiler:
+        profiler.start()
+
     logger.info("🤖 Бот запущен!")
-    
+    prewarm_task = startup.start_prewarm()
+    recovery_task = asyncio.create_task(
+        recover_unfinished_jobs(bot, db, unfinished_jobs), name="journal_recovery"
+    )
+    archive_task = asyncio.create_task(run_generation_archiver(db), name="generation_archive")
+    media_sweep_task = asyncio.create_task(run_media_sweeper(db), name="media_sweep")
+    reaper_task = asyncio.create_task(session_reaper.run(bot), name="session_reaper") if session_reaper else None
+
     try:
         await dp.start_polling(bot)
     finally:
+        prewarm_task.cancel()
+        recovery_task.cancel()
+        archive_task.cancel()
+        media_sweep_task.cancel()
+        if reaper_task:
+            reaper_task.cancel()
         await bot.session.close()
+        await close_session()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if profiler:
+            profiler.stop()
+            if PROFILER_OUTPUT:
+                profiler.dump(PROFILER_OUTPUT)
+        tracing.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""
+Массовое пополнение баланса (/bulk_credit)
+
+После каждой пачки платежей менеджеры пополняли баланс сотням
+покупателей по одному /add_balance на пользователя.
+
+/bulk_credit принимает строки «user_id количество» текстом сообщения
+(после команды) или CSV-документом с командой в подписи. Все строки
+проверяются до записи: при любой ошибке пачка отклоняется целиком с
+отчетом по строкам. Корректная пачка применяется одной транзакцией
+(Database.bulk_credit) через журнал баланса.
+
+Пачка идемпотентна по batch_id: повторно отправленный файл не начисляет
+второй раз. batch_id задается аргументом команды, иначе это дата и хэш
+содержимого: тот же файл, отправленный повторно в тот же день, не
+начисляет второй раз, а такая же пачка в другой день (например,
+ежемесячное пополнение тем же пользователям) применяется. Повторить
+пачку в тот же день намеренно можно только с явным batch_id.
+"""
+import csv
+import io
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from media_store import content_hash
+
+# Лимиты пачки
+MAX_ROWS = 5000
+MAX_BYTES = 1024 * 1024
+MAX_AMOUNT = 100_000
+
+_BATCH_ID_RE = re.compile(r"^[\w.:-]{1,64}$")
+_SEPARATORS_RE = re.compile(r"[,;\t ]+")
+# Заголовок CSV, который пропускается в первой строке с данными
+HEADER = ("user_id", "amount")
+
+
+@dataclass
+class BulkCreditBatch:
+    """Проверенная пачка пополнений"""
+    batch_id: str
+    rows: List[Tuple[int, int]] = field(default_factory=list)  # (user_id, количество)
+    errors: List[str] = field(default_factory=list)  # «строка N: причина»
+
+
+@dataclass
+class BulkCreditResult:
+    """Итог применения пачки"""
+    batch_id: str
+    applied: bool  # False - пачка уже применялась раньше
+    rows: int
+    total: int
+    created_at: str
+    balances: Dict[int, int] = field(default_factory=dict)  # новый баланс по пользователям
+
+
+def parse_batch(text: str, batch_id: Optional[str] = None) -> BulkCreditBatch:
+    """
+    Разбирает строки «user_id количество» (разделители - запятая, точка
+    с запятой, табуляция или пробелы). Пустые строки, строки с # и
+    заголовок CSV «user_id,amount» пропускаются; любая другая строка
+    проверяется как данные.
+
+    Raises:
+        ValueError: некорректный batch_id
+    """
+    if batch_id is not None and not _BATCH_ID_RE.match(batch_id):
+        raise ValueError("batch_id: до 64 символов - буквы, цифры, «_», «-», «.», «:»")
+
+    batch = BulkCreditBatch(batch_id or "")
+    seen: Dict[int, int] = {}
+    first = True
+    for number, line in enumerate(io.StringIO(text), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = [part for part in _SEPARATORS_RE.split(line) if part]
+        if first:
+            first = False
+            if tuple(part.lower() for part in fields) == HEADER:
+                continue
+        if len(fields) != 2:
+            batch.errors.append(f"строка {number}: нужно два поля - user_id и количество")
+            continue
+        try:
+            user_id, amount = int(fields[0]), int(fields[1])
+        except ValueError:
+            batch.errors.append(f"строка {number}: user_id и количество должны быть целыми числами")
+            continue
+        if user_id <= 0:
+            batch.errors.append(f"строка {number}: некорректный user_id {user_id}")
+        elif not 0 < amount <= MAX_AMOUNT:
+            batch.errors.append(f"строка {number}: количество должно быть от 1 до {MAX_AMOUNT}")
+        elif user_id in seen:
+            batch.errors.append(f"строка {number}: user_id {user_id} уже был в строке {seen[user_id]}")
+        else:
+            seen[user_id] = number
+            batch.rows.append((user_id, amount))
+
+    if not batch.rows and not batch.errors:
+        batch.errors.append("нет строк для пополнения")
+    if len(batch.rows) > MAX_ROWS:
+        batch.errors.append(f"слишком много строк: {len(batch.rows)} (максимум {MAX_ROWS})")
+    if not batch.batch_id:
+        # Порядок строк не важен: тот же файл, пересохраненный иначе, - та же пачка
+        normalized = "\n".join(f"{user_id} {amount}" for user_id, amount in sorted(batch.rows))
+        batch.batch_id = f"auto-{time.strftime('%Y%m%d')}-" + content_hash(normalized.encode())[:16]
+    return batch
+
+
+def report_csv(rows: Sequence[Tuple[int, int]], result: BulkCreditResult) -> bytes:
+    """Построчный отчет примененной пачки: user_id, количество, новый баланс"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(("user_id", "amount", "balance"))
+    for user_id, amount in rows:
+        writer.writerow((user_id, amount, result.balances.get(user_id, "")))
+    return buffer.getvalue().encode("utf-8")
@@ -1,34 +1,141 @@
-"""
-Конфигурация и переменные окружения для Fashion Bot
-"""
-import os
-import sys
-import logging
-from dotenv import load_dotenv
-
-# Загрузка переменных окружения
-load_dotenv()
-
-# Конфигурация из .env
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
-SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "@bnbslow")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Демо-режим
-# True - генерировать демо-изображения для тестирования
-# False - использовать реальный Gemini 2.5 Flash Image API
-GEMINI_DEMO_MODE = False  # Отключен - используем реальный API!
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-# Проверка обязательных переменных
-if not BOT_TOKEN:
-    logger.error("❌ BOT_TOKEN не установлен в .env файле")
-    sys.exit(1)
-
+"""
+Конфигурация и переменные окружения для Fashion Bot
+"""
+import os
+import logging
+from dotenv import load_dotenv
+
+# Загрузка переменных окружения
+load_dotenv()
+
+# Конфигурация из .env
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "@bnbslow")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Базовый URL Gemini API (можно направить на локальный фейковый сервер)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com")
+DATABASE_PATH = os.getenv("DATABASE_PATH", "fashion_bot.db")
+# Сколько пользователей держать в кэше состояния (баланс, число генераций); 0 - без кэша
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+# Архив генераций: записи старше N дней переносятся в сжатые сегменты (0 - не архивировать)
+GENERATION_ARCHIVE_AFTER_DAYS = float(os.getenv("GENERATION_ARCHIVE_AFTER_DAYS", 30))
+GENERATION_ARCHIVE_INTERVAL = float(os.getenv("GENERATION_ARCHIVE_INTERVAL", 3600))  # секунды
+GENERATION_ARCHIVE_SEGMENT_ROWS = int(os.getenv("GENERATION_ARCHIVE_SEGMENT_ROWS", 5000))
+# /export: строк за одно чтение курсора
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 1000))
+# Миграции схемы: строк в одной транзакции переноса и пауза между пачками (секунды)
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 1000))
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", 0.05))
+# Контентно-адресуемое хранилище входных и выходных изображений генераций
+MEDIA_STORE_DIR = os.getenv("MEDIA_STORE_DIR", "media_store")
+# Срок хранения файлов, к которым не обращались (0 - не удалять); файлы незавершенных
+# заданий и открытых сессий правок не удаляются
+MEDIA_STORE_TTL = float(os.getenv("MEDIA_STORE_TTL", 86400))  # секунды
+MEDIA_STORE_SWEEP_INTERVAL = float(os.getenv("MEDIA_STORE_SWEEP_INTERVAL", 3600))  # секунды
+
+# Демо-режим (GEMINI_DEMO_MODE=1)
+# True - бесплатные демо-изображения без списания баланса
+# False - использовать реальный Gemini 2.5 Flash Image API
+GEMINI_DEMO_MODE = os.getenv("GEMINI_DEMO_MODE", "0") == "1"
+
+# Бэкенд генерации: "gemini" - реальный API, "demo" - фейковый бэкенд
+# для нагрузочных тестов (баланс списывается как обычно)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+DEMO_LATENCY_MEDIAN_MS = float(os.getenv("DEMO_LATENCY_MEDIAN_MS", 6000))
+DEMO_LATENCY_SIGMA = float(os.getenv("DEMO_LATENCY_SIGMA", 0.35))
+DEMO_ERROR_RATES = os.getenv("DEMO_ERROR_RATES", "")  # например "429=0.02,500=0.01,text=0.01"
+DEMO_FAULT_SCRIPT = os.getenv("DEMO_FAULT_SCRIPT", "")  # путь к сценарию отказов
+
+# Подготовка входного фото, пока пользователь заполняет анкету
+GEMINI_INPUT_MAX_SIDE = int(os.getenv("GEMINI_INPUT_MAX_SIDE", 1536))
+PREPARED_PAYLOAD_TTL = float(os.getenv("PREPARED_PAYLOAD_TTL", 1800))  # секунды
+# Загрузка исходного фото через Gemini File API: правки ссылаются на файл по URI
+GEMINI_FILE_API = os.getenv("GEMINI_FILE_API", "1") == "1"
+# За сколько секунд до истечения файла загружать его заново
+GEMINI_FILE_REUPLOAD_MARGIN = float(os.getenv("GEMINI_FILE_REUPLOAD_MARGIN", 3600))
+# Цены Gemini для учета расходов, USD за миллион токенов (входные и выходные)
+GEMINI_PRICE_INPUT = float(os.getenv("GEMINI_PRICE_INPUT", 0.30))
+GEMINI_PRICE_OUTPUT = float(os.getenv("GEMINI_PRICE_OUTPUT", 30.0))
+
+# Сессии правок: правка отправляет в Gemini предыдущий результат, а не начинает заново
+EDIT_SESSION_MAX_TURNS = int(os.getenv("EDIT_SESSION_MAX_TURNS", 3))  # прошлых результатов в запросе
+EDIT_SESSION_MAX_BYTES = int(os.getenv("EDIT_SESSION_MAX_BYTES", 8_000_000))  # их суммарный размер
+EDIT_SESSION_TTL = float(os.getenv("EDIT_SESSION_TTL", 3600))  # секунды
+EDIT_SESSION_MAX_USERS = int(os.getenv("EDIT_SESSION_MAX_USERS", 2000))
+# Брошенные сценарии создания фото: через сколько секунд простоя очищать анкету
+# и временное фото (0 - не очищать) и сообщать ли об этом пользователю
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", 3600))
+SESSION_EXPIRE_NOTIFY = os.getenv("SESSION_EXPIRE_NOTIFY", "1") == "1"
+
+# Проверка качества входного фото до списания генерации (0 - отключить)
+PHOTO_QUALITY_GATE = os.getenv("PHOTO_QUALITY_GATE", "1") == "1"
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", 480))  # пикселей по короткой стороне
+PHOTO_MAX_ASPECT = float(os.getenv("PHOTO_MAX_ASPECT", 3.0))  # длинная сторона / короткая
+# Резкость - дисперсия лапласиана на деталях кадра: ниже REJECT - отклонить, ниже WARN - предупредить
+PHOTO_BLUR_REJECT = float(os.getenv("PHOTO_BLUR_REJECT", 20))
+PHOTO_BLUR_WARN = float(os.getenv("PHOTO_BLUR_WARN", 80))
+# Блики - доля пересвеченных пикселей рядом с деталями (белый фон не считается)
+PHOTO_GLARE_WARN = float(os.getenv("PHOTO_GLARE_WARN", 0.04))
+# Доли кадра, ушедшие в белое и в черное
+PHOTO_OVEREXPOSED_REJECT = float(os.getenv("PHOTO_OVEREXPOSED_REJECT", 0.9))
+PHOTO_DARK_REJECT = float(os.getenv("PHOTO_DARK_REJECT", 0.6))
+
+# Кодирование результата для Telegram
+OUTPUT_TARGET_BYTES = int(os.getenv("OUTPUT_TARGET_BYTES", 300_000))
+OUTPUT_MAX_SIDE = int(os.getenv("OUTPUT_MAX_SIDE", 2048))
+OUTPUT_MIN_QUALITY = int(os.getenv("OUTPUT_MIN_QUALITY", 60))
+OUTPUT_MAX_QUALITY = int(os.getenv("OUTPUT_MAX_QUALITY", 92))
+OUTPUT_MAX_ITERATIONS = int(os.getenv("OUTPUT_MAX_ITERATIONS", 5))
+# Дополнительно отправлять оригинал документом (превью-фото уходит первым)
+OUTPUT_SEND_DOCUMENT = os.getenv("OUTPUT_SEND_DOCUMENT", "0") == "1"
+
+# Надзор за генерацией: общий дедлайн от списания до доставки и бюджеты этапов, секунды
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", 120))
+GENERATION_STAGE_BUDGETS = os.getenv(
+    "GENERATION_STAGE_BUDGETS", "preprocess=15,queue=60,upload=20,model=75,encode=15,send=30"
+)
+
+# Приоритетный допуск к Gemini: одновременных запросов (0 - без ограничения),
+# классы «класс=вес:зарезервировано слотов» и старение (секунд ожидания за единицу метки)
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 16))
+GENERATION_PRIORITY_CLASSES = os.getenv("GENERATION_PRIORITY_CLASSES", "paid=6:4,edit=3:2,trial=1:0")
+GENERATION_PRIORITY_AGING = float(os.getenv("GENERATION_PRIORITY_AGING", 30))
+
+# Сколько ждать генерации в работе при остановке (SIGTERM), секунды
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 25))
+
+# Ограничение частоты апдейтов от одного пользователя (token bucket, 0 - отключить)
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") == "1"
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1.0))  # токенов в секунду
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", 12))  # емкость корзины
+THROTTLE_IDLE_TTL = float(os.getenv("THROTTLE_IDLE_TTL", 600))  # секунды простоя до удаления корзины
+
+# Метрики Prometheus и health-эндпоинты (0 - отключить HTTP-сервер)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# Сэмплирующий профилировщик (по умолчанию выключен)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", 0.05))
+PROFILER_SLOW_MS = float(os.getenv("PROFILER_SLOW_MS", 1000))
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", 5))
+PROFILER_OUTPUT = os.getenv("PROFILER_OUTPUT", "")  # Файл collapsed-стеков при остановке
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", 100))
+
+# Трассировка генераций: "file:путь" (JSON-строки) или URL коллектора (POST NDJSON); пусто - выключена
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 100))  # записей в одной отправке коллектору
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", 5))  # секунды
+
+# Настройка логирования; %(trace)s - id трассы генерации (см. tracing)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(trace)s',
+    defaults={"trace": ""}
+))
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+logger = logging.getLogger(__name__)
+# BOT_TOKEN проверяется при запуске бота (bot.main): утилиты вроде
+# migrator.py работают и без него
+
@@ -0,0 +1,174 @@
+"""
+Учет расходов на Gemini API
+
+call_gemini_api возвращал только байты изображения: usageMetadata
+(токены) и версия модели из ответа отбрасывались, и сколько стоит
+генерация, правка или пользователь, было неизвестно.
+
+Каждый запрос к Gemini фиксируется в observe_gemini_call (metrics). Если
+вызов идет внутри collect(), запись о нем (исход, задержка, размеры
+запроса и ответа, токены) добавляется в список, а вызывающий сохраняет
+список в таблицу gemini_calls вместе с заданием журнала
+(Database.record_gemini_calls). Стоимость считается по ценам
+GEMINI_PRICE_INPUT/OUTPUT на момент запроса и хранится в микродолларах.
+
+В той же транзакции растут сводки stats_rollups: стоимость по категориям,
+токены по виду задания и запросы по исходу - по часам, дням и за все
+время. /costs [период] берет итоги из сводок, а средние по запросу и
+самых дорогих пользователей - из gemini_calls за период.
+"""
+import contextvars
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import analytics
+from analytics import StatsReport
+from config import GEMINI_PRICE_INPUT, GEMINI_PRICE_OUTPUT
+
+# Метрики сводок
+CALLS = "gemini_calls"  # по исходу
+COST = "gemini_cost"  # микродоллары, по категории GenderType
+INPUT_TOKENS = "gemini_input_tokens"  # по виду задания (create/edit)
+OUTPUT_TOKENS = "gemini_output_tokens"  # по виду задания
+
+# Пользователей в отчете /costs
+TOP_USERS = 10
+
+CALL_COLUMNS = (
+    "job_id", "user_id", "kind", "category", "model", "outcome", "latency_ms",
+    "request_bytes", "response_bytes", "input_tokens", "image_tokens", "output_tokens", "cost"
+)
+_INSERT_SQL = f'''
+    INSERT INTO gemini_calls ({", ".join(CALL_COLUMNS)})
+    VALUES ({", ".join("?" * len(CALL_COLUMNS))})
+'''
+
+
+@dataclass
+class Usage:
+    """Токены запроса по usageMetadata ответа"""
+    model_version: str = ""
+    input_tokens: int = 0
+    image_tokens: int = 0  # входные токены изображений (часть input_tokens)
+    output_tokens: int = 0
+
+    @property
+    def cost(self) -> int:
+        """Стоимость в микродолларах (цены - за миллион токенов)"""
+        return round(self.input_tokens * GEMINI_PRICE_INPUT + self.output_tokens * GEMINI_PRICE_OUTPUT)
+
+
+def parse_usage(result: Dict[str, Any]) -> Optional[Usage]:
+    """Usage из ответа generateContent; None, если usageMetadata нет"""
+    metadata = result.get("usageMetadata")
+    if not metadata:
+        return None
+    image_tokens = sum(
+        detail.get("tokenCount", 0)
+        for detail in metadata.get("promptTokensDetails", [])
+        if detail.get("modality") == "IMAGE"
+    )
+    return Usage(
+        model_version=result.get("modelVersion", ""),
+        input_tokens=metadata.get("promptTokenCount", 0),
+        image_tokens=image_tokens,
+        # Токены размышлений оплачиваются как выходные
+        output_tokens=metadata.get("candidatesTokenCount", 0) + metadata.get("thoughtsTokenCount", 0)
+    )
+
+
+@dataclass
+class GeminiCall:
+    """Один запрос к Gemini"""
+    outcome: str
+    latency_ms: int
+    request_bytes: int = 0
+    response_bytes: int = 0
+    usage: Optional[Usage] = None
+
+
+_calls: contextvars.ContextVar[Optional[List[GeminiCall]]] = contextvars.ContextVar("gemini_calls", default=None)
+
+
+@contextmanager
+def collect():
+    """Собирает запросы к Gemini, выполненные внутри блока (в той же задаче)"""
+    calls: List[GeminiCall] = []
+    token = _calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _calls.reset(token)
+
+
+def observe(outcome: str, latency: float, request_bytes: int = 0, response_bytes: Optional[int] = None,
+            usage: Optional[Usage] = None):
+    """Добавляет запрос к собираемым collect() (вне collect - ничего)"""
+    calls = _calls.get()
+    if calls is not None:
+        calls.append(GeminiCall(outcome, round(latency * 1000), request_bytes, response_bytes or 0, usage))
+
+
+def store(cursor: sqlite3.Cursor, job_id: int, user_id: int, kind: str, category: str, calls: List[GeminiCall]):
+    """Записывает запросы задания и добавляет их к сводкам; вызывать в транзакции"""
+    rows = []
+    for call in calls:
+        usage = call.usage or Usage()
+        rows.append((
+            job_id, user_id, kind, category, usage.model_version, call.outcome, call.latency_ms,
+            call.request_bytes, call.response_bytes, usage.input_tokens, usage.image_tokens,
+            usage.output_tokens, usage.cost
+        ))
+        analytics.bump(cursor, CALLS, dim=call.outcome)
+        analytics.bump(cursor, COST, usage.cost, dim=category)
+        analytics.bump(cursor, INPUT_TOKENS, usage.input_tokens, dim=kind)
+        analytics.bump(cursor, OUTPUT_TOKENS, usage.output_tokens, dim=kind)
+    cursor.executemany(_INSERT_SQL, rows)
+
+
+@dataclass
+class CallAverages:
+    """Средние по успешным запросам одного вида задания"""
+    calls: int
+    latency_ms: float
+    request_bytes: float
+    input_tokens: float
+    image_tokens: float
+    output_tokens: float
+
+
+@dataclass
+class CostReport:
+    """Расходы за период"""
+    stats: StatsReport  # сводки, в том числе метрики расходов
+    by_kind: Dict[str, CallAverages] = field(default_factory=dict)
+    top_users: List[Tuple[int, int, int]] = field(default_factory=list)  # (user_id, запросов, стоимость)
+
+
+def read_report(cursor: sqlite3.Cursor, text: Optional[str]) -> CostReport:
+    """
+    Расходы за период (см. analytics.parse_period).
+
+    Raises:
+        ValueError: неизвестный период
+    """
+    report = CostReport(analytics.read_report(cursor, text))
+    granularity, count = analytics.parse_period(text)
+    since = analytics.period_start(cursor, granularity, count) or ""
+    cursor.execute(
+        '''SELECT kind, COUNT(*), AVG(latency_ms), AVG(request_bytes),
+                  AVG(input_tokens), AVG(image_tokens), AVG(output_tokens)
+           FROM gemini_calls WHERE created_at >= ? AND outcome = 'ok' GROUP BY kind''',
+        (since,)
+    )
+    for kind, *values in cursor.fetchall():
+        report.by_kind[kind] = CallAverages(*values)
+    cursor.execute(
+        '''SELECT user_id, COUNT(*), SUM(cost) FROM gemini_calls WHERE created_at >= ?
+           GROUP BY user_id ORDER BY SUM(cost) DESC LIMIT ?''',
+        (since, TOP_USERS)
+    )
+    report.top_users = cursor.fetchall()
+    return report
@@ -1,130 +1,693 @@
-"""
-Работа с базой данных SQLite
-"""
-import sqlite3
-from typing import Tuple
-from config import logger
-
-
-class Database:
-    """Класс для работы с базой данных"""
-    
-    def __init__(self, db_name: str = 'fashion_bot.db'):
-        self.db_name = db_name
-        self._init_db()
-    
-    def _get_connection(self) -> sqlite3.Connection:
-        """Создает новое подключение к БД"""
-        return sqlite3.connect(self.db_name, check_same_thread=False)
-    
-    def _init_db(self):
-        """Инициализация базы данных"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                balance INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS generations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                prompt TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
-
-    def get_user_balance(self, user_id: int) -> int:
-        """Получить баланс пользователя"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            else:
-                cursor.execute(
-                    'INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)',
-                    (user_id,)
-                )
-                conn.commit()
-                return 0
-        finally:
-            conn.close()
-
-    def update_user_balance(self, user_id: int, balance: int):
-        """Обновить баланс пользователя"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute(
-                'INSERT OR REPLACE INTO users (user_id, balance) VALUES (?, ?)',
-                (user_id, balance)
-            )
-            conn.commit()
-        finally:
-            conn.close()
-
-    def add_generation(self, user_id: int, prompt: str):
-        """Добавить запись о генерации"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute(
-                'INSERT INTO generations (user_id, prompt) VALUES (?, ?)',
-                (user_id, prompt)
-            )
-            conn.commit()
-        finally:
-            conn.close()
-
-    def get_user_generations_count(self, user_id: int) -> int:
-        """Получить количество генераций пользователя"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute(
-                'SELECT COUNT(*) FROM generations WHERE user_id = ?',
-                (user_id,)
-            )
-            return cursor.fetchone()[0]
-        finally:
-            conn.close()
-
-    def get_all_users_stats(self) -> Tuple[int, int, int]:
-        """Получить общую статистику"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('SELECT COUNT(*) FROM users')
-            total_users = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM generations')
-            total_generations = cursor.fetchone()[0]
-
-            cursor.execute('SELECT SUM(balance) FROM users')
-            total_balance = cursor.fetchone()[0] or 0
-
-            return total_users, total_generations, total_balance
-        finally:
-            conn.close()
-
+"""
+Работа с базой данных SQLite
+"""
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import analytics
+import costs
+import migrator
+from analytics import StatsReport
+from bulk_credit import BulkCreditResult
+from config import DATABASE_PATH, logger
+from generation_archive import SEGMENT_COLUMNS, pack_segment, unpack_segment
+from media_store import content_hash
+from metrics import timed_db_method
+from models import JobState, JOB_TRANSITIONS
+from prompt_templates import TEMPLATES, render_prompt
+from user_cache import UserState, UserStateCache
+
+
+class Database:
+    """Класс для работы с базой данных"""
+
+    # Пользователей в одном запросе WHERE user_id IN (...)
+    IN_CHUNK = 500
+    
+    def __init__(self, db_name: str = DATABASE_PATH):
+        self.db_name = db_name
+        # Кэш состояния пользователей: методы, меняющие баланс и генерации, обновляют его сами
+        self.user_cache = UserStateCache()
+        # Хэш шаблона промпта -> id в prompt_templates
+        self._template_ids: Dict[str, int] = {}
+        self._init_db()
+        # Подключения короткие, и при закрытии последнего SQLite сбрасывает WAL
+        # в файл БД и удаляет его - это удорожало бы каждый запрос. Постоянно
+        # открытое подключение (без транзакций) держит WAL открытым.
+        self._wal_keeper = self._get_connection()
+    
+    def _get_connection(self) -> sqlite3.Connection:
+        """Создает новое подключение к БД"""
+        return sqlite3.connect(self.db_name, check_same_thread=False)
+    
+    def _init_db(self):
+        """Инициализация базы данных: применяет недостающие миграции (см. migrator)"""
+        # Быстрая проверка схемы: версия актуальна - миграции не загружаются
+        conn = self._get_connection()
+        try:
+            version = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0]
+        except sqlite3.OperationalError:
+            version = None  # БД пуста или создана до появления версий
+        finally:
+            conn.close()
+        if version is not None and version >= migrator.latest_version():
+            logger.info("✅ База данных: схема актуальна")
+            return
+
+        applied = migrator.migrate(self.db_name)
+        logger.info(f"✅ База данных инициализирована (применено миграций: {len(applied)})")
+
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Подключение с открытой читающей транзакцией: все запросы видят
+        один согласованный снимок БД, запись в это время не блокируется (WAL).
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN')
+            yield conn
+        finally:
+            conn.rollback()
+            conn.close()
+
+    @staticmethod
+    def _insert_template(cursor: sqlite3.Cursor, name: str, text: str) -> int:
+        """id шаблона в prompt_templates (добавляет его при необходимости)"""
+        digest = content_hash(f"{name}\n{text}".encode())
+        cursor.execute(
+            'INSERT OR IGNORE INTO prompt_templates (name, digest, text) VALUES (?, ?, ?)',
+            (name, digest, text)
+        )
+        cursor.execute('SELECT id FROM prompt_templates WHERE digest = ?', (digest,))
+        return cursor.fetchone()[0]
+
+    def _template_id(self, conn: sqlite3.Connection, name: str) -> int:
+        """id шаблона TEMPLATES[name]; новый шаблон сохраняется отдельной транзакцией"""
+        text = TEMPLATES[name]
+        digest = content_hash(f"{name}\n{text}".encode())
+        template_id = self._template_ids.get(digest)
+        if template_id is None:
+            template_id = self._insert_template(conn.cursor(), name, text)
+            conn.commit()
+            self._template_ids[digest] = template_id
+        return template_id
+
+    def get_user_state(self, user_id: int, with_generations: bool = False) -> UserState:
+        """
+        Состояние пользователя из кэша, при промахе - из БД.
+
+        with_generations - загрузить и число генераций (нужно для проверки
+        бесплатной генерации, остальным хватает баланса).
+        """
+        state = self.user_cache.get(user_id)
+        if state is None:
+            state = self._load_user_state(user_id)
+            self.user_cache.put(user_id, state)
+        if with_generations and state.generations is None:
+            state.generations = self._count_user_generations(user_id)
+        return state
+
+    def get_user_balance(self, user_id: int) -> int:
+        """Получить баланс пользователя"""
+        return self.get_user_state(user_id).balance
+
+    @staticmethod
+    def _ensure_user(cursor: sqlite3.Cursor, user_id: int) -> bool:
+        """Создает пользователя с нулевым балансом, если его нет; True - создан"""
+        cursor.execute('INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)', (user_id,))
+        if cursor.rowcount == 0:
+            return False
+        analytics.bump(cursor, analytics.NEW_USERS)
+        return True
+
+    @timed_db_method
+    def _load_user_state(self, user_id: int) -> UserState:
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('SELECT balance, paid FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
+            
+            if result:
+                return UserState(result[0], bool(result[1]))
+            else:
+                self._ensure_user(cursor, user_id)
+                conn.commit()
+                return UserState(0)
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def update_user_balance(self, user_id: int, balance: int):
+        """Обновить баланс пользователя"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._ensure_user(cursor, user_id)
+            cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+            previous = cursor.fetchone()[0]
+            cursor.execute('UPDATE users SET balance = ? WHERE user_id = ?', (balance, user_id))
+            analytics.bump(cursor, analytics.BALANCE, balance - previous)
+            conn.commit()
+            self.user_cache.set_balance(user_id, balance)
+        finally:
+            conn.close()
+
+    def has_paid(self, user_id: int) -> bool:
+        """Пополнял ли пользователь баланс (/add_balance или /bulk_credit)"""
+        return self.get_user_state(user_id).paid
+
+    @timed_db_method
+    def grant_free_trial(self, user_id: int) -> bool:
+        """
+        Начисляет бесплатную генерацию, если баланс нулевой и бесплатная
+        генерация еще не выдавалась.
+
+        Returns:
+            True, если генерация начислена
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._ensure_user(cursor, user_id)
+            cursor.execute(
+                '''UPDATE users SET balance = balance + 1
+                   WHERE user_id = ? AND balance = 0 AND NOT EXISTS (
+                       SELECT 1 FROM balance_ledger WHERE user_id = ? AND reason = 'free_trial'
+                   )''',
+                (user_id, user_id)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            cursor.execute(
+                'INSERT INTO balance_ledger (user_id, delta, reason) VALUES (?, 1, ?)',
+                (user_id, 'free_trial')
+            )
+            analytics.bump(cursor, analytics.FREE_TRIALS)
+            analytics.bump(cursor, analytics.BALANCE, 1)
+            conn.commit()
+            self.user_cache.set_balance(user_id, 1)
+            return True
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def credit_balance(self, user_id: int, amount: int) -> int:
+        """
+        Пополняет баланс на amount генераций (с записью в журнал баланса).
+
+        Returns:
+            новый баланс
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._ensure_user(cursor, user_id)
+            # Первое пополнение после бесплатной генерации - конверсия
+            cursor.execute(
+                '''SELECT COALESCE(SUM(reason = 'free_trial'), 0), COALESCE(SUM(reason = 'credit'), 0)
+                   FROM balance_ledger WHERE user_id = ?''',
+                (user_id,)
+            )
+            trials, credits = cursor.fetchone()
+            cursor.execute(
+                'UPDATE users SET balance = balance + ?, paid = 1 WHERE user_id = ?',
+                (amount, user_id)
+            )
+            cursor.execute(
+                'INSERT INTO balance_ledger (user_id, delta, reason) VALUES (?, ?, ?)',
+                (user_id, amount, 'credit')
+            )
+            cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+            balance = cursor.fetchone()[0]
+            analytics.bump(cursor, analytics.CREDITS, amount)
+            analytics.bump(cursor, analytics.BALANCE, amount)
+            if trials and not credits:
+                analytics.bump(cursor, analytics.TRIAL_CONVERSIONS)
+            conn.commit()
+            self.user_cache.set_balance(user_id, balance, paid=True)
+            return balance
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def bulk_credit(
+        self,
+        batch_id: str,
+        rows: Sequence[Tuple[int, int]],
+        admin_id: Optional[int] = None
+    ) -> BulkCreditResult:
+        """
+        Пополняет баланс пачке пользователей одной транзакцией.
+
+        rows - пары (user_id, количество) без повторов user_id. Пачка с
+        уже примененным batch_id не начисляется повторно.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT rows, total, created_at FROM credit_batches WHERE batch_id = ?', (batch_id,))
+            applied = cursor.fetchone()
+            if applied:
+                conn.rollback()
+                return BulkCreditResult(batch_id, False, *applied)
+
+            user_ids = [user_id for user_id, _ in rows]
+            cursor.executemany(
+                'INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)',
+                [(user_id,) for user_id in user_ids]
+            )
+            new_users = cursor.rowcount
+
+            # Первое пополнение после бесплатной генерации - конверсия
+            trials, credited = set(), set()
+            for chunk in self._chunks(user_ids):
+                cursor.execute(
+                    f'''SELECT user_id, reason FROM balance_ledger
+                        WHERE user_id IN ({", ".join("?" * len(chunk))}) AND reason IN ('free_trial', 'credit')''',
+                    chunk
+                )
+                for user_id, reason in cursor.fetchall():
+                    (trials if reason == 'free_trial' else credited).add(user_id)
+
+            cursor.executemany(
+                'UPDATE users SET balance = balance + ?, paid = 1 WHERE user_id = ?',
+                [(amount, user_id) for user_id, amount in rows]
+            )
+            cursor.executemany(
+                'INSERT INTO balance_ledger (user_id, delta, reason, batch_id) VALUES (?, ?, ?, ?)',
+                [(user_id, amount, 'credit', batch_id) for user_id, amount in rows]
+            )
+            total = sum(amount for _, amount in rows)
+            cursor.execute(
+                'INSERT INTO credit_batches (batch_id, admin_id, rows, total) VALUES (?, ?, ?, ?)',
+                (batch_id, admin_id, len(rows), total)
+            )
+            analytics.bump(cursor, analytics.NEW_USERS, new_users)
+            analytics.bump(cursor, analytics.CREDITS, total)
+            analytics.bump(cursor, analytics.BALANCE, total)
+            analytics.bump(cursor, analytics.TRIAL_CONVERSIONS, len(trials - credited))
+
+            balances = {}
+            for chunk in self._chunks(user_ids):
+                cursor.execute(
+                    f'SELECT user_id, balance FROM users WHERE user_id IN ({", ".join("?" * len(chunk))})',
+                    chunk
+                )
+                balances.update(cursor.fetchall())
+            cursor.execute('SELECT created_at FROM credit_batches WHERE batch_id = ?', (batch_id,))
+            created_at = cursor.fetchone()[0]
+            conn.commit()
+            for user_id, balance in balances.items():
+                self.user_cache.set_balance(user_id, balance, paid=True)
+            return BulkCreditResult(batch_id, True, len(rows), total, created_at, balances)
+        finally:
+            conn.close()
+
+    @classmethod
+    def _chunks(cls, items: Sequence) -> List[Sequence]:
+        return [items[i:i + cls.IN_CHUNK] for i in range(0, len(items), cls.IN_CHUNK)]
+
+    @timed_db_method
+    def add_generation(
+        self,
+        user_id: int,
+        template: str,
+        params: str,
+        additions: Optional[str] = None,
+        job_id: Optional[int] = None
+    ):
+        """
+        Добавить запись о подтвержденной генерации.
+
+        template и params - имя шаблона и строка параметров
+        (prompt_templates.describe_prompt), additions - текст правки.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            template_id = self._template_id(conn, template)
+            cursor.execute(
+                'INSERT INTO generations (user_id, template_id, params, additions, job_id) VALUES (?, ?, ?, ?, ?)',
+                (user_id, template_id, params, additions, job_id)
+            )
+            # Анкета подтверждена - черновик больше не нужен
+            cursor.execute('DELETE FROM generation_drafts WHERE user_id = ?', (user_id,))
+            analytics.bump(
+                cursor,
+                analytics.EDITS if additions else analytics.GENERATIONS,
+                dim=analytics.category(params)
+            )
+            conn.commit()
+            self.user_cache.add_generation(user_id)
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def save_draft(self, user_id: int, template: str, params: str):
+        """Запомнить заполненную, но еще не подтвержденную анкету"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            template_id = self._template_id(conn, template)
+            cursor.execute(
+                '''INSERT INTO generation_drafts (user_id, template_id, params) VALUES (?, ?, ?)
+                   ON CONFLICT (user_id) DO UPDATE SET
+                       template_id = excluded.template_id,
+                       params = excluded.params,
+                       updated_at = CURRENT_TIMESTAMP''',
+                (user_id, template_id, params)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_user_generations_count(self, user_id: int) -> int:
+        """Получить количество генераций пользователя"""
+        return self.get_user_state(user_id, with_generations=True).generations
+
+    @timed_db_method
+    def _count_user_generations(self, user_id: int) -> int:
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                '''SELECT (SELECT COUNT(*) FROM generations WHERE user_id = ?)
+                        + (SELECT COALESCE(SUM(rows), 0) FROM generation_archive_users WHERE user_id = ?)''',
+                (user_id, user_id)
+            )
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def get_stats(self, period: Optional[str] = None) -> StatsReport:
+        """
+        Статистика за период из сводок (см. analytics.parse_period).
+
+        Raises:
+            ValueError: неизвестный период
+        """
+        conn = self._get_connection()
+        
+        try:
+            return analytics.read_report(conn.cursor(), period)
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def get_costs(self, period: Optional[str] = None) -> costs.CostReport:
+        """
+        Расходы на Gemini за период (см. costs.read_report).
+
+        Raises:
+            ValueError: неизвестный период
+        """
+        conn = self._get_connection()
+        
+        try:
+            return costs.read_report(conn.cursor(), period)
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def get_user_generations(self, user_id: int) -> List[Dict[str, Any]]:
+        """
+        История генераций пользователя, включая архив, от старых к новым.
+
+        Промпт восстанавливается из шаблона и параметров.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            rows = []
+            cursor.execute(
+                '''SELECT a.data FROM generation_archive a
+                   JOIN generation_archive_users u ON u.segment_id = a.id
+                   WHERE u.user_id = ? ORDER BY a.id''',
+                (user_id,)
+            )
+            for (data,) in cursor.fetchall():
+                rows.extend(
+                    dict(zip(SEGMENT_COLUMNS, row), archived=True)
+                    for row in unpack_segment(data) if row[1] == user_id
+                )
+            cursor.execute(
+                f'''SELECT {", ".join(SEGMENT_COLUMNS)} FROM generations
+                    WHERE user_id = ? ORDER BY id''',
+                (user_id,)
+            )
+            rows.extend(dict(zip(SEGMENT_COLUMNS, row), archived=False) for row in cursor.fetchall())
+            if not rows:
+                return rows
+
+            template_ids = {row["template_id"] for row in rows}
+            cursor.execute(
+                f'''SELECT id, name, text FROM prompt_templates
+                    WHERE id IN ({", ".join("?" * len(template_ids))})''',
+                tuple(template_ids)
+            )
+            templates = {template_id: (name, text) for template_id, name, text in cursor.fetchall()}
+            for row in rows:
+                name, text = templates[row["template_id"]]
+                row["template"] = name
+                row["prompt"] = render_prompt(name, text, row["params"], row["additions"])
+            return rows
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def archive_generations(self, older_than_days: float, max_rows: int) -> int:
+        """
+        Переносит до max_rows самых старых генераций старше older_than_days
+        в один сжатый сегмент архива.
+
+        Returns:
+            число перенесенных строк
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT datetime('now', ?)", (f"-{older_than_days} days",))
+            cutoff = cursor.fetchone()[0]
+            # id растут вместе с created_at: берем префикс таблицы до первой свежей строки
+            cursor.execute(f'SELECT {", ".join(SEGMENT_COLUMNS)} FROM generations ORDER BY id')
+            rows = []
+            for row in cursor:
+                if (row[-1] is not None and row[-1] >= cutoff) or len(rows) >= max_rows:
+                    break
+                rows.append(row)
+            if not rows:
+                conn.rollback()
+                return 0
+
+            cursor.execute(
+                '''INSERT INTO generation_archive (first_id, last_id, first_created, last_created, rows, data)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (rows[0][0], rows[-1][0], rows[0][-1], rows[-1][-1], len(rows), pack_segment(rows))
+            )
+            segment_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO generation_archive_users (user_id, segment_id, rows) VALUES (?, ?, ?)',
+                [(user_id, segment_id, count) for user_id, count in Counter(row[1] for row in rows).items()]
+            )
+            cursor.execute('DELETE FROM generations WHERE id BETWEEN ? AND ?', (rows[0][0], rows[-1][0]))
+            conn.commit()
+            # execute выполняет прагму за один шаг (одну страницу), executescript - целиком
+            conn.executescript('PRAGMA incremental_vacuum;')
+            return len(rows)
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def reserve_generation(
+        self,
+        user_id: int,
+        chat_id: int,
+        kind: str,
+        prompt: str,
+        input_hash: Optional[str],
+        cost: int = 1
+    ) -> Optional[int]:
+        """
+        Атомарно списывает баланс и создает задание в состоянии reserved.
+
+        Returns:
+            id задания или None, если баланса недостаточно
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            if cost:
+                cursor.execute(
+                    'UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?',
+                    (cost, user_id, cost)
+                )
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return None
+
+            cursor.execute(
+                '''INSERT INTO generation_jobs (user_id, chat_id, kind, state, cost, prompt, input_hash)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (user_id, chat_id, kind, JobState.RESERVED.value, cost, prompt, input_hash)
+            )
+            job_id = cursor.lastrowid
+
+            if cost:
+                cursor.execute(
+                    'INSERT INTO balance_ledger (user_id, delta, reason, job_id) VALUES (?, ?, ?, ?)',
+                    (user_id, -cost, 'generation', job_id)
+                )
+                analytics.bump(cursor, analytics.BALANCE, -cost)
+            conn.commit()
+            self.user_cache.adjust_balance(user_id, -cost)
+            return job_id
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _transition(cursor: sqlite3.Cursor, job_id: int, state: JobState, **fields) -> bool:
+        """Переводит задание в state, если текущее состояние это допускает"""
+        allowed = [s.value for s in JOB_TRANSITIONS[state]]
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        if assignments:
+            assignments = ", " + assignments
+        cursor.execute(
+            f'''UPDATE generation_jobs SET state = ?, updated_at = CURRENT_TIMESTAMP{assignments}
+                WHERE id = ? AND state IN ({", ".join("?" * len(allowed))})''',
+            (state.value, *fields.values(), job_id, *allowed)
+        )
+        return cursor.rowcount > 0
+
+    @timed_db_method
+    def transition_job(self, job_id: int, state: JobState, **fields) -> bool:
+        """
+        Переход задания по машине состояний (идемпотентно).
+
+        Returns:
+            False, если задание уже не в исходном для перехода состоянии
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            changed = self._transition(cursor, job_id, state, **fields)
+            if changed and state == JobState.DELIVERED:
+                analytics.bump(cursor, analytics.DELIVERIES)
+            conn.commit()
+            return changed
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def refund_job(self, job_id: int, error: Optional[str] = None) -> bool:
+        """
+        Возвращает баланс за задание и переводит его в refunded.
+
+        Возврат делается в одной транзакции с переходом состояния, поэтому
+        повторный вызов ничего не начислит.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            fields = {"error": error} if error is not None else {}
+            if not self._transition(cursor, job_id, JobState.REFUNDED, **fields):
+                conn.rollback()
+                return False
+
+            cursor.execute('SELECT user_id, cost FROM generation_jobs WHERE id = ?', (job_id,))
+            user_id, cost = cursor.fetchone()
+            if cost:
+                cursor.execute(
+                    'UPDATE users SET balance = balance + ? WHERE user_id = ?',
+                    (cost, user_id)
+                )
+                cursor.execute(
+                    'INSERT INTO balance_ledger (user_id, delta, reason, job_id) VALUES (?, ?, ?, ?)',
+                    (user_id, cost, 'refund', job_id)
+                )
+                analytics.bump(cursor, analytics.BALANCE, cost)
+            reason = analytics.refund_reason(error)
+            analytics.bump(cursor, analytics.REFUNDS, dim=reason)
+            if reason == analytics.REFUND_ERROR:
+                analytics.bump(cursor, analytics.FAILURES)
+            conn.commit()
+            self.user_cache.adjust_balance(user_id, cost)
+            return True
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def record_gemini_calls(self, job_id: int, calls: Sequence[costs.GeminiCall], category: str = ""):
+        """Сохраняет запросы к Gemini по заданию и добавляет их к сводкам расходов"""
+        if not calls:
+            return
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('SELECT user_id, kind FROM generation_jobs WHERE id = ?', (job_id,))
+            user_id, kind = cursor.fetchone()
+            costs.store(cursor, job_id, user_id, kind, category, calls)
+            conn.commit()
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Задание журнала по id"""
+        conn = self._get_connection()
+        conn.row_factory = sqlite3.Row
+        
+        try:
+            row = conn.execute('SELECT * FROM generation_jobs WHERE id = ?', (job_id,)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    @timed_db_method
+    def get_unfinished_jobs(self) -> List[Dict[str, Any]]:
+        """Задания, не дошедшие до delivered/refunded, с параметрами генерации (params)"""
+        conn = self._get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                '''SELECT j.*, (
+                       SELECT g.params FROM generations g WHERE g.user_id = j.user_id AND g.job_id = j.id
+                   ) AS params
+                   FROM generation_jobs j WHERE j.state IN (?, ?, ?, ?) ORDER BY j.id''',
+                (
+                    JobState.RESERVED.value,
+                    JobState.SUBMITTED.value,
+                    JobState.SUCCEEDED.value,
+                    JobState.FAILED.value
+                )
+            )
+            return [dict(row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
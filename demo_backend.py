@@ -0,0 +1,217 @@
+"""
+Демо-бэкенд генерации для нагрузочного тестирования
+
+Подменяет Gemini API без расхода квоты: отдает заранее отрисованные шаблонные
+изображения, имитирует задержки (логнормальное распределение) и типичные ошибки
+API (429, 500, «location is not supported», текст вместо изображения), не
+блокируя event loop. Поддерживает сценарии внесения отказов из файла.
+
+Формат сценария (DEMO_FAULT_SCRIPT) - по одному шагу на строку:
+    ok              # успешный ответ
+    429*3           # три ответа 429 подряд
+    500 2500        # ответ 500 с задержкой 2500 мс
+    location
+    text
+    timeout         # задержка и сетевая ошибка
+Строки после # игнорируются. Когда сценарий закончится, используется
+случайное распределение из DEMO_ERROR_RATES.
+"""
+import asyncio
+import io
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from config import (
+    DEMO_LATENCY_MEDIAN_MS,
+    DEMO_LATENCY_SIGMA,
+    DEMO_ERROR_RATES,
+    DEMO_FAULT_SCRIPT,
+    logger
+)
+from costs import Usage
+from metrics import observe_gemini_call, record_cache_lookup
+
+OUTCOMES = ("ok", "429", "500", "location", "text", "timeout")
+
+# Цвета шаблонов: по одному изображению на вариант
+TEMPLATE_COLORS = [(73, 109, 137), (137, 96, 73), (84, 122, 88), (120, 120, 120)]
+TEMPLATE_SIZE = (1024, 1024)
+# Токены, которые Gemini насчитывает за входное фото и за изображение 1024x1024
+IMAGE_INPUT_TOKENS = 258
+IMAGE_OUTPUT_TOKENS = 1290
+
+
+def demo_usage(prompt: str, output_tokens: int = IMAGE_OUTPUT_TOKENS) -> Usage:
+    """Токены, как их посчитал бы Gemini (около 4 символов на токен промпта)"""
+    return Usage(
+        model_version="demo",
+        input_tokens=len(prompt) // 4 + IMAGE_INPUT_TOKENS,
+        image_tokens=IMAGE_INPUT_TOKENS,
+        output_tokens=output_tokens
+    )
+
+
+def parse_error_rates(spec: str) -> Dict[str, float]:
+    """Разбирает строку вида «429=0.02,500=0.01,text=0.01»"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        outcome, _, value = item.partition("=")
+        if outcome not in OUTCOMES or outcome == "ok":
+            raise ValueError(f"Неизвестный исход в DEMO_ERROR_RATES: {outcome}")
+        rates[outcome] = float(value)
+    return rates
+
+
+def parse_fault_script(text: str) -> List[Tuple[str, Optional[float]]]:
+    """Разбирает сценарий отказов в список шагов (исход, задержка в мс)"""
+    steps = []
+    for line_no, raw in enumerate(text.splitlines(), 1):
+        line = raw.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        outcome, _, count = parts[0].partition("*")
+        if outcome not in OUTCOMES:
+            raise ValueError(f"Строка {line_no}: неизвестный исход {outcome}")
+        delay_ms = float(parts[1]) if len(parts) > 1 else None
+        steps.extend([(outcome, delay_ms)] * int(count or 1))
+    return steps
+
+
+class DemoBackend:
+    """
+    Фейковый бэкенд генерации изображений.
+
+    Args:
+        latency_median_ms: Медиана задержки ответа
+        latency_sigma: Разброс логнормального распределения (0 - константа)
+        error_rates: Доли ошибок по исходам
+        script: Шаги сценария отказов, выполняются до случайных исходов
+        seed: Зерно генератора для воспроизводимых прогонов
+    """
+
+    def __init__(
+        self,
+        latency_median_ms: float = 6000,
+        latency_sigma: float = 0.35,
+        error_rates: Dict[str, float] = None,
+        script: List[Tuple[str, Optional[float]]] = None,
+        seed: Optional[int] = None
+    ):
+        self.latency_median_ms = latency_median_ms
+        self.latency_sigma = latency_sigma
+        self.error_rates = error_rates or {}
+        self.script: Deque[Tuple[str, Optional[float]]] = deque(script or [])
+        self.rng = random.Random(seed)
+        self._templates: List[bytes] = []
+        self._render_lock = asyncio.Lock()
+
+    @staticmethod
+    def _render_templates() -> List[bytes]:
+        from PIL import Image, ImageDraw
+
+        templates = []
+        for index, color in enumerate(TEMPLATE_COLORS):
+            img = Image.new('RGB', TEMPLATE_SIZE, color=color)
+            d = ImageDraw.Draw(img)
+            d.text((50, 50), f"ДЕМО-РЕЖИМ. Шаблон #{index + 1}", fill=(255, 255, 255))
+            stream = io.BytesIO()
+            img.save(stream, format='JPEG', quality=85)
+            templates.append(stream.getvalue())
+        return templates
+
+    async def warm_up(self):
+        """Отрисовывает шаблоны один раз в пуле потоков"""
+        if self._templates:
+            return
+        async with self._render_lock:
+            if not self._templates:
+                self._templates = await asyncio.to_thread(self._render_templates)
+                logger.info(f"🧪 Демо-бэкенд: подготовлено {len(self._templates)} шаблонов")
+
+    def _next_step(self) -> Tuple[str, float]:
+        if self.script:
+            outcome, delay_ms = self.script.popleft()
+        else:
+            outcome, delay_ms = self._random_outcome(), None
+        if delay_ms is None:
+            delay_ms = self._sample_latency_ms()
+        return outcome, delay_ms
+
+    def _random_outcome(self) -> str:
+        roll = self.rng.random()
+        for outcome, rate in self.error_rates.items():
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+    def _sample_latency_ms(self) -> float:
+        if self.latency_sigma <= 0:
+            return self.latency_median_ms
+        return self.rng.lognormvariate(0, self.latency_sigma) * self.latency_median_ms
+
+    async def generate(self, prompt: str) -> bytes:
+        """
+        Имитирует вызов generateContent.
+
+        Raises:
+            Exception: С тем же текстом, что и у реального API для данного исхода
+        """
+        started = time.perf_counter()
+        record_cache_lookup("demo_templates", bool(self._templates))
+        await self.warm_up()
+
+        outcome, delay_ms = self._next_step()
+        await asyncio.sleep(delay_ms / 1000)
+
+        if outcome == "ok":
+            image_bytes = self._templates[hash(prompt) % len(self._templates)]
+            observe_gemini_call(started, "ok", len(prompt), len(image_bytes), demo_usage(prompt))
+            return image_bytes
+        if outcome == "429":
+            observe_gemini_call(started, "http_429", len(prompt))
+            raise Exception(
+                'Ошибка генерации: API вернул код 429: '
+                '{"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}}'
+            )
+        if outcome == "500":
+            observe_gemini_call(started, "http_500", len(prompt))
+            raise Exception(
+                'Ошибка генерации: API вернул код 500: '
+                '{"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}}'
+            )
+        if outcome == "location":
+            observe_gemini_call(started, "http_400", len(prompt))
+            raise Exception(
+                'Ошибка генерации: API вернул код 400: '
+                '{"error": {"code": 400, "message": "User location is not supported for the API use.", '
+                '"status": "FAILED_PRECONDITION"}}'
+            )
+        if outcome == "text":
+            observe_gemini_call(started, "text_instead_of_image", len(prompt), usage=demo_usage(prompt, 40))
+            raise Exception(
+                "Ошибка генерации: API вернул текст вместо изображения: "
+                "I can't generate this image, but here is a description instead."
+            )
+        observe_gemini_call(started, "network_error", len(prompt))
+        raise Exception("Ошибка сетевого запроса к Gemini API: Read timed out. (demo)")
+
+
+def _load_script(path: str) -> List[Tuple[str, Optional[float]]]:
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        steps = parse_fault_script(f.read())
+    logger.info(f"🧪 Демо-бэкенд: загружен сценарий отказов {path} ({len(steps)} шагов)")
+    return steps
+
+
+demo_backend = DemoBackend(
+    latency_median_ms=DEMO_LATENCY_MEDIAN_MS,
+    latency_sigma=DEMO_LATENCY_SIGMA,
+    error_rates=parse_error_rates(DEMO_ERROR_RATES),
+    script=_load_script(DEMO_FAULT_SCRIPT)
+)
@@ -0,0 +1,143 @@
+"""
+Сессии правок: цепочка "Внести изменения" как диалог с Gemini
+
+Раньше каждая правка выбрасывала сгенерированное изображение и просила
+Gemini начать заново с исходного фото и original_prompt плюс "Additional
+user requirements". Чтобы получить нужный результат, часто требовалось
+несколько платных попыток.
+
+Сессия хранит хэш последнего результата и компактную историю шагов, а
+правка отправляется многоходовым запросом: исходное фото с промптом,
+прошлые результаты как ответы модели и новая инструкция. Gemini правит
+предыдущее изображение, а не генерирует его с нуля.
+
+История ограничена по числу прошлых результатов и их суммарному размеру:
+вытесняются самые старые шаги, исходный запрос и последний результат
+остаются всегда. Изображения передаются ссылками File API, когда они уже
+загружены (см. source_uploads).
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from config import (
+    EDIT_SESSION_MAX_TURNS,
+    EDIT_SESSION_MAX_BYTES,
+    EDIT_SESSION_TTL,
+    EDIT_SESSION_MAX_USERS
+)
+from gemini_api import build_conversation_body, text_part
+from source_uploads import source_uploads
+
+
+@dataclass
+class EditTurn:
+    """Шаг сессии: инструкция и полученный по ней результат"""
+    instruction: Optional[str]  # None - первая генерация по исходному промпту
+    output_hash: str
+    output_size: int
+
+
+@dataclass
+class EditSession:
+    """Цепочка правок одного исходного фото"""
+    source_hash: str
+    base_prompt: str
+    turns: List[EditTurn] = field(default_factory=list)
+    evicted: int = 0
+    updated: float = field(default_factory=time.monotonic)
+
+    @property
+    def last_output_hash(self) -> str:
+        return self.turns[-1].output_hash
+
+    def add_turn(
+        self,
+        instruction: Optional[str],
+        output_hash: str,
+        output_size: int,
+        max_turns: int = EDIT_SESSION_MAX_TURNS,
+        max_bytes: int = EDIT_SESSION_MAX_BYTES
+    ):
+        """Добавляет результат и вытесняет самые старые шаги сверх лимитов"""
+        self.turns.append(EditTurn(instruction, output_hash, output_size))
+        self.updated = time.monotonic()
+        while len(self.turns) > 1 and (
+            len(self.turns) > max_turns
+            or sum(turn.output_size for turn in self.turns) > max_bytes
+        ):
+            self.turns.pop(0)
+            self.evicted += 1
+
+    async def build_body(self, instruction: str, source_part) -> bytes:
+        """
+        Тело многоходового запроса для новой правки.
+
+        source_part - функция без аргументов, возвращающая фрагмент запроса
+        с исходным фото (см. store_generation_input). Порядок ходов:
+        исходное фото с промптом (user), затем для каждого шага результат
+        (model) и следующая инструкция (user). Инструкция вытесненного шага
+        уже отражена в результатах, оставшихся в истории.
+        """
+        turns = [("user", [text_part(self.base_prompt), await source_part()])]
+        for index, turn in enumerate(self.turns):
+            turns.append(("model", [await source_uploads.part(turn.output_hash)]))
+            following = self.turns[index + 1].instruction if index + 1 < len(self.turns) else instruction
+            turns.append(("user", [text_part(following)]))
+        return build_conversation_body(turns)
+
+
+class EditSessionStore:
+    """Сессии по пользователям: LRU с ограничением числа и временем жизни"""
+
+    def __init__(self, max_users: int = EDIT_SESSION_MAX_USERS, ttl: float = EDIT_SESSION_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._sessions: "OrderedDict[int, EditSession]" = OrderedDict()
+
+    def start(self, user_id: int, source_hash: str, base_prompt: str, output_hash: str, output_size: int) -> EditSession:
+        """Начинает сессию с результата первой генерации"""
+        session = EditSession(source_hash, base_prompt)
+        session.add_turn(None, output_hash, output_size)
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_users:
+            self._sessions.popitem(last=False)
+        return session
+
+    def get(self, user_id: int, source_hash: Optional[str] = None) -> Optional[EditSession]:
+        """
+        Сессия пользователя, если она не истекла.
+
+        Если задан source_hash, сессия должна относиться к этому фото.
+        """
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.updated > self.ttl:
+            del self._sessions[user_id]
+            return None
+        if source_hash is not None and session.source_hash != source_hash:
+            return None
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def discard(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+    def media_hashes(self) -> Set[str]:
+        """Хэши исходных фото и результатов неистекших сессий (их нельзя удалять из хранилища медиа)"""
+        now = time.monotonic()
+        hashes = set()
+        for session in self._sessions.values():
+            if now - session.updated <= self.ttl:
+                hashes.add(session.source_hash)
+                hashes.update(turn.output_hash for turn in session.turns)
+        return hashes
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+edit_sessions = EditSessionStore()
@@ -0,0 +1,160 @@
+"""
+Выгрузка данных для администратора (/export)
+
+Раньше получить данные можно было только копированием fashion_bot.db.
+Выгрузка пишет таблицы в CSV или NDJSON со сжатием gzip на лету во
+временные файлы, которые затем отправляются документами.
+
+- Память не зависит от размера таблиц: строки читаются курсором пачками
+  по EXPORT_CHUNK_ROWS, архив генераций - по одному сегменту.
+- Все таблицы читаются в одной читающей транзакции (Database.read_snapshot):
+  выгрузка согласована, а в режиме WAL не блокирует запись - бот
+  продолжает обслуживать пользователей.
+- Работа с БД и сжатие выполняются в отдельном потоке.
+"""
+import asyncio
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+from dataclasses import dataclass
+from typing import Iterator, List, Sequence, Tuple
+
+import costs
+from config import EXPORT_CHUNK_ROWS
+from generation_archive import unpack_segment
+
+EXPORT_TABLES = ("users", "ledger", "generations", "calls")
+FORMATS = ("csv", "ndjson")
+
+USER_COLUMNS = ("user_id", "username", "full_name", "balance", "paid", "created_at")
+LEDGER_COLUMNS = ("id", "user_id", "delta", "reason", "job_id", "batch_id", "created_at")
+GENERATION_COLUMNS = ("id", "user_id", "job_id", "created_at", "template", "params", "additions", "archived")
+CALL_COLUMNS = ("id", *costs.CALL_COLUMNS, "created_at")
+
+# Лимит размера документа, отправляемого ботом
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+@dataclass
+class ExportFile:
+    """Готовый файл выгрузки"""
+    table: str
+    filename: str  # имя документа в Telegram
+    path: str
+    rows: int = 0
+    size: int = 0
+
+
+def _iter_query(conn: sqlite3.Connection, sql: str) -> Iterator[tuple]:
+    cursor = conn.execute(sql)
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            return
+        yield from rows
+
+
+def _iter_generations(conn: sqlite3.Connection) -> Iterator[tuple]:
+    """Архивные, затем текущие генерации с именем шаблона вместо id"""
+    templates = dict(conn.execute('SELECT id, name FROM prompt_templates'))
+    segments = conn.execute('SELECT data FROM generation_archive ORDER BY id')
+    while True:
+        segment = segments.fetchone()
+        if segment is None:
+            break
+        for generation_id, user_id, template_id, params, additions, job_id, created_at in unpack_segment(segment[0]):
+            yield generation_id, user_id, job_id, created_at, templates.get(template_id), params, additions, 1
+    for generation_id, user_id, template_id, params, additions, job_id, created_at in _iter_query(
+        conn,
+        'SELECT id, user_id, template_id, params, additions, job_id, created_at FROM generations ORDER BY id'
+    ):
+        yield generation_id, user_id, job_id, created_at, templates.get(template_id), params, additions, 0
+
+
+def _table_rows(conn: sqlite3.Connection, table: str) -> Tuple[Sequence[str], Iterator[tuple]]:
+    if table == "users":
+        return USER_COLUMNS, _iter_query(conn, f'SELECT {", ".join(USER_COLUMNS)} FROM users ORDER BY user_id')
+    if table == "ledger":
+        return LEDGER_COLUMNS, _iter_query(conn, f'SELECT {", ".join(LEDGER_COLUMNS)} FROM balance_ledger ORDER BY id')
+    if table == "calls":
+        return CALL_COLUMNS, _iter_query(conn, f'SELECT {", ".join(CALL_COLUMNS)} FROM gemini_calls ORDER BY id')
+    return GENERATION_COLUMNS, _iter_generations(conn)
+
+
+def write_table(conn: sqlite3.Connection, table: str, fmt: str, path: str) -> int:
+    """
+    Пишет таблицу в gzip-файл в формате fmt.
+
+    Returns:
+        число строк
+    """
+    columns, rows = _table_rows(conn, table)
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                f.write("\n")
+                count += 1
+    return count
+
+
+def parse_export_args(args: Sequence[str]) -> Tuple[List[str], str]:
+    """
+    Аргументы /export: таблицы (users, ledger, generations, calls, all) и формат
+    (csv, ndjson) в любом порядке.
+
+    Raises:
+        ValueError: неизвестный аргумент
+    """
+    tables, fmt = [], "csv"
+    for arg in (arg.lower() for arg in args):
+        if arg in FORMATS:
+            fmt = arg
+        elif arg == "all":
+            tables = list(EXPORT_TABLES)
+        elif arg in EXPORT_TABLES:
+            if arg not in tables:
+                tables.append(arg)
+        else:
+            raise ValueError(f"Неизвестный аргумент: {arg}")
+    return tables or list(EXPORT_TABLES), fmt
+
+
+def _export(db, tables: Sequence[str], fmt: str, stamp: str) -> List[ExportFile]:
+    files = []
+    try:
+        with db.read_snapshot() as conn:
+            for table in tables:
+                fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{fmt}.gz")
+                os.close(fd)
+                export_file = ExportFile(table, f"{table}-{stamp}.{fmt}.gz", path)
+                files.append(export_file)
+                export_file.rows = write_table(conn, table, fmt, path)
+                export_file.size = os.path.getsize(path)
+    except BaseException:
+        remove_files(files)
+        raise
+    return files
+
+
+async def export_tables(db, tables: Sequence[str], fmt: str, stamp: str) -> List[ExportFile]:
+    """Выгружает таблицы во временные файлы (удалить через remove_files)"""
+    return await asyncio.to_thread(_export, db, tables, fmt, stamp)
+
+
+def remove_files(files: Sequence[ExportFile]):
+    for export_file in files:
+        try:
+            os.remove(export_file.path)
+        except OSError:
+            pass
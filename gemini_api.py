@@ -1,125 +1,304 @@
-"""
-Интеграция с Google Gemini API
-
-Использует прямой REST API для генерации изображений через модель gemini-2.5-flash-image.
-Этот подход работает напрямую с HTTP запросами, без необходимости устанавливать 
-устаревшие версии google-generativeai.
-"""
-import base64
-import io
-from typing import Dict, Any
-
-import requests
-from PIL import Image, ImageDraw
-
-from config import GEMINI_API_KEY, GEMINI_DEMO_MODE, logger
-
-
-def call_gemini_api(
-    input_image_path: str,
-    prompt: str,
-    extra_params: Dict[str, Any] = None
-) -> bytes:
-    """
-    Отправляет изображение и промпт в Gemini 2.5 Flash Image API и возвращает байты изображения.
-    
-    Args:
-        input_image_path: Путь к входному изображению (одежда)
-        prompt: Текстовый промпт для генерации (описание модели и сцены)
-        extra_params: Дополнительные параметры API
-        
-    Returns:
-        bytes: Байты сгенерированного изображения
-        
-    Raises:
-        Exception: При ошибках API или отсутствии результата
-    """
-    if GEMINI_DEMO_MODE:
-        return _generate_demo_image(prompt)
-
-    # Конфигурация endpoint
-    endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image:generateContent?key={GEMINI_API_KEY}"
-    headers = {"Content-Type": "application/json"}
-    
-    try:
-        # Загрузка и кодирование входного изображения
-        with open(input_image_path, 'rb') as img_file:
-            input_image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-        
-        # Формирование payload с промптом и изображением
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inlineData": {
-                            "mimeType": "image/jpeg",
-                            "data": input_image_base64
-                        }
-                    }
-                ]
-            }]
-        }
-        
-        logger.info("Отправка запроса к Gemini 2.5 Flash Image API...")
-        
-        # Отправка запроса
-        response = requests.post(endpoint, headers=headers, json=payload, timeout=60)
-        
-        if response.status_code != 200:
-            error_msg = f"API вернул код {response.status_code}: {response.text}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
-        
-        result = response.json()
-        
-        # Извлечение изображения из ответа
-        for candidate in result.get("candidates", []):
-            for part in candidate.get("content", {}).get("parts", []):
-                # Проверяем оба варианта ключа (camelCase и snake_case)
-                inline = part.get("inlineData") or part.get("inline_data")
-                
-                if inline and "data" in inline:
-                    # Декодирование base64 изображения
-                    image_bytes = base64.b64decode(inline["data"])
-                    logger.info(f"✅ Успешно получено изображение ({len(image_bytes)} байт)")
-                    return image_bytes
-        
-        # Если изображение не найдено в ответе
-        if "candidates" not in result:
-            error_msg = f"API не вернул кандидатов. Ответ: {result}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
-        
-        # Если есть текст вместо изображения
-        text_parts = []
-        for candidate in result.get("candidates", []):
-            for part in candidate.get("content", {}).get("parts", []):
-                if "text" in part:
-                    text_parts.append(part["text"])
-        
-        if text_parts:
-            error_msg = f"API вернул текст вместо изображения: {' '.join(text_parts[:200])}"
-            logger.warning(error_msg)
-            raise Exception(error_msg)
-        
-        raise Exception("API не вернул изображение в ожидаемом формате")
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка сетевого запроса: {e}")
-        raise Exception(f"Ошибка сетевого запроса к Gemini API: {e}")
-    except Exception as e:
-        logger.error(f"Ошибка генерации изображения: {e}")
-        raise Exception(f"Ошибка генерации: {e}")
-
-
-def _generate_demo_image(prompt: str) -> bytes:
-    """Генерирует демо-изображение для тестирования"""
-    img = Image.new('RGB', (1024, 1024), color=(73, 109, 137))
-    d = ImageDraw.Draw(img)
-    d.text((50, 50), "ДЕМО-РЕЖИМ. Промпт: " + prompt[:100] + "...", fill=(255, 255, 255))
-    
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    return img_byte_arr.getvalue()
-
+"""
+Интеграция с Google Gemini API
+
+Использует прямой REST API для генерации изображений через модель gemini-2.5-flash-image.
+Этот подход работает напрямую с HTTP запросами, без необходимости устанавливать 
+устаревшие версии google-generativeai.
+"""
+import asyncio
+import base64
+import json
+import time
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+from config import GEMINI_API_KEY, GEMINI_API_BASE, GEMINI_BACKEND, GEMINI_DEMO_MODE, logger
+from costs import parse_usage
+from metrics import observe_gemini_call
+
+GEMINI_MODEL = "gemini-2.5-flash-image"
+REQUEST_TIMEOUT = 60
+
+# Общая HTTP-сессия: keep-alive соединение с хостом Gemini переиспользуется
+# между запросами и прогревается при старте (см. warm_up_connection)
+_session = None
+KEEPALIVE_TIMEOUT = 120
+# Время последнего обмена с Gemini (monotonic): по нему видно, живо ли соединение
+_last_activity = 0.0
+
+
+def _get_session():
+    """Возвращает общую aiohttp-сессию, создавая ее при первом обращении"""
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp
+
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+    return _session
+
+
+async def warm_up_connection():
+    """
+    Заранее открывает TCP/TLS-соединение с хостом Gemini.
+
+    Первый запрос пользователя не платит за DNS и TLS-рукопожатие.
+    Ошибки не критичны: соединение будет открыто при первом запросе.
+    """
+    global _last_activity
+    if GEMINI_DEMO_MODE or GEMINI_BACKEND == "demo":
+        return
+    started = time.perf_counter()
+    try:
+        async with _get_session().head(GEMINI_API_BASE) as response:
+            await response.read()
+        _last_activity = time.monotonic()
+        logger.info(f"🔌 Соединение с Gemini API прогрето за {(time.perf_counter() - started) * 1000:.0f} мс")
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть соединение с Gemini API: {e}")
+
+
+async def ensure_connection():
+    """
+    Прогревает соединение, только если keep-alive соединение могло закрыться.
+
+    Дешево вызывать на каждый заказ: при недавнем обмене с Gemini ничего не делает.
+    """
+    if time.monotonic() - _last_activity < KEEPALIVE_TIMEOUT / 2:
+        return
+    await warm_up_connection()
+
+
+async def close_session():
+    """Закрывает общую HTTP-сессию"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def uses_demo_backend() -> bool:
+    """Запросы обслуживает демо-бэкенд: тело запроса не нужно"""
+    return GEMINI_DEMO_MODE or GEMINI_BACKEND == "demo"
+
+
+async def call_gemini_api(
+    input_image_path: str,
+    prompt: str,
+    extra_params: Dict[str, Any] = None,
+    body: Optional[bytes] = None
+) -> bytes:
+    """
+    Генерирует изображение выбранным бэкендом, не блокируя event loop.
+
+    Бэкенд задается GEMINI_BACKEND: "gemini" (реальный API) или "demo"
+    (фейковый бэкенд для нагрузочного тестирования, см. demo_backend).
+    В GEMINI_DEMO_MODE всегда используется демо-бэкенд.
+
+    body - заранее собранное тело запроса (build_request_body или
+    build_conversation_body); без него файл читается и кодируется здесь.
+    """
+    if uses_demo_backend():
+        from demo_backend import demo_backend
+        return await demo_backend.generate(prompt)
+
+    return await _call_gemini_rest(input_image_path, prompt, extra_params, body)
+
+
+def encode_image_part(image_bytes: bytes, mime_type: str = "image/jpeg") -> bytes:
+    """JSON-фрагмент inlineData с изображением в base64 (CPU-bound)"""
+    part = {
+        "inlineData": {
+            "mimeType": mime_type,
+            "data": base64.b64encode(image_bytes).decode('ascii')
+        }
+    }
+    return json.dumps(part).encode('utf-8')
+
+
+def file_image_part(file_uri: str, mime_type: str = "image/jpeg") -> bytes:
+    """JSON-фрагмент fileData со ссылкой на файл, загруженный через File API"""
+    return json.dumps({"fileData": {"mimeType": mime_type, "fileUri": file_uri}}).encode('utf-8')
+
+
+async def upload_file(data: bytes, mime_type: str = "image/jpeg", display_name: str = "") -> Dict[str, Any]:
+    """
+    Загружает файл через Gemini File API (resumable upload: start + upload/finalize).
+
+    Returns:
+        Описание файла: name, uri, mimeType, expirationTime
+
+    Raises:
+        Exception: При ошибках API
+    """
+    global _last_activity
+    session = _get_session()
+    start_headers = {
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(len(data)),
+        "X-Goog-Upload-Header-Content-Type": mime_type,
+        "Content-Type": "application/json",
+    }
+    endpoint = f"{GEMINI_API_BASE}/upload/v1beta/files?key={GEMINI_API_KEY}"
+    async with session.post(endpoint, headers=start_headers, json={"file": {"display_name": display_name}}) as response:
+        raw = await response.read()
+        upload_url = response.headers.get("X-Goog-Upload-URL")
+        if response.status != 200 or not upload_url:
+            raise Exception(f"File API вернул код {response.status}: {raw.decode('utf-8', errors='replace')}")
+
+    upload_headers = {
+        "Content-Length": str(len(data)),
+        "X-Goog-Upload-Offset": "0",
+        "X-Goog-Upload-Command": "upload, finalize",
+    }
+    async with session.post(upload_url, headers=upload_headers, data=data) as response:
+        raw = await response.read()
+        if response.status != 200:
+            raise Exception(f"File API вернул код {response.status}: {raw.decode('utf-8', errors='replace')}")
+    _last_activity = time.monotonic()
+    return json.loads(raw)["file"]
+
+
+def text_part(text: str) -> bytes:
+    """JSON-фрагмент с текстом"""
+    return json.dumps({"text": text}).encode('utf-8')
+
+
+def build_conversation_body(turns: Sequence[Tuple[str, List[bytes]]]) -> bytes:
+    """
+    Собирает тело многоходового запроса из готовых JSON-фрагментов.
+
+    Args:
+        turns: (роль "user"/"model", фрагменты частей) по порядку
+
+    Фрагменты вставляются как есть: мегабайты base64 не сериализуются повторно.
+    """
+    contents = b", ".join(
+        b'{"role": "' + role.encode('ascii') + b'", "parts": [' + b", ".join(parts) + b']}'
+        for role, parts in turns
+    )
+    return b'{"contents": [' + contents + b']}'
+
+
+def build_request_body(prompt: str, image_part: bytes) -> bytes:
+    """Тело одноходового запроса: промпт и изображение"""
+    return build_conversation_body([("user", [text_part(prompt), image_part])])
+
+
+def _build_request_body(input_image_path: str, prompt: str) -> bytes:
+    """Читает изображение и собирает JSON-тело запроса (CPU-bound)"""
+    with open(input_image_path, 'rb') as img_file:
+        image_part = encode_image_part(img_file.read())
+
+    # Формирование payload с промптом и изображением
+    return build_request_body(prompt, image_part)
+
+
+def _parse_response(raw: bytes) -> Tuple[Optional[bytes], Dict[str, Any]]:
+    """Разбирает ответ и декодирует изображение, если оно есть (CPU-bound)"""
+    result = json.loads(raw)
+
+    # Извлечение изображения из ответа
+    for candidate in result.get("candidates", []):
+        for part in candidate.get("content", {}).get("parts", []):
+            # Проверяем оба варианта ключа (camelCase и snake_case)
+            inline = part.get("inlineData") or part.get("inline_data")
+
+            if inline and "data" in inline:
+                # Декодирование base64 изображения
+                return base64.b64decode(inline["data"]), result
+    return None, result
+
+
+async def _call_gemini_rest(
+    input_image_path: str,
+    prompt: str,
+    extra_params: Dict[str, Any] = None,
+    body: Optional[bytes] = None
+) -> bytes:
+    """
+    Отправляет изображение и промпт в Gemini 2.5 Flash Image API и возвращает байты изображения.
+    
+    Args:
+        input_image_path: Путь к входному изображению (одежда)
+        prompt: Текстовый промпт для генерации (описание модели и сцены)
+        extra_params: Дополнительные параметры API
+        body: Готовое тело запроса (если собрано заранее)
+        
+    Returns:
+        bytes: Байты сгенерированного изображения
+        
+    Raises:
+        Exception: При ошибках API или отсутствии результата
+    """
+    import aiohttp
+
+    global _last_activity
+    started = time.perf_counter()
+
+    # Конфигурация endpoint
+    endpoint = f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
+    headers = {"Content-Type": "application/json"}
+    request_bytes = 0
+    
+    try:
+        if body is None:
+            # Загрузка и кодирование входного изображения вне event loop
+            body = await asyncio.to_thread(_build_request_body, input_image_path, prompt)
+        request_bytes = len(body)
+        
+        logger.info("Отправка запроса к Gemini 2.5 Flash Image API...")
+        
+        # Отправка запроса
+        async with _get_session().post(endpoint, headers=headers, data=body) as response:
+            raw = await response.read()
+            status = response.status
+        _last_activity = time.monotonic()
+        
+        if status != 200:
+            observe_gemini_call(started, f"http_{status}", request_bytes, len(raw))
+            error_msg = f"API вернул код {status}: {raw.decode('utf-8', errors='replace')}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        
+        image_bytes, result = await asyncio.to_thread(_parse_response, raw)
+        # Токены оплачиваются и тогда, когда вместо изображения пришел текст
+        usage = parse_usage(result)
+        
+        if image_bytes is not None:
+            logger.info(f"✅ Успешно получено изображение ({len(image_bytes)} байт)")
+            observe_gemini_call(started, "ok", request_bytes, len(raw), usage)
+            return image_bytes
+        
+        # Если изображение не найдено в ответе
+        if "candidates" not in result:
+            observe_gemini_call(started, "no_candidates", request_bytes, len(raw), usage)
+            error_msg = f"API не вернул кандидатов. Ответ: {result}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        
+        # Если есть текст вместо изображения
+        text_parts = []
+        for candidate in result.get("candidates", []):
+            for part in candidate.get("content", {}).get("parts", []):
+                if "text" in part:
+                    text_parts.append(part["text"])
+        
+        if text_parts:
+            observe_gemini_call(started, "text_instead_of_image", request_bytes, len(raw), usage)
+            error_msg = f"API вернул текст вместо изображения: {' '.join(text_parts[:200])}"
+            logger.warning(error_msg)
+            raise Exception(error_msg)
+        
+        observe_gemini_call(started, "no_image", request_bytes, len(raw), usage)
+        raise Exception("API не вернул изображение в ожидаемом формате")
+        
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        observe_gemini_call(started, "network_error", request_bytes)
+        logger.error(f"Ошибка сетевого запроса: {e!r}")
+        raise Exception(f"Ошибка сетевого запроса к Gemini API: {e!r}")
+    except Exception as e:
+        logger.error(f"Ошибка генерации изображения: {e}")
+        raise Exception(f"Ошибка генерации: {e}")
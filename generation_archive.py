@@ -0,0 +1,64 @@
+"""
+Архив старых записей о генерациях
+
+Таблица generations нужна горячей только за последние дни: по ней
+считается число генераций пользователя и общая статистика. Записи
+старше GENERATION_ARCHIVE_AFTER_DAYS переносятся в таблицу
+generation_archive сегментами до GENERATION_ARCHIVE_SEGMENT_ROWS строк,
+сжатыми zlib. Строки почти одинаковы (шаблон и параметры), поэтому
+сегмент занимает в десятки раз меньше места, чем строки в таблице.
+
+Архив остается доступен для запросов: generation_archive_users хранит,
+сколько строк каждого пользователя в каком сегменте, - по ней считаются
+итоги без распаковки, а история пользователя распаковывает только
+сегменты с его строками (Database.get_user_generations).
+"""
+import asyncio
+import json
+import zlib
+from typing import List, Sequence
+
+from config import (
+    GENERATION_ARCHIVE_AFTER_DAYS,
+    GENERATION_ARCHIVE_INTERVAL,
+    GENERATION_ARCHIVE_SEGMENT_ROWS,
+    logger
+)
+from metrics import REGISTRY
+
+ARCHIVED_GENERATIONS = REGISTRY.counter(
+    "generations_archived_total",
+    "Записи о генерациях, перенесенные в сжатый архив"
+)
+
+# Колонки строки сегмента, в порядке хранения
+SEGMENT_COLUMNS = ("id", "user_id", "template_id", "params", "additions", "job_id", "created_at")
+
+
+def pack_segment(rows: Sequence[Sequence]) -> bytes:
+    """Сжимает строки generations (в порядке SEGMENT_COLUMNS)"""
+    return zlib.compress(json.dumps(list(rows), ensure_ascii=False, separators=(",", ":")).encode(), 9)
+
+
+def unpack_segment(data: bytes) -> List[list]:
+    return json.loads(zlib.decompress(data))
+
+
+async def run_generation_archiver(db, interval: float = GENERATION_ARCHIVE_INTERVAL):
+    """Фоновая задача: периодически переносит старые генерации в архив"""
+    if GENERATION_ARCHIVE_AFTER_DAYS <= 0:
+        return
+    while True:
+        try:
+            # Полный сегмент - возможно, старых записей больше: продолжаем сразу
+            archived = GENERATION_ARCHIVE_SEGMENT_ROWS
+            while archived >= GENERATION_ARCHIVE_SEGMENT_ROWS:
+                archived = await asyncio.to_thread(
+                    db.archive_generations, GENERATION_ARCHIVE_AFTER_DAYS, GENERATION_ARCHIVE_SEGMENT_ROWS
+                )
+                if archived:
+                    ARCHIVED_GENERATIONS.inc(amount=archived)
+                    logger.info(f"🗄 В архив перенесено генераций: {archived}")
+        except Exception as e:
+            logger.error(f"Ошибка архивации генераций: {e}")
+        await asyncio.sleep(interval)
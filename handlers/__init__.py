@@ -1,4 +1,4 @@
-"""
-Модуль обработчиков для бота
-"""
-
+"""
+Модуль обработчиков для бота
+"""
+
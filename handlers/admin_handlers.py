@@ -1,72 +1,360 @@
-"""
-Обработчики команд администратора
-"""
-from aiogram import Router, F
-from aiogram.types import Message
-from aiogram.filters import Command
-
-from config import ADMIN_ID, logger
-from database import Database
-
-router = Router()
-db = Database()
-
-
-@router.message(Command("add_balance"))
-async def add_balance_handler(message: Message):
-    """Обработчик команды /add_balance (Только для ADMIN_ID)"""
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("❌ Эта команда доступна только администратору.")
-        return
-
-    try:
-        parts = message.text.split()
-        if len(parts) != 3:
-            await message.answer(
-                "⚠️ Использование: `/add_balance [user_id] [количество_генераций]`",
-                parse_mode="Markdown"
-            )
-            return
-
-        target_user_id = int(parts[1])
-        amount = int(parts[2])
-
-        if amount <= 0:
-            await message.answer("❌ Количество генераций должно быть положительным числом.")
-            return
-
-        current_balance = db.get_user_balance(target_user_id)
-        new_balance = current_balance + amount
-        db.update_user_balance(target_user_id, new_balance)
-
-        await message.answer(
-            f"✅ Баланс пользователя `{target_user_id}` обновлен.\n"
-            f"Добавлено: {amount} генераций.\n"
-            f"Новый баланс: {new_balance} генераций.",
-            parse_mode="Markdown"
-        )
-
-    except ValueError:
-        await message.answer("❌ Неверный формат ID или количества. Используйте целые числа.")
-    except Exception as e:
-        logger.error(f"Ошибка в add_balance_handler: {e}")
-        await message.answer(f"❌ Произошла ошибка при обновлении баланса: {e}")
-
-
-@router.message(Command("stats"))
-async def stats_handler(message: Message):
-    """Обработчик команды /stats (Только для ADMIN_ID)"""
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("❌ Эта команда доступна только администратору.")
-        return
-
-    total_users, total_generations, total_balance = db.get_all_users_stats()
-
-    stats_text = (
-        "📊 **Статистика Бота**\n\n"
-        f"👤 Всего пользователей: {total_users}\n"
-        f"🎨 Всего генераций: {total_generations}\n"
-        f"💰 Общий остаток баланса: {total_balance} генераций"
-    )
-    await message.answer(stats_text, parse_mode="Markdown")
-
+"""
+Обработчики команд администратора
+"""
+import time
+from typing import Dict
+
+from aiogram import Bot, Router, F
+from aiogram.types import Message, BufferedInputFile, FSInputFile
+from aiogram.filters import Command
+
+import analytics
+import costs
+from analytics import StatsReport
+from bulk_credit import MAX_BYTES, parse_batch, report_csv
+from config import ADMIN_ID, logger
+from database import Database
+from export import TELEGRAM_DOCUMENT_LIMIT, export_tables, parse_export_args, remove_files
+from models import GenderType
+from profiler import profiler
+
+router = Router()
+
+
+@router.message(Command("add_balance"))
+async def add_balance_handler(message: Message, db: Database):
+    """Обработчик команды /add_balance (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    try:
+        parts = message.text.split()
+        if len(parts) != 3:
+            await message.answer(
+                "⚠️ Использование: `/add_balance [user_id] [количество_генераций]`",
+                parse_mode="Markdown"
+            )
+            return
+
+        target_user_id = int(parts[1])
+        amount = int(parts[2])
+
+        if amount <= 0:
+            await message.answer("❌ Количество генераций должно быть положительным числом.")
+            return
+
+        new_balance = db.credit_balance(target_user_id, amount)
+
+        await message.answer(
+            f"✅ Баланс пользователя `{target_user_id}` обновлен.\n"
+            f"Добавлено: {amount} генераций.\n"
+            f"Новый баланс: {new_balance} генераций.",
+            parse_mode="Markdown"
+        )
+
+    except ValueError:
+        await message.answer("❌ Неверный формат ID или количества. Используйте целые числа.")
+    except Exception as e:
+        logger.error(f"Ошибка в add_balance_handler: {e}")
+        await message.answer(f"❌ Произошла ошибка при обновлении баланса: {e}")
+
+
+REFUND_REASONS = {
+    analytics.REFUND_ERROR: "ошибки",
+    analytics.REFUND_CANCELLED: "отмены",
+    analytics.REFUND_RESTART: "перезапуск",
+}
+
+
+def _refund_reasons(refunds: Dict[str, int]) -> Dict[str, int]:
+    """Возвраты по подписям причин; незнакомые причины сводятся в «другое»"""
+    labeled: Dict[str, int] = {}
+    for reason, value in refunds.items():
+        label = REFUND_REASONS.get(reason, "другое")
+        labeled[label] = labeled.get(label, 0) + value
+    return labeled
+
+
+def _category_label(name: str) -> str:
+    return GenderType[name].value if name in GenderType.__members__ else "без категории"
+
+
+def _breakdown(values: Dict[str, int], label) -> str:
+    """«(женская: 5, мужская: 3)» по убыванию значения"""
+    parts = [f"{label(key)}: {value}" for key, value in sorted(values.items(), key=lambda item: -item[1]) if value]
+    return f" ({', '.join(parts)})" if parts else ""
+
+
+def _period_label(period: str) -> str:
+    """«today» -> «сегодня», «7d» -> «7 дн.», «24h» -> «24 ч»"""
+    if period == "today":
+        return "сегодня"
+    return f"{period[:-1]} {'ч' if period.endswith('h') else 'дн.'}"
+
+
+def format_stats(report: StatsReport) -> str:
+    """Текст ответа /stats"""
+    generations = report.by_dim.get(analytics.GENERATIONS, {})
+    edits = report.by_dim.get(analytics.EDITS, {})
+    refunds = report.by_dim.get(analytics.REFUNDS, {})
+    trials = report.total(analytics.FREE_TRIALS)
+    conversions = report.total(analytics.TRIAL_CONVERSIONS)
+
+    if report.period == "all":
+        lines = [
+            "📊 **Статистика Бота**\n",
+            f"👤 Всего пользователей: {report.total(analytics.NEW_USERS)}",
+        ]
+    else:
+        lines = [
+            f"📊 **Статистика за {_period_label(report.period)}**\n",
+            f"👤 Новых пользователей: {report.total(analytics.NEW_USERS)}",
+        ]
+    lines += [
+        f"🎨 Генераций: {sum(generations.values())}{_breakdown(generations, _category_label)}",
+        f"✏️ Правок: {sum(edits.values())}{_breakdown(edits, _category_label)}",
+        f"✅ Доставлено: {report.total(analytics.DELIVERIES)}",
+        f"❌ Сбоев генерации: {report.total(analytics.FAILURES)}",
+        f"↩️ Возвратов: {sum(refunds.values())}{_breakdown(_refund_reasons(refunds), str)}",
+        f"🎁 Бесплатных генераций: {trials}",
+        f"💳 Пополнили после бесплатной: {conversions}"
+        + (f" ({conversions / trials:.0%})" if trials else ""),
+        f"💰 Начислено генераций: {report.total(analytics.CREDITS)}",
+    ]
+    if report.period == "all":
+        lines.append(f"💰 Общий остаток баланса: {report.total(analytics.BALANCE)} генераций")
+    elif len(report.by_bucket) > 1:
+        lines.append("")
+        for bucket in sorted(report.by_bucket):
+            metrics = report.by_bucket[bucket]
+            lines.append(
+                f"{bucket}: 🎨 {metrics.get(analytics.GENERATIONS, 0)} ✏️ {metrics.get(analytics.EDITS, 0)} "
+                f"❌ {metrics.get(analytics.FAILURES, 0)} ↩️ {metrics.get(analytics.REFUNDS, 0)}"
+            )
+    return "\n".join(lines)
+
+
+def _outcome_label(outcome: str) -> str:
+    """Исход запроса (http_429) с экранированием «_» для Markdown"""
+    return outcome.replace("_", "\\_")
+
+
+def _usd(micros: float) -> str:
+    return f"${micros / 1_000_000:.4f}"
+
+
+def format_costs(report: costs.CostReport) -> str:
+    """Текст ответа /costs"""
+    stats = report.stats
+    calls = stats.by_dim.get(costs.CALLS, {})
+    cost_by_category = stats.by_dim.get(costs.COST, {})
+    total_cost = sum(cost_by_category.values())
+    deliveries = stats.total(analytics.DELIVERIES)
+    title = "за все время" if stats.period == "all" else f"за {_period_label(stats.period)}"
+
+    lines = [
+        f"💸 **Расходы на Gemini {title}**\n",
+        f"📨 Запросов: {sum(calls.values())}{_breakdown(calls, _outcome_label)}",
+        f"💵 Стоимость: {_usd(total_cost)}"
+        + (f" ({_usd(total_cost / deliveries)} за доставленное фото)" if deliveries else ""),
+    ]
+    parts = [
+        f"{_category_label(name)}: {_usd(value)}"
+        for name, value in sorted(cost_by_category.items(), key=lambda item: -item[1]) if value
+    ]
+    if parts:
+        lines.append(f"🗂 По категориям: {', '.join(parts)}")
+    lines.append(
+        f"🔤 Токенов: вход {stats.total(costs.INPUT_TOKENS)}, выход {stats.total(costs.OUTPUT_TOKENS)}"
+    )
+    for kind, averages in sorted(report.by_kind.items()):
+        lines.append(
+            f"📐 Средний запрос {kind}: вход {averages.input_tokens:.0f} ток. "
+            f"(фото {averages.image_tokens:.0f}), выход {averages.output_tokens:.0f} ток., "
+            f"{averages.request_bytes / 1024:.0f} КБ, {averages.latency_ms / 1000:.1f} с"
+        )
+    if report.top_users:
+        lines.append("\n👤 Дороже всего:")
+        lines += [
+            f"`{user_id}`: {_usd(cost)} ({count} запр.)" for user_id, count, cost in report.top_users
+        ]
+    if stats.period != "all" and len(stats.by_bucket) > 1:
+        lines.append("")
+        for bucket in sorted(stats.by_bucket):
+            metrics = stats.by_bucket[bucket]
+            lines.append(f"{bucket}: {_usd(metrics.get(costs.COST, 0))} ({metrics.get(costs.CALLS, 0)} запр.)")
+    return "\n".join(lines)
+
+
+BULK_CREDIT_USAGE = (
+    "Использование: /bulk_credit [batch_id], а на следующих строках - «user_id количество», "
+    "или CSV-файл с этой командой в подписи."
+)
+# Сколько ошибок показывать в ответе
+BULK_CREDIT_SHOWN_ERRORS = 20
+
+
+@router.message(Command("bulk_credit"))
+async def bulk_credit_handler(message: Message, db: Database, bot: Bot):
+    """Обработчик команды /bulk_credit (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    command_line, _, body = (message.text or message.caption or "").partition("\n")
+    args = command_line.split()[1:]
+    if len(args) > 1:
+        await message.answer(f"⚠️ {BULK_CREDIT_USAGE}")
+        return
+
+    if message.document:
+        if (message.document.file_size or 0) > MAX_BYTES:
+            await message.answer(f"❌ Файл больше {MAX_BYTES // 1024} КБ.")
+            return
+        try:
+            body = (await bot.download(message.document)).getvalue().decode("utf-8-sig")
+        except UnicodeDecodeError:
+            await message.answer("❌ Файл должен быть в кодировке UTF-8.")
+            return
+
+    try:
+        batch = parse_batch(body, args[0] if args else None)
+    except ValueError as e:
+        await message.answer(f"⚠️ {e}\n{BULK_CREDIT_USAGE}")
+        return
+
+    if batch.errors:
+        shown = batch.errors[:BULK_CREDIT_SHOWN_ERRORS]
+        more = len(batch.errors) - len(shown)
+        await message.answer(
+            f"❌ Пачка не применена, ошибок: {len(batch.errors)}\n\n" + "\n".join(shown)
+            + (f"\n...и еще {more}" if more else "")
+        )
+        return
+
+    try:
+        result = db.bulk_credit(batch.batch_id, batch.rows, message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка в bulk_credit_handler: {e}")
+        await message.answer(f"❌ Пачка не применена из-за ошибки: {e}")
+        return
+
+    if not result.applied:
+        await message.answer(
+            f"⚠️ Пачка {result.batch_id} уже применена {result.created_at} "
+            f"({result.rows} пользователей, {result.total} генераций). Повторно не начислено."
+        )
+        return
+
+    logger.info(f"Пачка пополнений {result.batch_id}: {result.rows} пользователей, {result.total} генераций")
+    await message.answer_document(
+        BufferedInputFile(report_csv(batch.rows, result), filename=f"bulk_credit-{result.batch_id}.csv"),
+        caption=(
+            f"✅ Пачка {result.batch_id} применена.\n"
+            f"Пользователей: {result.rows}, начислено: {result.total} генераций."
+        )
+    )
+
+
+@router.message(Command("stats"))
+async def stats_handler(message: Message, db: Database):
+    """Обработчик команды /stats [all|today|<N>h|<N>d] (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    parts = message.text.split()
+    try:
+        report = db.get_stats(parts[1] if len(parts) > 1 else None)
+    except ValueError as e:
+        await message.answer(
+            f"⚠️ {e}\nИспользование: `/stats [all|today|24h|7d|30d]`",
+            parse_mode="Markdown"
+        )
+        return
+
+    await message.answer(format_stats(report), parse_mode="Markdown")
+
+
+@router.message(Command("costs"))
+async def costs_handler(message: Message, db: Database):
+    """Обработчик команды /costs [all|today|<N>h|<N>d] (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    parts = message.text.split()
+    try:
+        report = db.get_costs(parts[1] if len(parts) > 1 else None)
+    except ValueError as e:
+        await message.answer(
+            f"⚠️ {e}\nИспользование: `/costs [all|today|24h|7d|30d]`",
+            parse_mode="Markdown"
+        )
+        return
+
+    await message.answer(format_costs(report), parse_mode="Markdown")
+
+
+@router.message(Command("export"))
+async def export_handler(message: Message, db: Database):
+    """Обработчик команды /export [users|ledger|generations|calls|all] [csv|ndjson] (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    try:
+        tables, fmt = parse_export_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(
+            f"⚠️ {e}\nИспользование: `/export [users|ledger|generations|calls|all] [csv|ndjson]`",
+            parse_mode="Markdown"
+        )
+        return
+
+    await message.answer("⏳ Готовлю выгрузку...")
+    try:
+        files = await export_tables(db, tables, fmt, time.strftime("%Y%m%d-%H%M%S"))
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки: {e}")
+        await message.answer(f"❌ Ошибка при выгрузке: {e}")
+        return
+
+    try:
+        for export_file in files:
+            caption = f"📦 {export_file.table}: {export_file.rows} строк"
+            if export_file.size > TELEGRAM_DOCUMENT_LIMIT:
+                await message.answer(f"{caption} - файл больше лимита Telegram ({export_file.size} байт)")
+                continue
+            await message.answer_document(
+                FSInputFile(export_file.path, filename=export_file.filename),
+                caption=caption
+            )
+    finally:
+        remove_files(files)
+
+
+@router.message(Command("profile"))
+async def profile_handler(message: Message):
+    """Обработчик команды /profile [reset] (Только для ADMIN_ID)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+
+    if not profiler:
+        await message.answer("⚠️ Профилировщик выключен. Запустите бота с PROFILER_ENABLED=1.")
+        return
+
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == "reset":
+        profiler.reset()
+        await message.answer("🔬 Данные профилировщика сброшены.")
+        return
+
+    collapsed = BufferedInputFile(profiler.collapsed().encode("utf-8"), filename="profile.folded")
+    await message.answer_document(
+        collapsed,
+        caption=profiler.summary()[:1024],
+        parse_mode=None
+    )
@@ -1,755 +1,1004 @@
-"""
-Обработчики создания фотографий
-"""
-import os
-import asyncio
-import tempfile
-from typing import Dict, Any
-from io import BytesIO
-
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
-from aiogram.filters import StateFilter
-from aiogram.fsm.context import FSMContext
-from aiogram.utils.media_group import MediaGroupBuilder
-from PIL import Image
-
-from config import SUPPORT_USERNAME, GEMINI_DEMO_MODE, logger
-from database import Database
-from models import (
-    GenderType,
-    LocationType,
-    SizeType,
-    LocationStyle,
-    PoseType,
-    ViewType,
-    ProductCreationStates
-)
-from keyboards import (
-    get_location_keyboard,
-    get_age_keyboard,
-    get_size_keyboard,
-    get_location_style_keyboard,
-    get_pose_keyboard,
-    get_view_keyboard,
-    get_confirmation_keyboard,
-    get_back_keyboard,
-    get_white_bg_view_keyboard,
-    get_after_generation_keyboard,
-    get_regenerate_keyboard,
-    get_length_keyboard
-)
-from gemini_api import call_gemini_api
-from utils import show_progress_bar
-
-router = Router()
-db = Database()
-
-
-async def generate_prompt(data: Dict[str, Any]) -> str:
-    """
-    Генерирует подробный промпт для Gemini API на основе выбранных параметров.
-    """
-    gender = data.get('gender', GenderType.FLAT_LAY)
-    
-    # Добавляем описание телосложения в зависимости от размера
-    size = data.get('size')
-    body_type_description = ""
-    if size:
-        size_value = size.value if hasattr(size, 'value') else str(size)
-        if "42-46" in size_value:
-            body_type_description = "Стройная фигура, худощавое телосложение."
-        elif "50-54" in size_value:
-            body_type_description = "Полная, но не сильно полная фигура, среднее телосложение, не худое и не очень толстое."
-        elif "58-64" in size_value:
-            body_type_description = "Полная фигура, крупное телосложение, крупные ноги и руки."
-        elif "64-68" in size_value:
-            body_type_description = "Очень полная фигура, гигантские размеры, очень толстое телосложение."
-
-    # НОВЫЙ БЛОК ДЛЯ ФОТО + ПРОМТ
-    if gender == GenderType.FLAT_LAY:
-        flat_lay_prompt = (
-            "Create a professional flat lay product photo with the following background setup: "
-            "A luxurious, bright white faux fur rug with a deep, shaggy texture as the main surface. "
-            "The background is a dark grey, slightly textured floor occupying the bottom third of the frame. "
-            "Include these decorative elements: "
-            "a cluster of realistic white and cream roses bordering the top edge, "
-            "a single vibrant orange and yellow maple leaf on the right side, "
-            "a smaller green maple leaf on the left side, "
-            "and a tiny potted green succulent plant in the top left corner. "
-            "Soft, diffused natural lighting that creates gentle shadows and emphasizes textures. "
-            "Perfectly centered composition with everything in sharp focus. "
-            "Seamlessly integrate the clothing item from the input photo onto this background, "
-            "making it look naturally placed on the white fur rug. "
-            "The clothing should be perfectly arranged, clean, and professionally presented. "
-            "Remove any wrinkles, creases, or folds from the original clothing photo. "
-            "Image aspect ratio: 4:3. "
-            "Ensure the final result looks like high-end e-commerce product photography."
-        )
-        return flat_lay_prompt
-    
-    if gender == GenderType.WHITE_BG:
-        view = data.get('white_bg_view', 'front')
-        view_text = "back view" if view == "back" else "front view"
-        
-        white_bg_prompt = (
-            f"Create a professional, high-quality product photograph on a pure white background. "
-            f"Show the clothing item from {view_text} as a 3D product visualization. "
-            f"The clothing must be perfectly ironed, without any wrinkles or creases. "
-            f"The product should look like a 3D rendered object - clean, crisp, and professional. "
-            f"The product should be the main focus, well-lit with soft shadows, "
-            f"presented in a clean, commercial style suitable for an online store. "
-            f"The background must be completely white (#FFFFFF). "
-            f"Ensure the product looks professional and appealing, as if it's a 3D product visualization. "
-            f"Image aspect ratio: 4:3. "
-            f"If the clothing in the original photo is wrinkled or has folds, they must be completely removed in the final image. "
-            f"Avoid excessive retouching, maintain natural fabric texture. "
-            f"European appearance for any human elements."
-        )
-        return white_bg_prompt
-
-    gender_text = gender.value
-    height = data.get('height', '170')
-    length = data.get('length', '70') 
-    location = data.get('location', LocationType.STUDIO).value
-    age = data.get('age', '25-35')
-    size = data.get('size', SizeType.SIZE_42_46).value if gender != GenderType.KIDS else ""
-    location_style = data.get('location_style', LocationStyle.REGULAR).value
-    pose = data.get('pose', PoseType.STANDING).value
-    view = data.get('view', ViewType.FRONT).value
-
-    model_details = f"a professional, natural-looking model with European appearance, {gender_text} clothing, height {height} cm, age range {age}"
-    if size:
-        model_details += f", wearing size {size}"
-    if body_type_description:
-        model_details += f", {body_type_description}"
-
-    scene_details = f"in a {location} setting, with a {location_style} atmosphere. Pose: {pose}, View: {view}."
-
-    prompt = (
-        f"Generate a hyper-realistic, high-definition (4k), professional fashion photograph with 4:3 aspect ratio. "
-        f"The image must feature **{model_details}**. "
-        f"The clothing on the model must be perfectly ironed, smooth, without any wrinkles, creases or folds. "
-        f"If the clothing in the original photo is wrinkled or has folds, they must be completely removed in the final image. "
-        f"The model should be perfectly integrated with the clothing from the input image. "
-        f"Scene: **{scene_details}**. "
-        f"The model should be well-lit, and the final image should look like it was taken by a top fashion photographer. "
-        f"Focus on natural-looking hands and realistic facial features (if visible). "
-        f"Avoid excessive retouching - keep natural skin texture and appearance. "
-        f"European facial features and appearance. "
-        f"Image aspect ratio: 4:3. "
-        f"Exclude any watermarks or text overlays."
-    )
-
-    return prompt
-
-
-async def generate_summary(data: Dict[str, Any]) -> str:
-    """
-    Генерирует текстовую сводку выбранных параметров для подтверждения.
-    """
-    summary_parts = []
-
-    gender = data.get('gender', GenderType.FLAT_LAY)
-    summary_parts.append(f"📦 **Категория**: {gender.value.capitalize()}")
-
-    if gender == GenderType.WHITE_BG:
-        view = data.get('white_bg_view', 'front')
-        view_text = "Сзади" if view == "back" else "Спереди"
-        summary_parts.append(f"👀 **Ракурс**: {view_text}")
-    elif gender != GenderType.FLAT_LAY:
-        summary_parts.append(f"📏 **Рост модели**: {data.get('height', 'Не указан')} см")
-        summary_parts.append(f"📐 **Длина изделия**: {data.get('length', 'Не указана')} см")
-        summary_parts.append(f"📍 **Локация**: {data.get('location', LocationType.STUDIO).value}")
-        summary_parts.append(f"🎂 **Возраст модели**: {data.get('age', 'Не указан')}")
-
-        if gender != GenderType.KIDS:
-            summary_parts.append(f"📐 **Размер**: {data.get('size', SizeType.SIZE_42_46).value}")
-
-        summary_parts.append(f"🎨 **Стиль локации**: {data.get('location_style', LocationStyle.REGULAR).value}")
-        summary_parts.append(f"🧘 **Положение тела**: {data.get('pose', PoseType.STANDING).value}")
-        summary_parts.append(f"👀 **Вид**: {data.get('view', ViewType.FRONT).value}")
-
-    return "\n".join(summary_parts)
-
-
-@router.callback_query(F.data.startswith("gender_"))
-async def gender_select_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора пола/категории"""
-    # Проверяем, есть ли у пользователя бесплатная генерация
-    user_id = callback.from_user.id
-    user_generations = db.get_user_generations_count(user_id)
-    
-    # Если это первая генерация пользователя, даем бесплатную
-    if user_generations == 0:
-        current_balance = db.get_user_balance(user_id)
-        if current_balance == 0:  # Даем бесплатную генерацию только если баланс 0
-            db.update_user_balance(user_id, 1)
-            await callback.message.answer(
-                "🎉 **Вам предоставлена 1 бесплатная генерация!**\n\n"
-                "Вы можете создать свое первое фото бесплатно. "
-                "Для последующих генераций потребуется пополнение баланса."
-            )
-
-    gender_map = {
-        "gender_women": GenderType.WOMEN,
-        "gender_men": GenderType.MEN,
-        "gender_kids": GenderType.KIDS,
-        "gender_display": GenderType.FLAT_LAY,
-        "gender_white_bg": GenderType.WHITE_BG
-    }
-
-    gender = gender_map[callback.data]
-    await state.update_data(gender=gender)
-
-    # Попытка загрузить примеры фото (опционально)
-    if gender not in [GenderType.FLAT_LAY, GenderType.WHITE_BG]:
-        import os
-        if os.path.exists("photo/example1.jpg") and os.path.exists("photo/example2.jpg"):
-            try:
-                media_group = MediaGroupBuilder()
-                photo1 = FSInputFile("photo/example1.jpg")
-                photo2 = FSInputFile("photo/example2.jpg")
-                media_group.add_photo(media=photo1)
-                media_group.add_photo(media=photo2)
-                await callback.message.answer_media_group(media=media_group.build())
-            except Exception as e:
-                logger.warning(f"Не удалось загрузить примеры фото: {e}")
-        else:
-            logger.info("Примеры фото не найдены, пропускаем")
-
-    if gender == GenderType.FLAT_LAY:
-        instruction_text = (
-            "📸 Пожалуйста пришлите фотографию вашего товара для создания витринного фото.\n\n"
-            "⚠️ Обратите внимание: фотография вашего товара должна быть четко видна "
-            "без лишних бликов и размытостей.\n\n"
-            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
-        )
-    elif gender == GenderType.WHITE_BG:
-        instruction_text = (
-            "📸 Пожалуйста пришлите фотографию вашего товара для фото на белом фоне.\n\n"
-            "⚠️ Обратите внимание: фотография должна быть четкой "
-            "без лишних бликов и размытостей.\n\n"
-            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
-        )
-    else:
-        instruction_text = (
-            "📸 Пожалуйста пришлите фотографию вашего товара.\n\n"
-            "⚠️ Обратите внимание: фотография вашего товара должна быть четко видна "
-            "без лишних бликов и размытостей.\n\n"
-            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
-        )
-
-    await callback.message.answer(instruction_text)
-    await state.set_state(ProductCreationStates.waiting_for_photo)
-    await callback.answer()
-
-
-@router.message(StateFilter(ProductCreationStates.waiting_for_photo))
-async def photo_handler(message: Message, state: FSMContext, bot):
-    """Обработчик загрузки фото"""
-    if not message.photo:
-        await message.answer("📸 Пожалуйста, отправьте фотографию товара.")
-        return
-
-    photo_file_id = message.photo[-1].file_id
-    await state.update_data(photo_file_id=photo_file_id)
-
-    temp_path = None
-    try:
-        file = await bot.get_file(photo_file_id)
-        file_path = file.file_path
-
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
-        temp_path = temp_file.name
-        temp_file.close()
-
-        await bot.download_file(file_path, temp_path)
-        await state.update_data(temp_photo_path=temp_path)
-
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении фото: {e}")
-        await message.answer("❌ Ошибка при обработке фото. Попробуйте еще раз.")
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
-        return
-
-    data = await state.get_data()
-    gender = data['gender']
-
-    if gender == GenderType.FLAT_LAY:
-        prompt = await generate_prompt(data)
-        await state.update_data(prompt=prompt)
-
-        user_id = message.from_user.id
-        db.add_generation(user_id, prompt)
-
-        summary = await generate_summary(data)
-        summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
-
-        await message.answer(summary_text, reply_markup=get_confirmation_keyboard())
-        await state.set_state(ProductCreationStates.waiting_for_confirmation)
-    elif gender == GenderType.WHITE_BG:
-        # Для белого фона - сразу выбор ракурса
-        await state.set_state(ProductCreationStates.waiting_for_white_bg_view)
-        await message.answer(
-            "👀 Выберите ракурс для фото на белом фоне:",
-            reply_markup=get_white_bg_view_keyboard()
-        )
-    else:
-        await state.set_state(ProductCreationStates.waiting_for_height)
-        await message.answer("📏 Напишите рост модели (в см):")
-
-
-@router.message(StateFilter(ProductCreationStates.waiting_for_height))
-async def height_handler(message: Message, state: FSMContext):
-    """Обработчик ввода роста"""
-    height = message.text
-    if not height.isdigit():
-        await message.answer("❌ Пожалуйста, введите числовое значение роста в см:")
-        return
-
-    await state.update_data(height=height)
-    await state.set_state(ProductCreationStates.waiting_for_length)
-    
-    await message.answer(
-        "📏 Теперь введите длину изделия в см (или пропустите):",
-        reply_markup=get_length_keyboard()
-    )
-
-
-@router.message(StateFilter(ProductCreationStates.waiting_for_length))
-async def length_handler(message: Message, state: FSMContext):
-    """Обработчик ввода длины изделия"""
-    length = message.text
-    if not length.isdigit():
-        await message.answer("❌ Пожалуйста, введите числовое значение длины в см:")
-        return
-
-    await state.update_data(length=length)
-    await state.set_state(ProductCreationStates.waiting_for_location)
-
-    await message.answer("📍 Пожалуйста выберите локацию:", reply_markup=get_location_keyboard())
-
-@router.callback_query(F.data == "length_skip")
-async def length_skip_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик пропуска ввода длины"""
-    await state.update_data(length="70")  # Значение по умолчанию
-    await state.set_state(ProductCreationStates.waiting_for_location)
-
-    await callback.message.answer("📍 Пожалуйста выберите локацию:", reply_markup=get_location_keyboard())
-    await callback.answer()
-
-@router.callback_query(F.data.startswith("location_"))
-async def location_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора локации"""
-    location_map = {
-        "location_street": LocationType.STREET,
-        "location_studio": LocationType.STUDIO, 
-        "location_floor": LocationType.FLOOR_ZONE
-    }
-
-    location = location_map[callback.data]
-    await state.update_data(location=location)
-
-    data = await state.get_data()
-    gender = data['gender']
-
-    await callback.message.answer(
-        "🎂 Пожалуйста выберите возраст модели:",
-        reply_markup=get_age_keyboard(gender)
-    )
-    await state.set_state(ProductCreationStates.waiting_for_age)
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("age_"))
-async def age_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора возраста"""
-    age = callback.data.replace("age_", "")
-    await state.update_data(age=age)
-
-    data = await state.get_data()
-    gender = data['gender']
-    location = data.get('location')  # Получаем выбранную локацию
-
-    if gender == GenderType.KIDS:
-        await state.set_state(ProductCreationStates.waiting_for_location_style)
-        await callback.message.answer(
-            "🎨 Пожалуйста, выберите стиль локации:",
-            reply_markup=get_location_style_keyboard(location)  # Передаем локацию
-        )
-    else:
-        await state.set_state(ProductCreationStates.waiting_for_size)
-        await callback.message.answer(
-            "📏 Пожалуйста выберите размер одежды:",
-            reply_markup=get_size_keyboard()
-        )
-    
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("size_"))
-async def size_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора размера"""
-    size_map = {
-        "size_42_46": SizeType.SIZE_42_46,
-        "size_50_54": SizeType.SIZE_50_54,
-        "size_58_64": SizeType.SIZE_58_64,
-        "size_64_68": SizeType.SIZE_64_68
-    }
-
-    size = size_map[callback.data]
-    await state.update_data(size=size)
-    await state.set_state(ProductCreationStates.waiting_for_location_style)
-
-    # Получаем выбранную локацию из состояния
-    data = await state.get_data()
-    location = data.get('location')
-
-    await callback.message.answer(
-        "🎨 Пожалуйста, выберите стиль локации:",
-        reply_markup=get_location_style_keyboard(location)  # Передаем локацию
-    )
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("style_"))
-async def location_style_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора стиля локации"""
-    style_map = {
-        "style_new_year": LocationStyle.NEW_YEAR,
-        "style_summer": LocationStyle.SUMMER,
-        "style_nature": LocationStyle.NATURE,
-        "style_park_winter": LocationStyle.PARK_WINTER,
-        "style_park_summer": LocationStyle.PARK_SUMMER,
-        "style_regular": LocationStyle.REGULAR,
-        "style_car": LocationStyle.CAR
-    }
-
-    location_style = style_map[callback.data]
-    await state.update_data(location_style=location_style)
-    await state.set_state(ProductCreationStates.waiting_for_pose)
-
-    await callback.message.answer(
-        "🧘 Пожалуйста выберите положение тела:",
-        reply_markup=get_pose_keyboard()
-    )
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("pose_"))
-async def pose_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора позы"""
-    pose_map = {
-        "pose_sitting": PoseType.SITTING,
-        "pose_standing": PoseType.STANDING
-    }
-
-    pose = pose_map[callback.data]
-    await state.update_data(pose=pose)
-    await state.set_state(ProductCreationStates.waiting_for_view)
-
-    await callback.message.answer("👀 Пожалуйста выберите вид:", reply_markup=get_view_keyboard())
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("view_"))
-async def view_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора вида"""
-    view_map = {
-        "view_back": ViewType.BACK,
-        "view_front": ViewType.FRONT
-    }
-
-    view = view_map[callback.data]
-    await state.update_data(view=view)
-
-    data = await state.get_data()
-    summary = await generate_summary(data)
-    prompt = await generate_prompt(data)
-
-    await state.update_data(prompt=prompt)
-
-    user_id = callback.from_user.id
-    db.add_generation(user_id, prompt)
-
-    summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
-
-    await callback.message.answer(summary_text, reply_markup=get_confirmation_keyboard())
-    await state.set_state(ProductCreationStates.waiting_for_confirmation)
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("white_bg_view_"))
-async def white_bg_view_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик выбора ракурса для белого фона"""
-    view_map = {
-        "white_bg_view_back": "back",
-        "white_bg_view_front": "front"
-    }
-    
-    view = view_map[callback.data]
-    await state.update_data(white_bg_view=view)
-    
-    data = await state.get_data()
-    prompt = await generate_prompt(data)
-    await state.update_data(prompt=prompt)
-    
-    user_id = callback.from_user.id
-    db.add_generation(user_id, prompt)
-    
-    summary = await generate_summary(data)
-    summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
-    
-    await callback.message.answer(summary_text, reply_markup=get_confirmation_keyboard())
-    await state.set_state(ProductCreationStates.waiting_for_confirmation)
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("confirm_"))
-async def confirmation_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик подтверждения генерации"""
-    from handlers.user_handlers import create_photo_handler
-    
-    user_id = callback.from_user.id
-    current_balance = db.get_user_balance(user_id)
-
-    if callback.data == "confirm_generate":
-        if current_balance <= 0 and not GEMINI_DEMO_MODE:
-            await callback.message.answer("❌ Недостаточно генераций. Пополните баланс.")
-            await state.clear()
-            await callback.answer()
-            return
-
-        if not GEMINI_DEMO_MODE:
-            new_balance = current_balance - 1
-            db.update_user_balance(user_id, new_balance)
-        else:
-            new_balance = current_balance
-
-        data = await state.get_data()
-        prompt = data.get('prompt', '')
-        temp_photo_path = data.get('temp_photo_path')
-        
-        # Сохраняем оригинальный промпт для возможности изменений
-        if 'original_prompt' not in data:
-            await state.update_data(original_prompt=prompt)
-        
-        # Проверка наличия временного файла
-        if not temp_photo_path:
-            await callback.message.answer(
-                "❌ Ошибка: фото товара не найдено. Пожалуйста, начните заново.",
-                reply_markup=get_back_keyboard()
-            )
-            await state.clear()
-            await callback.answer()
-            return
-
-        generating_msg = await callback.message.answer(
-            f"🎨 Генерация началась...\n\n"
-            f"[▱▱▱▱▱▱▱▱▱▱] 0%\n\n"
-            f"⏱️ Пожалуйста, подождите..."
-        )
-
-        try:
-            # Запускаем прогресс-бар и генерацию параллельно
-            progress_task = asyncio.create_task(show_progress_bar(generating_msg, duration=15))
-            
-            # Генерация изображения через Gemini API
-            processed_image_bytes = call_gemini_api(temp_photo_path, prompt)
-            
-            # Отменяем прогресс-бар после завершения генерации
-            progress_task.cancel()
-            try:
-                await progress_task
-            except asyncio.CancelledError:
-                pass
-
-            # Пересохранение через PIL для гарантии совместимости с Telegram
-            image_stream = BytesIO(processed_image_bytes)
-            img = Image.open(image_stream)
-
-            output_stream = BytesIO()
-            img.save(output_stream, format='JPEG', quality=90)
-            final_image_bytes = output_stream.getvalue()
-
-            # Отправка сгенерированного изображения
-            generated_image = BufferedInputFile(final_image_bytes, filename="generated_fashion.jpg")
-
-            await callback.message.answer_photo(
-                generated_image,
-                caption="✨ Генерация завершена успешно!",
-                reply_markup=get_after_generation_keyboard()
-            )
-
-            await generating_msg.delete()
-
-        except Exception as e:
-            logger.error(f"Ошибка при генерации изображения: {e}")
-            await generating_msg.delete()
-
-            error_msg = str(e)
-            if "location is not supported" in error_msg.lower() and not GEMINI_DEMO_MODE:
-                await callback.message.answer(
-                    "❌ Сервис генерации изображений недоступен в вашем регионе.\n\n"
-                    "Ваш баланс был возвращен."
-                )
-                db.update_user_balance(user_id, current_balance)
-            else:
-                await callback.message.answer(
-                    f"❌ Произошла ошибка при генерации изображения:\n\n"
-                    f"{error_msg[:200]}\n\n"
-                    f"Попробуйте изменить параметры или обратитесь в поддержку.",
-                    parse_mode=None
-                )
-                if not GEMINI_DEMO_MODE:
-                    db.update_user_balance(user_id, current_balance)
-
-        finally:
-            # НЕ очищаем состояние и НЕ удаляем файл - они нужны для возможности изменений
-            # Состояние и файл будут очищены при выборе "Завершить" или при создании нового фото
-            pass
-
-    elif callback.data == "confirm_edit":
-        await state.clear()
-        await create_photo_handler(callback)
-    
-    await callback.answer()
-
-
-@router.callback_query(F.data == "after_gen_edit")
-async def after_generation_edit_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик внесения изменений после генерации"""
-    await callback.message.answer(
-        "✏️ Опишите желаемые изменения:\n\n"
-        "Например:\n"
-        "• Измените цвет фона на голубой\n"
-        "• Добавьте более яркое освещение\n"
-        "• Сделайте модель более улыбчивой\n\n"
-        "Ваши пожелания будут добавлены к исходному запросу."
-    )
-    await state.set_state(ProductCreationStates.waiting_for_custom_prompt)
-    await callback.answer()
-
-
-@router.callback_query(F.data == "after_gen_finish")
-async def after_generation_finish_handler(callback: CallbackQuery, state: FSMContext):
-    """Обработчик завершения после генерации"""
-    from handlers.user_handlers import show_main_menu
-    
-    # Очищаем состояние и временные файлы
-    data = await state.get_data()
-    temp_photo_path = data.get('temp_photo_path')
-    
-    if temp_photo_path and os.path.exists(temp_photo_path):
-        os.unlink(temp_photo_path)
-    
-    await state.clear()
-    await callback.message.delete()
-    await show_main_menu(callback.message)
-    await callback.answer()
-
-
-@router.message(StateFilter(ProductCreationStates.waiting_for_custom_prompt))
-async def custom_prompt_handler(message: Message, state: FSMContext):
-    """Обработчик пользовательского промпта для изменений"""
-    user_id = message.from_user.id
-    current_balance = db.get_user_balance(user_id)
-    
-    if current_balance <= 0 and not GEMINI_DEMO_MODE:
-        await message.answer("❌ Недостаточно генераций. Пополните баланс.")
-        await state.clear()
-        return
-    
-    # Получаем данные
-    data = await state.get_data()
-    original_prompt = data.get('original_prompt', data.get('prompt', ''))
-    user_additions = message.text
-    temp_photo_path = data.get('temp_photo_path')
-    
-    # Проверка наличия временного файла
-    if not temp_photo_path or not os.path.exists(temp_photo_path):
-        await message.answer(
-            "❌ Ошибка: исходное фото не найдено. Пожалуйста, начните создание фото заново.",
-            reply_markup=get_back_keyboard()
-        )
-        await state.clear()
-        return
-    
-    # Сохраняем оригинальный промпт, если еще не сохранен
-    if 'original_prompt' not in data:
-        await state.update_data(original_prompt=original_prompt)
-    
-    # Объединяем промпты
-    combined_prompt = f"{original_prompt}\n\nAdditional user requirements: {user_additions}"
-    
-    # Списываем генерацию
-    if not GEMINI_DEMO_MODE:
-        new_balance = current_balance - 1
-        db.update_user_balance(user_id, new_balance)
-    else:
-        new_balance = current_balance
-    
-    db.add_generation(user_id, combined_prompt)
-    
-    generating_msg = await message.answer(
-        f"🎨 Генерация с изменениями...\n\n"
-        f"[▱▱▱▱▱▱▱▱▱▱] 0%\n\n"
-        f"⏱️ Пожалуйста, подождите..."
-    )
-    
-    try:
-        # Запускаем прогресс-бар и генерацию параллельно
-        progress_task = asyncio.create_task(show_progress_bar(generating_msg, duration=12))
-        
-        # Генерация с измененным промптом
-        processed_image_bytes = call_gemini_api(temp_photo_path, combined_prompt)
-        
-        # Отменяем прогресс-бар
-        progress_task.cancel()
-        try:
-            await progress_task
-        except asyncio.CancelledError:
-            pass
-        
-        # Пересохранение через PIL
-        image_stream = BytesIO(processed_image_bytes)
-        img = Image.open(image_stream)
-        
-        output_stream = BytesIO()
-        img.save(output_stream, format='JPEG', quality=90)
-        final_image_bytes = output_stream.getvalue()
-        
-        # Отправка
-        generated_image = BufferedInputFile(final_image_bytes, filename="generated_fashion.jpg")
-        
-        await message.answer_photo(
-            generated_image,
-            caption="✨ Генерация с изменениями завершена!",
-            reply_markup=get_regenerate_keyboard()
-        )
-        
-        await generating_msg.delete()
-        
-    except Exception as e:
-        logger.error(f"Ошибка при регенерации: {e}")
-        await generating_msg.delete()
-        
-        error_msg = str(e)
-        await message.answer(
-            f"❌ Произошла ошибка при генерации:\n\n"
-            f"{error_msg[:200]}\n\n"
-            f"Попробуйте изменить описание или начните заново.",
-            parse_mode=None
-        )
-        
-        # Возвращаем баланс
-        if not GEMINI_DEMO_MODE:
-            db.update_user_balance(user_id, current_balance)
-    
-    finally:
-        # Очищаем состояние и файл
-        await state.clear()
-        if temp_photo_path and os.path.exists(temp_photo_path):
-            os.unlink(temp_photo_path)
+"""
+Обработчики создания фотографий
+"""
+import os
+import asyncio
+import functools
+import tempfile
+from typing import Dict, Any, Optional
+
+from aiogram import Router, F
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
+from aiogram.filters import StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.utils.media_group import MediaGroupBuilder
+
+from config import SUPPORT_USERNAME, GEMINI_DEMO_MODE, OUTPUT_SEND_DOCUMENT, logger
+from database import Database
+from models import (
+    JobState,
+    GenderType,
+    LocationType,
+    SizeType,
+    LocationStyle,
+    PoseType,
+    ViewType,
+    ProductCreationStates
+)
+from keyboards import (
+    get_location_keyboard,
+    get_age_keyboard,
+    get_size_keyboard,
+    get_location_style_keyboard,
+    get_pose_keyboard,
+    get_view_keyboard,
+    get_confirmation_keyboard,
+    get_generation_in_progress_keyboard,
+    get_back_keyboard,
+    get_white_bg_view_keyboard,
+    get_after_generation_keyboard,
+    get_length_keyboard
+)
+import analytics
+import costs
+from edit_sessions import edit_sessions
+from gemini_api import build_request_body, call_gemini_api, uses_demo_backend
+from image_encoder import EncodedImage, encode_for_telegram, document_filename
+from image_quality import check_photo_quality
+from inflight import InflightGeneration, idempotency_key, inflight
+from journal import REDELIVERY_NOTICE, schedule_redelivery
+from lifecycle import lifecycle
+from media_store import media_store
+from payload_prep import payload_preparer
+from prompt_templates import build_prompt, describe_prompt
+from scheduling import generation_scheduler, priority_class
+from source_uploads import is_stale_reference, source_uploads
+from supervision import STAGE_BUDGETS, GenerationCancelled, GenerationRun, supervise_generation
+from utils import show_progress_bar
+import tracing
+
+router = Router()
+
+SHUTDOWN_NOTICE = "⏳ Бот перезапускается. Попробуйте через минуту - баланс не списан."
+
+DUPLICATE_NOTICE = "⏳ Генерация уже выполняется, результат придет в этот чат."
+BUSY_NOTICE = "⏳ Дождитесь завершения текущей генерации."
+
+# Стоимость генерации; в демо-режиме баланс не списывается
+GENERATION_COST = 0 if GEMINI_DEMO_MODE else 1
+
+
+async def generate_prompt(data: Dict[str, Any]) -> str:
+    """
+    Генерирует подробный промпт для Gemini API на основе выбранных параметров.
+    """
+    return build_prompt(data)
+
+
+async def encode_result(image_bytes: bytes) -> EncodedImage:
+    """Кодирует результат для Telegram вне event loop"""
+    encoded = await asyncio.to_thread(encode_for_telegram, image_bytes)
+    logger.info(
+        f"Результат закодирован: {len(image_bytes)} -> {len(encoded.data)} байт, "
+        f"quality={encoded.quality or 'исходное'}, {encoded.width}x{encoded.height}, "
+        f"итераций {encoded.iterations}"
+    )
+    return encoded
+
+
+async def send_generated_image(
+    message: Message,
+    image_bytes: bytes,
+    caption: str,
+    reply_markup=None,
+    encoded: Optional[EncodedImage] = None
+):
+    """
+    Отправляет результат: быстрое превью-фото в пределах бюджета байт,
+    и при OUTPUT_SEND_DOCUMENT - оригинал документом без перекодирования.
+    """
+    if encoded is None:
+        encoded = await encode_result(image_bytes)
+
+    generated_image = BufferedInputFile(encoded.data, filename="generated_fashion.jpg")
+    await message.answer_photo(generated_image, caption=caption, reply_markup=reply_markup)
+
+    if OUTPUT_SEND_DOCUMENT:
+        filename = await asyncio.to_thread(document_filename, image_bytes)
+        if filename:
+            await message.answer_document(
+                BufferedInputFile(image_bytes, filename=filename),
+                caption="📎 Оригинал в полном качестве"
+            )
+
+
+async def _on_generation_cancelled(message: Message, generating_msg: Message, refunded: bool):
+    """
+    Уведомляет пользователя об отмене генерации при остановке бота.
+
+    Если результат уже получен (возврат не выполнен), его доставит
+    восстановление журнала после перезапуска.
+    """
+    if refunded:
+        notice = "⛔ Генерация прервана из-за перезапуска бота. Ваш баланс был возвращен."
+    else:
+        notice = "⏳ Бот перезапускается. Готовое изображение будет отправлено после перезапуска."
+    try:
+        await asyncio.wait_for(generating_msg.delete(), timeout=5)
+        await asyncio.wait_for(message.answer(notice), timeout=5)
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить об отмене генерации: {e}")
+
+
+async def _on_user_cancelled(message: Message, generating_msg: Message, refunded: bool):
+    """Уведомляет об отмене генерации кнопкой «Отменить»"""
+    notice = "⛔ Генерация отменена."
+    if refunded:
+        notice += " Ваш баланс был возвращен."
+    try:
+        await generating_msg.delete()
+    except Exception as e:
+        logger.debug(f"Не удалось удалить сообщение прогресса: {e}")
+    await message.answer(notice)
+
+
+async def _answer_duplicate(event, entry: InflightGeneration, key: str):
+    """
+    Отвечает на повторный запуск, пока идет генерация пользователя.
+
+    Повтор того же заказа присоединяется к идущей генерации: баланс не
+    списывается, запрос в Gemini не отправляется.
+    """
+    logger.info(f"Повторный запуск генерации отклонен (задание {entry.job_id}, повторов {entry.duplicates})")
+    # У Message и CallbackQuery одинаковая сигнатура answer(text)
+    await event.answer(DUPLICATE_NOTICE if entry.key == key else BUSY_NOTICE)
+
+
+async def _set_reply_markup(message: Message, reply_markup):
+    """Меняет клавиатуру сообщения; ошибки (сообщение удалено, не изменилось) не важны"""
+    try:
+        await message.edit_reply_markup(reply_markup=reply_markup)
+    except Exception as e:
+        logger.debug(f"Не удалось изменить клавиатуру: {e}")
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def store_generation_input(user_id: int, temp_photo_path: str):
+    """
+    Сохраняет входное фото в хранилище медиа.
+
+    Returns:
+        (хэш входа, функция без аргументов, возвращающая фрагмент запроса
+        с фото): ссылку на файл в File API, если фото уже загружено, иначе
+        заранее подготовленный base64-фрагмент или кодирование на месте
+    """
+    with tracing.span("input") as span:
+        # Зависшая фоновая подготовка не задерживает генерацию дольше бюджета этапа
+        prepared = await payload_preparer.get(user_id, temp_photo_path, timeout=STAGE_BUDGETS.get("preprocess"))
+        if prepared is None:
+            image_bytes = await asyncio.to_thread(_read_file, temp_photo_path)
+            image_part = None
+        else:
+            image_bytes, image_part = prepared.image_bytes, prepared.image_part
+        if span is not None:
+            span.set(prepared=prepared is not None, bytes=len(image_bytes))
+        input_hash = await asyncio.to_thread(media_store.put, image_bytes)
+    return input_hash, functools.partial(source_uploads.part, input_hash, image_bytes, image_part)
+
+
+async def build_single_turn_body(prompt: str, source_part) -> bytes:
+    """Тело запроса из промпта и исходного фото"""
+    return build_request_body(prompt, await source_part())
+
+
+async def run_generation_job(
+    job_id: int,
+    db: Database,
+    input_path: str,
+    prompt: str,
+    build_body,
+    run: GenerationRun,
+    category: str = "",
+    priority: str = "paid"
+):
+    """
+    Выполняет запрос к Gemini по заданию журнала и сохраняет результат.
+
+    Сборка тела (этап upload) и запрос (этап model) выполняются в бюджетах
+    надзора run. build_body - функция без аргументов, собирающая тело
+    запроса. Если Gemini не находит файл, на который ссылается тело,
+    ссылки сбрасываются и запрос повторяется с собранным заново телом.
+    Запросы к Gemini записываются в учет расходов с категорией category
+    при любом исходе. На время сборки и запроса генерация занимает слот
+    Gemini класса priority (этап queue - ожидание слота, см. scheduling).
+
+    После возврата задание в состоянии succeeded: при сбое доставки
+    результат будет отправлен повторно без нового запроса к Gemini.
+
+    Returns:
+        (байты изображения, хэш результата в хранилище медиа)
+    """
+    db.transition_job(job_id, JobState.SUBMITTED)
+    if generation_scheduler:
+        await run.stage("queue", generation_scheduler.acquire(priority))
+    try:
+        body = None if uses_demo_backend() else await run.stage("upload", build_body())
+        with costs.collect() as calls:
+            try:
+                image_bytes = await run.stage("model", _call_with_fallback(input_path, prompt, body, build_body))
+            finally:
+                db.record_gemini_calls(job_id, calls, category)
+    finally:
+        if generation_scheduler:
+            generation_scheduler.release(priority)
+    # Результат получен и будет сохранен: дальше отмена пользователем невозможна
+    run.cancellable = False
+    output_hash = await asyncio.to_thread(media_store.put, image_bytes)
+    db.transition_job(job_id, JobState.SUCCEEDED, output_hash=output_hash)
+    return image_bytes, output_hash
+
+
+async def _call_with_fallback(input_path: str, prompt: str, body: Optional[bytes], build_body) -> bytes:
+    try:
+        return await call_gemini_api(input_path, prompt, body=body)
+    except Exception as e:
+        if body is None or not is_stale_reference(body, e):
+            raise
+        # Файл в File API истек или удален раньше срока: повторяем с изображениями в запросе
+        logger.warning(f"Файл в File API недоступен, повтор без ссылки: {e}")
+        source_uploads.invalidate_referenced(body)
+        return await call_gemini_api(input_path, prompt, body=await build_body())
+
+
+async def generate_summary(data: Dict[str, Any]) -> str:
+    """
+    Генерирует текстовую сводку выбранных параметров для подтверждения.
+    """
+    summary_parts = []
+
+    gender = data.get('gender', GenderType.FLAT_LAY)
+    summary_parts.append(f"📦 **Категория**: {gender.value.capitalize()}")
+
+    if gender == GenderType.WHITE_BG:
+        view = data.get('white_bg_view', 'front')
+        view_text = "Сзади" if view == "back" else "Спереди"
+        summary_parts.append(f"👀 **Ракурс**: {view_text}")
+    elif gender != GenderType.FLAT_LAY:
+        summary_parts.append(f"📏 **Рост модели**: {data.get('height', 'Не указан')} см")
+        summary_parts.append(f"📐 **Длина изделия**: {data.get('length', 'Не указана')} см")
+        summary_parts.append(f"📍 **Локация**: {data.get('location', LocationType.STUDIO).value}")
+        summary_parts.append(f"🎂 **Возраст модели**: {data.get('age', 'Не указан')}")
+
+        if gender != GenderType.KIDS:
+            summary_parts.append(f"📐 **Размер**: {data.get('size', SizeType.SIZE_42_46).value}")
+
+        summary_parts.append(f"🎨 **Стиль локации**: {data.get('location_style', LocationStyle.REGULAR).value}")
+        summary_parts.append(f"🧘 **Положение тела**: {data.get('pose', PoseType.STANDING).value}")
+        summary_parts.append(f"👀 **Вид**: {data.get('view', ViewType.FRONT).value}")
+
+    return "\n".join(summary_parts)
+
+
+@router.callback_query(F.data.startswith("gender_"))
+async def gender_select_handler(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Обработчик выбора пола/категории"""
+    # Проверяем, есть ли у пользователя бесплатная генерация
+    user_id = callback.from_user.id
+    user_state = db.get_user_state(user_id, with_generations=True)
+    
+    # Если это первая генерация пользователя и баланс 0, даем бесплатную
+    if user_state.free_trial_available and db.grant_free_trial(user_id):
+        await callback.message.answer(
+            "🎉 **Вам предоставлена 1 бесплатная генерация!**\n\n"
+            "Вы можете создать свое первое фото бесплатно. "
+            "Для последующих генераций потребуется пополнение баланса."
+        )
+
+    gender_map = {
+        "gender_women": GenderType.WOMEN,
+        "gender_men": GenderType.MEN,
+        "gender_kids": GenderType.KIDS,
+        "gender_display": GenderType.FLAT_LAY,
+        "gender_white_bg": GenderType.WHITE_BG
+    }
+
+    gender = gender_map[callback.data]
+    await state.update_data(gender=gender)
+
+    # Попытка загрузить примеры фото (опционально)
+    if gender not in [GenderType.FLAT_LAY, GenderType.WHITE_BG]:
+        import os
+        if os.path.exists("photo/example1.jpg") and os.path.exists("photo/example2.jpg"):
+            try:
+                media_group = MediaGroupBuilder()
+                photo1 = FSInputFile("photo/example1.jpg")
+                photo2 = FSInputFile("photo/example2.jpg")
+                media_group.add_photo(media=photo1)
+                media_group.add_photo(media=photo2)
+                await callback.message.answer_media_group(media=media_group.build())
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить примеры фото: {e}")
+        else:
+            logger.info("Примеры фото не найдены, пропускаем")
+
+    if gender == GenderType.FLAT_LAY:
+        instruction_text = (
+            "📸 Пожалуйста пришлите фотографию вашего товара для создания витринного фото.\n\n"
+            "⚠️ Обратите внимание: фотография вашего товара должна быть четко видна "
+            "без лишних бликов и размытостей.\n\n"
+            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
+        )
+    elif gender == GenderType.WHITE_BG:
+        instruction_text = (
+            "📸 Пожалуйста пришлите фотографию вашего товара для фото на белом фоне.\n\n"
+            "⚠️ Обратите внимание: фотография должна быть четкой "
+            "без лишних бликов и размытостей.\n\n"
+            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
+        )
+    else:
+        instruction_text = (
+            "📸 Пожалуйста пришлите фотографию вашего товара.\n\n"
+            "⚠️ Обратите внимание: фотография вашего товара должна быть четко видна "
+            "без лишних бликов и размытостей.\n\n"
+            f"Если остались вопросы - пишите в поддержку {SUPPORT_USERNAME}"
+        )
+
+    await callback.message.answer(instruction_text)
+    await state.set_state(ProductCreationStates.waiting_for_photo)
+    await callback.answer()
+
+
+@router.message(StateFilter(ProductCreationStates.waiting_for_photo))
+async def photo_handler(message: Message, state: FSMContext, bot, db: Database):
+    """Обработчик загрузки фото"""
+    if not message.photo:
+        await message.answer("📸 Пожалуйста, отправьте фотографию товара.")
+        return
+
+    photo_file_id = message.photo[-1].file_id
+    await state.update_data(photo_file_id=photo_file_id)
+    # Трасса сценария: продолжится в хэндлерах генерации и правок
+    trace_id = tracing.bind(user_id=message.from_user.id)
+
+    temp_path = None
+    try:
+        with tracing.span("download"):
+            file = await bot.get_file(photo_file_id)
+            file_path = file.file_path
+
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
+            temp_path = temp_file.name
+            temp_file.close()
+
+            lifecycle.track_temp_file(temp_path)
+            await bot.download_file(file_path, temp_path)
+
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении фото: {e}")
+        await message.answer("❌ Ошибка при обработке фото. Попробуйте еще раз.")
+        if temp_path:
+            lifecycle.remove_temp_file(temp_path)
+        return
+
+    # Размытое или пересвеченное фото отклоняем до списания генерации
+    with tracing.span("quality"):
+        report = await check_photo_quality(temp_path)
+    if report is not None and report.problems:
+        lifecycle.remove_temp_file(temp_path)
+        await message.answer(
+            "⚠️ Фото не подходит для генерации: " + ", ".join(report.problems) + ".\n\n"
+            "📸 Пожалуйста, пришлите другую фотографию: товар должен быть четко виден "
+            "без лишних бликов и размытостей."
+        )
+        return
+
+    await state.update_data(temp_photo_path=temp_path, trace_id=trace_id)
+    # Готовим запрос к Gemini, пока пользователь заполняет анкету
+    payload_preparer.start(message.from_user.id, temp_path)
+
+    if report is not None and report.warnings:
+        await message.answer(
+            "⚠️ Обратите внимание: " + ", ".join(report.warnings) + ". "
+            "Результат может получиться хуже - при желании начните заново с другим фото."
+        )
+
+    data = await state.get_data()
+    gender = data['gender']
+
+    if gender == GenderType.FLAT_LAY:
+        prompt = await generate_prompt(data)
+        await state.update_data(prompt=prompt)
+
+        db.save_draft(message.from_user.id, *describe_prompt(data))
+
+        summary = await generate_summary(data)
+        summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
+
+        await message.answer(summary_text, reply_markup=get_confirmation_keyboard())
+        await state.set_state(ProductCreationStates.waiting_for_confirmation)
+    elif gender == GenderType.WHITE_BG:
+        # Для белого фона - сразу выбор ракурса
+        await state.set_state(ProductCreationStates.waiting_for_white_bg_view)
+        await message.answer(
+            "👀 Выберите ракурс для фото на белом фоне:",
+            reply_markup=get_white_bg_view_keyboard()
+        )
+    else:
+        await state.set_state(ProductCreationStates.waiting_for_height)
+        await message.answer("📏 Напишите рост модели (в см):")
+
+
+@router.message(StateFilter(ProductCreationStates.waiting_for_height))
+async def height_handler(message: Message, state: FSMContext):
+    """Обработчик ввода роста"""
+    height = message.text
+    if not height.isdigit():
+        await message.answer("❌ Пожалуйста, введите числовое значение роста в см:")
+        return
+
+    await state.update_data(height=height)
+    await state.set_state(ProductCreationStates.waiting_for_length)
+    
+    await message.answer(
+        "📏 Теперь введите длину изделия в см (или пропустите):",
+        reply_markup=get_length_keyboard()
+    )
+
+
+@router.message(StateFilter(ProductCreationStates.waiting_for_length))
+async def length_handler(message: Message, state: FSMContext):
+    """Обработчик ввода длины изделия"""
+    length = message.text
+    if not length.isdigit():
+        await message.answer("❌ Пожалуйста, введите числовое значение длины в см:")
+        return
+
+    await state.update_data(length=length)
+    await state.set_state(ProductCreationStates.waiting_for_location)
+
+    await message.answer("📍 Пожалуйста выберите локацию:", reply_markup=get_location_keyboard())
+
+@router.callback_query(F.data == "length_skip")
+async def length_skip_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик пропуска ввода длины"""
+    await state.update_data(length="70")  # Значение по умолчанию
+    await state.set_state(ProductCreationStates.waiting_for_location)
+
+    await callback.message.answer("📍 Пожалуйста выберите локацию:", reply_markup=get_location_keyboard())
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("location_"))
+async def location_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора локации"""
+    location_map = {
+        "location_street": LocationType.STREET,
+        "location_studio": LocationType.STUDIO, 
+        "location_floor": LocationType.FLOOR_ZONE
+    }
+
+    location = location_map[callback.data]
+    await state.update_data(location=location)
+
+    data = await state.get_data()
+    gender = data['gender']
+
+    await callback.message.answer(
+        "🎂 Пожалуйста выберите возраст модели:",
+        reply_markup=get_age_keyboard(gender)
+    )
+    await state.set_state(ProductCreationStates.waiting_for_age)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("age_"))
+async def age_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора возраста"""
+    age = callback.data.replace("age_", "")
+    await state.update_data(age=age)
+
+    data = await state.get_data()
+    gender = data['gender']
+    location = data.get('location')  # Получаем выбранную локацию
+
+    if gender == GenderType.KIDS:
+        await state.set_state(ProductCreationStates.waiting_for_location_style)
+        await callback.message.answer(
+            "🎨 Пожалуйста, выберите стиль локации:",
+            reply_markup=get_location_style_keyboard(location)  # Передаем локацию
+        )
+    else:
+        await state.set_state(ProductCreationStates.waiting_for_size)
+        await callback.message.answer(
+            "📏 Пожалуйста выберите размер одежды:",
+            reply_markup=get_size_keyboard()
+        )
+    
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("size_"))
+async def size_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора размера"""
+    size_map = {
+        "size_42_46": SizeType.SIZE_42_46,
+        "size_50_54": SizeType.SIZE_50_54,
+        "size_58_64": SizeType.SIZE_58_64,
+        "size_64_68": SizeType.SIZE_64_68
+    }
+
+    size = size_map[callback.data]
+    await state.update_data(size=size)
+    await state.set_state(ProductCreationStates.waiting_for_location_style)
+
+    # Получаем выбранную локацию из состояния
+    data = await state.get_data()
+    location = data.get('location')
+
+    await callback.message.answer(
+        "🎨 Пожалуйста, выберите стиль локации:",
+        reply_markup=get_location_style_keyboard(location)  # Передаем локацию
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("style_"))
+async def location_style_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора стиля локации"""
+    style_map = {
+        "style_new_year": LocationStyle.NEW_YEAR,
+        "style_summer": LocationStyle.SUMMER,
+        "style_nature": LocationStyle.NATURE,
+        "style_park_winter": LocationStyle.PARK_WINTER,
+        "style_park_summer": LocationStyle.PARK_SUMMER,
+        "style_regular": LocationStyle.REGULAR,
+        "style_car": LocationStyle.CAR
+    }
+
+    location_style = style_map[callback.data]
+    await state.update_data(location_style=location_style)
+    await state.set_state(ProductCreationStates.waiting_for_pose)
+
+    await callback.message.answer(
+        "🧘 Пожалуйста выберите положение тела:",
+        reply_markup=get_pose_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("pose_"))
+async def pose_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора позы"""
+    pose_map = {
+        "pose_sitting": PoseType.SITTING,
+        "pose_standing": PoseType.STANDING
+    }
+
+    pose = pose_map[callback.data]
+    await state.update_data(pose=pose)
+    await state.set_state(ProductCreationStates.waiting_for_view)
+
+    await callback.message.answer("👀 Пожалуйста выберите вид:", reply_markup=get_view_keyboard())
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("view_"))
+async def view_handler(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Обработчик выбора вида"""
+    view_map = {
+        "view_back": ViewType.BACK,
+        "view_front": ViewType.FRONT
+    }
+
+    view = view_map[callback.data]
+    await state.update_data(view=view)
+
+    data = await state.get_data()
+    summary = await generate_summary(data)
+    prompt = await generate_prompt(data)
+
+    await state.update_data(prompt=prompt)
+
+    db.save_draft(callback.from_user.id, *describe_prompt(data))
+
+    summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
+
+    await callback.message.answer(summary_text, reply_markup=get_confirmation_keyboard())
+    await state.set_state(ProductCreationStates.waiting_for_confirmation)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("white_bg_view_"))
+async def white_bg_view_handler(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Обработчик выбора ракурса для белого фона"""
+    view_map = {
+        "white_bg_view_back": "back",
+        "white_bg_view_front": "front"
+    }
+    
+    view = view_map[callback.data]
+    await state.update_data(white_bg_view=view)
+    
+    data = await state.get_data()
+    prompt = await generate_prompt(data)
+    await state.update_data(prompt=prompt)
+    
+    db.save_draft(callback.from_user.id, *describe_prompt(data))
+    
+    summary = await generate_summary(data)
+    summary_text = f"📋 Проверьте выбранные параметры:\n\n{summary}"
+    
+    await callback.message.answer(summary_text, reply_markup=get_confirmation_keyboard())
+    await state.set_state(ProductCreationStates.waiting_for_confirmation)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("confirm_"))
+async def confirmation_handler(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Обработчик подтверждения генерации"""
+    from handlers.user_handlers import create_photo_handler
+    
+    user_id = callback.from_user.id
+    current_balance = db.get_user_balance(user_id)
+
+    if callback.data == "confirm_generate":
+        if not lifecycle.accepting:
+            await callback.message.answer(SHUTDOWN_NOTICE)
+            await callback.answer()
+            return
+
+        data = await state.get_data()
+        prompt = data.get('prompt', '')
+        temp_photo_path = data.get('temp_photo_path')
+        tracing.bind(data.get('trace_id'), user_id=user_id, kind="create")
+
+        # Повторное нажатие не должно второй раз списывать баланс и запускать генерацию
+        key = idempotency_key("create", callback.message.message_id, prompt, temp_photo_path)
+        entry, created = inflight.acquire(user_id, key, "create")
+        if not created:
+            await _answer_duplicate(callback, entry, key)
+            return
+
+        if current_balance < GENERATION_COST:
+            inflight.release(user_id, entry)
+            await callback.message.answer("❌ Недостаточно генераций. Пополните баланс.")
+            await state.clear()
+            await callback.answer()
+            return
+        
+        # Сохраняем оригинальный промпт для возможности изменений
+        if 'original_prompt' not in data:
+            await state.update_data(original_prompt=prompt)
+        
+        # Проверка наличия временного файла (до списания баланса)
+        if not temp_photo_path or not os.path.exists(temp_photo_path):
+            inflight.release(user_id, entry)
+            await callback.message.answer(
+                "❌ Ошибка: фото товара не найдено. Пожалуйста, начните заново.",
+                reply_markup=get_back_keyboard()
+            )
+            await state.clear()
+            await callback.answer()
+            return
+
+        # Списание и задание журнала - одной транзакцией
+        input_hash, source_part = await store_generation_input(user_id, temp_photo_path)
+        job_id = db.reserve_generation(
+            user_id, callback.message.chat.id, "create", prompt, input_hash, GENERATION_COST
+        )
+        if job_id is None:
+            inflight.release(user_id, entry)
+            await callback.message.answer("❌ Недостаточно генераций. Пополните баланс.")
+            await state.clear()
+            await callback.answer()
+            return
+        entry.job_id = job_id
+        priority = priority_class("create", db.has_paid(user_id))
+        tracing.annotate(job_id=job_id, priority=priority)
+        template, params = describe_prompt(data)
+        db.add_generation(user_id, template, params, job_id=job_id)
+
+        generating_msg = await callback.message.answer(
+            f"🎨 Генерация началась...\n\n"
+            f"[▱▱▱▱▱▱▱▱▱▱] 0%\n\n"
+            f"⏱️ Пожалуйста, подождите..."
+        )
+        await callback.answer()
+        # Индикатор вместо кнопок подтверждения
+        await _set_reply_markup(callback.message, get_generation_in_progress_keyboard())
+
+        delivered = redelivering = False
+        try:
+            async with lifecycle.generation(), supervise_generation() as run:
+                entry.attach(run)
+                # Прогресс-бар - дочерняя задача: завершится вместе с генерацией при любом исходе
+                run.spawn(show_progress_bar(generating_msg, duration=15))
+
+                # Генерация изображения через Gemini API
+                processed_image_bytes, output_hash = await run_generation_job(
+                    job_id, db, temp_photo_path, prompt,
+                    functools.partial(build_single_turn_body, prompt, source_part),
+                    run, category=analytics.category(params), priority=priority
+                )
+                await run.stop_children()
+
+                # Отправка сгенерированного изображения
+                encoded = await run.stage("encode", encode_result(processed_image_bytes), cancellable=False)
+                await run.stage("send", send_generated_image(
+                    callback.message,
+                    processed_image_bytes,
+                    caption="✨ Генерация завершена успешно!",
+                    reply_markup=get_after_generation_keyboard(),
+                    encoded=encoded
+                ), cancellable=False)
+                db.transition_job(job_id, JobState.DELIVERED)
+                delivered = True
+                # Следующие правки продолжают этот результат
+                edit_sessions.start(user_id, input_hash, prompt, output_hash, len(processed_image_bytes))
+
+                await generating_msg.delete()
+
+        except GenerationCancelled:
+            refunded = db.refund_job(job_id, "cancelled by user")
+            await _on_user_cancelled(callback.message, generating_msg, refunded)
+
+        except asyncio.CancelledError:
+            # Генерация отменена при остановке бота: возвращаем баланс
+            refunded = db.refund_job(job_id, "cancelled on shutdown")
+            await _on_generation_cancelled(callback.message, generating_msg, refunded)
+            raise
+
+        except Exception as e:
+            logger.error(f"Ошибка при генерации изображения: {e}")
+            await generating_msg.delete()
+
+            error_msg = str(e)
+            # Результат уже получен (сбой кодирования или отправки): баланс не
+            # возвращается, доставка повторяется из хранилища медиа
+            redelivering = not db.refund_job(job_id, error_msg[:500]) and schedule_redelivery(
+                callback.bot, db, job_id
+            )
+            if redelivering:
+                await callback.message.answer(REDELIVERY_NOTICE)
+            elif "location is not supported" in error_msg.lower() and not GEMINI_DEMO_MODE:
+                await callback.message.answer(
+                    "❌ Сервис генерации изображений недоступен в вашем регионе.\n\n"
+                    "Ваш баланс был возвращен."
+                )
+            else:
+                await callback.message.answer(
+                    f"❌ Произошла ошибка при генерации изображения:\n\n"
+                    f"{error_msg[:200]}\n\n"
+                    f"Попробуйте изменить параметры или обратитесь в поддержку.",
+                    parse_mode=None
+                )
+
+        finally:
+            # НЕ очищаем состояние и НЕ удаляем файл - они нужны для возможности изменений
+            # Состояние и файл будут очищены при выборе "Завершить" или при создании нового фото
+            # После успеха кнопки подтверждения не нужны (у результата своя клавиатура),
+            # после ошибки - возвращаем их для повторной попытки, если результат
+            # не доставляется повторно
+            try:
+                if delivered or redelivering:
+                    await _set_reply_markup(callback.message, None)
+                elif lifecycle.accepting:
+                    await _set_reply_markup(callback.message, get_confirmation_keyboard())
+            finally:
+                inflight.release(user_id, entry)
+        return
+
+    elif callback.data == "confirm_edit":
+        await state.clear()
+        await create_photo_handler(callback, db)
+    
+    await callback.answer()
+
+
+@router.callback_query(F.data == "generation_in_progress")
+async def generation_in_progress_handler(callback: CallbackQuery):
+    """Нажатие на индикатор идущей генерации"""
+    entry = inflight.get(callback.from_user.id)
+    await callback.answer(DUPLICATE_NOTICE if entry else "✅ Генерация уже завершена.")
+
+
+@router.callback_query(F.data == "generation_cancel")
+async def generation_cancel_handler(callback: CallbackQuery):
+    """Кнопка "Отменить" идущей генерации: обрывает запрос к Gemini и возвращает баланс"""
+    entry = inflight.get(callback.from_user.id)
+    if entry is None:
+        await callback.answer("✅ Генерация уже завершена.")
+    elif entry.cancel():
+        await callback.answer("⛔ Отменяем генерацию...")
+    else:
+        await callback.answer("⏳ Изображение уже готово и отправляется.")
+
+
+@router.callback_query(F.data == "after_gen_edit")
+async def after_generation_edit_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик внесения изменений после генерации"""
+    await callback.message.answer(
+        "✏️ Опишите желаемые изменения:\n\n"
+        "Например:\n"
+        "• Измените цвет фона на голубой\n"
+        "• Добавьте более яркое освещение\n"
+        "• Сделайте модель более улыбчивой\n\n"
+        "Изменения будут внесены в последний результат."
+    )
+    await state.set_state(ProductCreationStates.waiting_for_custom_prompt)
+    await callback.answer()
+
+
+@router.callback_query(F.data == "after_gen_finish")
+async def after_generation_finish_handler(callback: CallbackQuery, state: FSMContext):
+    """Обработчик завершения после генерации"""
+    from handlers.user_handlers import show_main_menu
+    
+    # Очищаем состояние и временные файлы
+    data = await state.get_data()
+    temp_photo_path = data.get('temp_photo_path')
+    
+    payload_preparer.discard(callback.from_user.id)
+    edit_sessions.discard(callback.from_user.id)
+    lifecycle.remove_temp_file(temp_photo_path)
+    
+    await state.clear()
+    await callback.message.delete()
+    await show_main_menu(callback.message)
+    await callback.answer()
+
+
+@router.message(StateFilter(ProductCreationStates.waiting_for_custom_prompt))
+async def custom_prompt_handler(message: Message, state: FSMContext, db: Database):
+    """Обработчик пользовательского промпта для изменений"""
+    user_id = message.from_user.id
+    if not lifecycle.accepting:
+        await message.answer(SHUTDOWN_NOTICE)
+        return
+
+    # Получаем данные
+    data = await state.get_data()
+    original_prompt = data.get('original_prompt', data.get('prompt', ''))
+    user_additions = message.text
+    temp_photo_path = data.get('temp_photo_path')
+    tracing.bind(data.get('trace_id'), user_id=user_id, kind="edit")
+
+    # Повторная отправка текста во время генерации не запускает вторую;
+    # та же правка следующего результата цепочки - уже другой заказ
+    session = edit_sessions.get(user_id)
+    last_output_hash = session.last_output_hash if session else None
+    key = idempotency_key("edit", original_prompt, user_additions, temp_photo_path, last_output_hash)
+    entry, created = inflight.acquire(user_id, key, "edit")
+    if not created:
+        await _answer_duplicate(message, entry, key)
+        return
+
+    current_balance = db.get_user_balance(user_id)
+    
+    if current_balance < GENERATION_COST:
+        inflight.release(user_id, entry)
+        await message.answer("❌ Недостаточно генераций. Пополните баланс.")
+        await state.clear()
+        return
+    
+    # Проверка наличия временного файла
+    if not temp_photo_path or not os.path.exists(temp_photo_path):
+        inflight.release(user_id, entry)
+        await message.answer(
+            "❌ Ошибка: исходное фото не найдено. Пожалуйста, начните создание фото заново.",
+            reply_markup=get_back_keyboard()
+        )
+        await state.clear()
+        return
+    
+    # Сохраняем оригинальный промпт, если еще не сохранен
+    if 'original_prompt' not in data:
+        await state.update_data(original_prompt=original_prompt)
+    
+    # Объединяем промпты (для журнала и для запроса без сессии)
+    combined_prompt = f"{original_prompt}\n\nAdditional user requirements: {user_additions}"
+    
+    # Списываем генерацию вместе с созданием задания журнала
+    input_hash, source_part = await store_generation_input(user_id, temp_photo_path)
+    job_id = db.reserve_generation(
+        user_id, message.chat.id, "edit", combined_prompt, input_hash, GENERATION_COST
+    )
+    if job_id is None:
+        inflight.release(user_id, entry)
+        await message.answer("❌ Недостаточно генераций. Пополните баланс.")
+        await state.clear()
+        return
+    entry.job_id = job_id
+    priority = priority_class("edit", db.has_paid(user_id))
+    tracing.annotate(job_id=job_id, priority=priority)
+    
+    template, params = describe_prompt(data)
+    db.add_generation(user_id, template, params, additions=user_additions, job_id=job_id)
+
+    # С сессией Gemini правит прошлый результат, без нее (сессия истекла,
+    # бот перезапускался) - генерирует заново по объединенному промпту
+    session = edit_sessions.get(user_id, input_hash)
+    if session is not None:
+        build_body = functools.partial(session.build_body, user_additions, source_part)
+    else:
+        build_body = functools.partial(build_single_turn_body, combined_prompt, source_part)
+    
+    in_progress_keyboard = get_generation_in_progress_keyboard()
+    generating_msg = await message.answer(
+        f"🎨 Генерация с изменениями...\n\n"
+        f"[▱▱▱▱▱▱▱▱▱▱] 0%\n\n"
+        f"⏱️ Пожалуйста, подождите...",
+        reply_markup=in_progress_keyboard
+    )
+    
+    delivered = False
+    try:
+        async with lifecycle.generation(), supervise_generation() as run:
+            entry.attach(run)
+            # Прогресс-бар - дочерняя задача: завершится вместе с генерацией при любом исходе
+            run.spawn(show_progress_bar(generating_msg, duration=12, reply_markup=in_progress_keyboard))
+        
+            # Генерация с измененным промптом
+            processed_image_bytes, output_hash = await run_generation_job(
+                job_id, db, temp_photo_path, combined_prompt, build_body, run,
+                category=analytics.category(params), priority=priority
+            )
+            await run.stop_children()
+        
+            # Отправка: результат можно править дальше
+            encoded = await run.stage("encode", encode_result(processed_image_bytes), cancellable=False)
+            await run.stage("send", send_generated_image(
+                message,
+                processed_image_bytes,
+                caption="✨ Генерация с изменениями завершена!",
+                reply_markup=get_after_generation_keyboard(),
+                encoded=encoded
+            ), cancellable=False)
+            db.transition_job(job_id, JobState.DELIVERED)
+            delivered = True
+            if session is not None:
+                session.add_turn(user_additions, output_hash, len(processed_image_bytes))
+            else:
+                edit_sessions.start(user_id, input_hash, combined_prompt, output_hash, len(processed_image_bytes))
+            await state.set_state(ProductCreationStates.waiting_for_confirmation)
+        
+            await generating_msg.delete()
+        
+    except GenerationCancelled:
+        refunded = db.refund_job(job_id, "cancelled by user")
+        await _on_user_cancelled(message, generating_msg, refunded)
+
+    except asyncio.CancelledError:
+        # Генерация отменена при остановке бота: возвращаем баланс
+        refunded = db.refund_job(job_id, "cancelled on shutdown")
+        await _on_generation_cancelled(message, generating_msg, refunded)
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка при регенерации: {e}")
+        await generating_msg.delete()
+        
+        error_msg = str(e)
+        # Возвращаем баланс; если результат уже получен - повторяем доставку
+        if not db.refund_job(job_id, error_msg[:500]) and schedule_redelivery(message.bot, db, job_id):
+            await message.answer(REDELIVERY_NOTICE)
+        else:
+            await message.answer(
+                f"❌ Произошла ошибка при генерации:\n\n"
+                f"{error_msg[:200]}\n\n"
+                f"Попробуйте изменить описание или начните заново.",
+                parse_mode=None
+            )
+    
+    finally:
+        inflight.release(user_id, entry)
+        # После успеха состояние, файл и сессия нужны для следующих правок;
+        # они очищаются при выборе "Завершить" или при создании нового фото
+        if not delivered:
+            await state.clear()
+            edit_sessions.discard(user_id)
+            payload_preparer.discard(user_id)
+            lifecycle.remove_temp_file(temp_photo_path)
@@ -0,0 +1,147 @@
+"""
+Кодирование результата генерации для отправки в Telegram
+
+Telegram все равно пережимает фото, поэтому отправлять JPEG quality 90 любого
+размера бессмысленно: это лишь удлиняет загрузку. Кодировщик подбирает
+параметры (progressive/optimized JPEG, субдискретизация, качество бинарным
+поиском с ограниченным числом итераций), чтобы уложиться в бюджет байт.
+"""
+import io
+from dataclasses import dataclass
+from typing import Optional
+
+from config import (
+    OUTPUT_TARGET_BYTES,
+    OUTPUT_MAX_SIDE,
+    OUTPUT_MIN_QUALITY,
+    OUTPUT_MAX_QUALITY,
+    OUTPUT_MAX_ITERATIONS
+)
+
+# Субдискретизация Pillow: 0 - 4:4:4, 2 - 4:2:0
+SUBSAMPLING_444 = 0
+SUBSAMPLING_420 = 2
+
+# Форматы, которые можно отправить документом без перекодирования
+_DOCUMENT_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+@dataclass
+class EncodedImage:
+    """Результат кодирования"""
+    data: bytes
+    quality: Optional[int]  # None - исходный JPEG отправлен без перекодирования
+    subsampling: int
+    width: int
+    height: int
+    iterations: int
+
+
+def _prepare(img):
+    """Приводит изображение к RGB и ограничивает размер стороны"""
+    from PIL import Image
+
+    if img.mode not in ("RGB", "L"):
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.split()[-1])
+            img = background
+        else:
+            img = img.convert("RGB")
+
+    if max(img.size) > OUTPUT_MAX_SIDE:
+        img = img.copy()
+        img.thumbnail((OUTPUT_MAX_SIDE, OUTPUT_MAX_SIDE), Image.LANCZOS)
+    return img
+
+
+def _encode(img, quality: int, subsampling: int) -> bytes:
+    stream = io.BytesIO()
+    img.save(
+        stream,
+        format="JPEG",
+        quality=quality,
+        subsampling=subsampling,
+        optimize=True,
+        progressive=True
+    )
+    return stream.getvalue()
+
+
+def encode_for_telegram(
+    image_bytes: bytes,
+    target_bytes: int = OUTPUT_TARGET_BYTES,
+    min_quality: int = OUTPUT_MIN_QUALITY,
+    max_quality: int = OUTPUT_MAX_QUALITY,
+    max_iterations: int = OUTPUT_MAX_ITERATIONS
+) -> EncodedImage:
+    """
+    Кодирует изображение в JPEG, укладываясь в бюджет байт.
+
+    Сначала пробует максимальное качество; если не влезает - бинарный поиск
+    наибольшего качества в пределах бюджета, не более max_iterations попыток.
+    Ниже 85 качества используется 4:2:0, выше - 4:4:4 (для фото одежды
+    цветовые края заметны только при высоком качестве).
+    Если даже min_quality не влезает, возвращается вариант с min_quality.
+    JPEG, который уже укладывается в бюджет, возвращается как есть.
+
+    Функция CPU-bound: вызывать через asyncio.to_thread.
+    """
+    from PIL import Image
+
+    source = Image.open(io.BytesIO(image_bytes))
+    # Быстрый путь: JPEG уже в бюджете - перекодирование только потеряет качество
+    if (
+        source.format == "JPEG"
+        and source.mode in ("RGB", "L")
+        and len(image_bytes) <= target_bytes
+        and max(source.size) <= OUTPUT_MAX_SIDE
+    ):
+        return EncodedImage(image_bytes, None, -1, *source.size, 0)
+
+    img = _prepare(source)
+
+    def subsampling_for(quality: int) -> int:
+        return SUBSAMPLING_444 if quality >= 85 else SUBSAMPLING_420
+
+    iterations = 1
+    data = _encode(img, max_quality, subsampling_for(max_quality))
+    if len(data) <= target_bytes:
+        return EncodedImage(data, max_quality, subsampling_for(max_quality), *img.size, iterations)
+
+    best: Optional[EncodedImage] = None
+    low, high = min_quality, max_quality - 1
+    while low <= high and iterations < max_iterations:
+        quality = (low + high) // 2
+        data = _encode(img, quality, subsampling_for(quality))
+        iterations += 1
+        if len(data) <= target_bytes:
+            best = EncodedImage(data, quality, subsampling_for(quality), *img.size, iterations)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        iterations += 1
+        data = _encode(img, min_quality, SUBSAMPLING_420)
+        best = EncodedImage(data, min_quality, SUBSAMPLING_420, *img.size, iterations)
+    best.iterations = iterations
+    return best
+
+
+def document_filename(image_bytes: bytes, stem: str = "generated_fashion_full") -> Optional[str]:
+    """
+    Имя файла для отправки оригинала документом без перекодирования.
+
+    Returns:
+        None, если формат не подходит для отправки как есть
+    """
+    from PIL import Image
+
+    try:
+        image_format = Image.open(io.BytesIO(image_bytes)).format
+    except Exception:
+        return None
+    extension = _DOCUMENT_EXTENSIONS.get(image_format)
+    return f"{stem}.{extension}" if extension else None
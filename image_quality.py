@@ -0,0 +1,206 @@
+"""
+Проверка качества входного фото до списания генерации
+
+Инструкция просит фото "без лишних бликов и размытостей", но раньше это
+никак не проверялось: размытое или пересвеченное фото уходило в платный
+запрос к Gemini, а затем в возврат или обращение в поддержку.
+
+Анализ выполняется на уменьшенной копии в оттенках серого (для JPEG
+декодер сразу уменьшает кадр через draft) векторно в NumPy и занимает
+единицы миллисекунд:
+
+- резкость: дисперсия лапласиана по плиткам кадра, берется 90-й
+  перцентиль - однотонный фон вокруг товара не занижает оценку;
+- блики: доля пересвеченных пикселей вне белого фона (пересвеченных
+  плиток, связанных с краем кадра);
+- пересвет и провалы: доли всего кадра на краях диапазона яркости;
+- разрешение и соотношение сторон исходного кадра.
+
+Оценки пишутся в лог, чтобы пороги (PHOTO_* в config) можно было
+подобрать по реальным данным.
+
+NumPy и Pillow импортируются при первой проверке (их прогревает startup),
+а не при импорте модуля: handlers импортируют его на пути запуска.
+"""
+import asyncio
+import io
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Optional
+
+from config import (
+    PHOTO_QUALITY_GATE,
+    PHOTO_MIN_SIDE,
+    PHOTO_MAX_ASPECT,
+    PHOTO_BLUR_REJECT,
+    PHOTO_BLUR_WARN,
+    PHOTO_GLARE_WARN,
+    PHOTO_OVEREXPOSED_REJECT,
+    PHOTO_DARK_REJECT,
+    logger
+)
+from metrics import PHOTO_QUALITY_CHECKS
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Сторона копии для анализа: оценки резкости сопоставимы между фото разного размера
+ANALYSIS_SIDE = 512
+# Сторона плитки для оценки резкости и бликов
+TILE = 32
+# Границы "пересвеченного" и "черного" пикселя
+GLARE_LEVEL = 250
+DARK_LEVEL = 5
+
+
+@dataclass
+class QualityReport:
+    """Оценки фото и найденные проблемы"""
+    width: int
+    height: int
+    sharpness: float
+    glare: float
+    overexposed: float
+    dark: float
+    elapsed_ms: float
+    problems: List[str] = field(default_factory=list)  # фото отклоняется
+    warnings: List[str] = field(default_factory=list)  # фото принимается с предупреждением
+
+    @property
+    def verdict(self) -> str:
+        if self.problems:
+            return "reject"
+        return "warn" if self.warnings else "ok"
+
+
+def _tiles(array: "np.ndarray") -> "np.ndarray":
+    """Представление (строки, TILE, столбцы, TILE) без копирования; остаток по краям отбрасывается"""
+    rows, cols = array.shape[0] // TILE, array.shape[1] // TILE
+    return array[:rows * TILE, :cols * TILE].reshape(rows, TILE, cols, TILE)
+
+
+def _sharpness(pixels: "np.ndarray") -> float:
+    """90-й перцентиль дисперсии лапласиана по плиткам"""
+    import numpy as np
+
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    tiles = _tiles(laplacian)
+    if tiles.size == 0:
+        return float(laplacian.var()) if laplacian.size else 0.0
+    return float(np.percentile(tiles.var(axis=(1, 3)), 90))
+
+
+def _glare(clipped: "np.ndarray") -> float:
+    """
+    Доля пересвеченных пикселей вне белого фона.
+
+    Фон - почти целиком пересвеченные плитки, связанные с краем кадра;
+    блик на товаре окружен деталями и к краю не выходит. Плитки, соседние
+    с фоном, тоже не учитываются.
+    """
+    import numpy as np
+
+    tiles = _tiles(clipped)
+    if tiles.size == 0:
+        return 0.0
+    shares = tiles.mean(axis=(1, 3))
+    white = shares >= 0.98
+    background = np.zeros_like(white)
+    background[[0, -1], :] = white[[0, -1], :]
+    background[:, [0, -1]] |= white[:, [0, -1]]
+    # Заливка от краев по сетке плиток (она маленькая: 16x12 при ANALYSIS_SIDE=512)
+    while True:
+        grown = background.copy()
+        grown[1:, :] |= background[:-1, :]
+        grown[:-1, :] |= background[1:, :]
+        grown[:, 1:] |= background[:, :-1]
+        grown[:, :-1] |= background[:, 1:]
+        grown &= white
+        if np.array_equal(grown, background):
+            break
+        background = grown
+    # Плитки на границе фона и товара пересвечены частично за счет фона
+    edge = background.copy()
+    edge[1:, :] |= background[:-1, :]
+    edge[:-1, :] |= background[1:, :]
+    edge[:, 1:] |= background[:, :-1]
+    edge[:, :-1] |= background[:, 1:]
+    return float(shares[~edge].sum() / shares.size)
+
+
+def analyze_image(image_bytes: bytes) -> QualityReport:
+    """
+    Оценивает фото. Функция CPU-bound: вызывать через asyncio.to_thread.
+    """
+    import numpy as np
+    from PIL import Image
+
+    started = time.perf_counter()
+    img = Image.open(io.BytesIO(image_bytes))
+    # Поворот по EXIF не меняет ни короткую сторону, ни соотношение сторон
+    width, height = img.size
+    img.draft("L", (ANALYSIS_SIDE, ANALYSIS_SIDE))
+    gray = img.convert("L")
+    gray.thumbnail((ANALYSIS_SIDE, ANALYSIS_SIDE), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.float32)
+    clipped = pixels >= GLARE_LEVEL
+
+    report = QualityReport(
+        width=width,
+        height=height,
+        sharpness=_sharpness(pixels),
+        glare=_glare(clipped),
+        overexposed=float(clipped.mean()),
+        dark=float((pixels <= DARK_LEVEL).mean()),
+        elapsed_ms=0.0
+    )
+
+    if min(width, height) < PHOTO_MIN_SIDE:
+        report.problems.append(f"слишком маленькое разрешение ({width}x{height})")
+    if max(width, height) > PHOTO_MAX_ASPECT * min(width, height):
+        report.problems.append("слишком вытянутый кадр")
+    if report.sharpness < PHOTO_BLUR_REJECT:
+        report.problems.append("фото размыто или не в фокусе")
+    elif report.sharpness < PHOTO_BLUR_WARN:
+        report.warnings.append("фото недостаточно резкое")
+    if report.overexposed >= PHOTO_OVEREXPOSED_REJECT:
+        report.problems.append("фото пересвечено")
+    elif report.glare >= PHOTO_GLARE_WARN:
+        report.warnings.append("на фото заметные блики")
+    if report.dark >= PHOTO_DARK_REJECT:
+        report.problems.append("фото слишком темное")
+
+    report.elapsed_ms = (time.perf_counter() - started) * 1000
+    return report
+
+
+def _analyze_file(path: str) -> QualityReport:
+    with open(path, "rb") as f:
+        return analyze_image(f.read())
+
+
+async def check_photo_quality(path: str) -> Optional[QualityReport]:
+    """
+    Проверяет фото, не блокируя event loop.
+
+    Returns:
+        None, если проверка отключена или фото не удалось разобрать -
+        тогда фото принимается без проверки
+    """
+    if not PHOTO_QUALITY_GATE:
+        return None
+    try:
+        report = await asyncio.to_thread(_analyze_file, path)
+    except Exception as e:
+        logger.warning(f"Не удалось оценить качество фото: {e}")
+        return None
+    PHOTO_QUALITY_CHECKS.inc(report.verdict)
+    logger.info(
+        f"Качество фото: {report.verdict}, {report.width}x{report.height}, "
+        f"резкость {report.sharpness:.1f}, блики {report.glare:.3f}, "
+        f"белое {report.overexposed:.3f}, черное {report.dark:.3f}, {report.elapsed_ms:.1f} мс"
+    )
+    return report
@@ -0,0 +1,101 @@
+"""
+Реестр генераций в работе по пользователям
+
+Нетерпеливые пользователи нажимают "Начать генерацию" дважды или повторно
+отправляют текст правки, пока идет прогресс-бар. Каждое такое нажатие без
+реестра списывало баланс и отправляло в Gemini еще один полный запрос.
+
+Ключ идемпотентности строится из данных заказа (сообщение подтверждения,
+промпт, исходное фото). Повтор с тем же ключом присоединяется к уже идущей
+генерации - ее результат придет в тот же чат; другой заказ того же
+пользователя ждет завершения текущего.
+"""
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from metrics import DUPLICATE_GENERATIONS
+from supervision import GenerationRun
+
+
+def idempotency_key(*parts) -> str:
+    """Ключ заказа из его составляющих"""
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class InflightGeneration:
+    """Генерация пользователя, выполняющаяся прямо сейчас"""
+    key: str
+    kind: str
+    task: Optional[asyncio.Task] = None
+    started: float = field(default_factory=time.monotonic)
+    job_id: Optional[int] = None
+    run: Optional[GenerationRun] = None  # надзор генерации: через него работает кнопка "Отменить"
+    cancel_requested: bool = False  # "Отменить" нажата до запуска надзора
+    duplicates: int = 0
+
+    def attach(self, run: GenerationRun):
+        """Связывает запись с надзором; отмена, запрошенная раньше, выполняется сразу"""
+        self.run = run
+        if self.cancel_requested:
+            run.cancel()
+
+    def cancel(self) -> bool:
+        """
+        Отмена генерации кнопкой "Отменить".
+
+        Returns:
+            False, если результат уже получен и доставляется
+        """
+        if self.run is None:
+            self.cancel_requested = True
+            return True
+        return self.run.cancel()
+
+
+class InflightRegistry:
+    """Не более одной генерации на пользователя"""
+
+    def __init__(self):
+        self._by_user: Dict[int, InflightGeneration] = {}
+
+    def get(self, user_id: int) -> Optional[InflightGeneration]:
+        entry = self._by_user.get(user_id)
+        # Задача завершилась, не сняв запись (например, упала до finally) - запись устарела
+        if entry is not None and entry.task is not None and entry.task.done():
+            del self._by_user[user_id]
+            return None
+        return entry
+
+    def acquire(self, user_id: int, key: str, kind: str) -> Tuple[InflightGeneration, bool]:
+        """
+        Регистрирует генерацию текущей задачи.
+
+        Вызов синхронный: между проверкой и регистрацией нет await, поэтому
+        два одновременных апдейта не могут оба получить запись.
+
+        Returns:
+            (запись, True) для новой генерации или (уже идущая запись, False)
+        """
+        existing = self.get(user_id)
+        if existing is not None:
+            existing.duplicates += 1
+            DUPLICATE_GENERATIONS.inc(kind, "attached" if existing.key == key else "busy")
+            return existing, False
+        entry = InflightGeneration(key=key, kind=kind, task=asyncio.current_task())
+        self._by_user[user_id] = entry
+        return entry, True
+
+    def release(self, user_id: int, entry: InflightGeneration):
+        """Снимает запись, если она все еще принадлежит этой генерации"""
+        if self._by_user.get(user_id) is entry:
+            del self._by_user[user_id]
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+
+inflight = InflightRegistry()
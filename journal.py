@@ -0,0 +1,174 @@
+"""
+Восстановление незавершенных генераций после перезапуска
+
+Каждая платная генерация проходит по журналу generation_jobs:
+reserved → submitted → succeeded/failed → delivered/refunded.
+При старте бот разбирает задания, не дошедшие до конечного состояния:
+
+- succeeded: результат уже в хранилище медиа - доставляем повторно,
+  без обращения к Gemini; если результат пропал - возвращаем баланс;
+- reserved: запрос не уходил в Gemini - выполняем генерацию заново;
+- submitted/failed: исход запроса неизвестен или неуспешен - возвращаем
+  баланс, чтобы не платить за повторный запрос к Gemini дважды.
+
+Если в работающем боте не удалось закодировать или отправить уже
+полученный результат, schedule_redelivery повторяет доставку из хранилища
+медиа, не дожидаясь перезапуска.
+"""
+import asyncio
+from typing import Any, Dict, List, Set
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+
+import analytics
+import costs
+from config import logger
+from database import Database
+from gemini_api import call_gemini_api
+from image_encoder import encode_for_telegram
+from lifecycle import lifecycle
+from media_store import media_store
+from models import JobState
+from scheduling import generation_scheduler, priority_class
+
+RECOVERED_CAPTION = "✨ Генерация завершена после перезапуска бота!"
+REFUND_NOTICE = "⛔ Генерация была прервана перезапуском бота. Ваш баланс был возвращен."
+RESULT_LOST_NOTICE = "⛔ Результат генерации не удалось сохранить. Ваш баланс был возвращен."
+REDELIVERED_CAPTION = "✨ Генерация завершена успешно!"
+REDELIVERY_NOTICE = (
+    "⏳ Изображение готово и сохранено, но отправить его не удалось.\n\n"
+    "Мы повторим отправку автоматически, повторно баланс не списывается."
+)
+
+# Паузы перед повторными попытками доставки, секунды; после последней
+# неудачи результат доставит восстановление при перезапуске
+REDELIVERY_DELAYS = (5, 30, 120)
+
+_redeliveries: Set[asyncio.Task] = set()
+
+
+async def _deliver(bot: Bot, db: Database, job: Dict[str, Any], image_bytes: bytes,
+                   caption: str = RECOVERED_CAPTION):
+    """Отправляет результат задания и отмечает его доставленным"""
+    encoded = await asyncio.to_thread(encode_for_telegram, image_bytes)
+    await bot.send_photo(
+        job["chat_id"],
+        BufferedInputFile(encoded.data, filename="generated_fashion.jpg"),
+        caption=caption
+    )
+    db.transition_job(job["id"], JobState.DELIVERED)
+
+
+async def _refund(bot: Bot, db: Database, job: Dict[str, Any], reason: str, notice: str = REFUND_NOTICE):
+    if db.refund_job(job["id"], reason):
+        try:
+            await bot.send_message(job["chat_id"], notice)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить о возврате по заданию {job['id']}: {e}")
+
+
+async def _generate(db: Database, job: Dict[str, Any]) -> bytes:
+    """Запрос к Gemini по заданию в слоте его класса приоритета, с учетом расходов"""
+    priority = priority_class(job["kind"], db.has_paid(job["user_id"]))
+    if generation_scheduler:
+        await generation_scheduler.acquire(priority)
+    try:
+        with costs.collect() as calls:
+            try:
+                return await call_gemini_api(media_store.path(job["input_hash"]), job["prompt"])
+            finally:
+                db.record_gemini_calls(job["id"], calls, analytics.category(job["params"]))
+    finally:
+        if generation_scheduler:
+            generation_scheduler.release(priority)
+
+
+async def _deliver_stored(bot: Bot, db: Database, job: Dict[str, Any], caption: str = RECOVERED_CAPTION) -> bool:
+    """Доставляет результат задания succeeded из хранилища медиа; False - результат потерян"""
+    if media_store.exists(job["output_hash"]):
+        image_bytes = await asyncio.to_thread(media_store.get, job["output_hash"])
+        await _deliver(bot, db, job, image_bytes, caption)
+        return True
+    else:
+        # Результат потерян: доставить нечего - возвращаем баланс
+        logger.error(f"Задание {job['id']}: результат {job['output_hash']} не найден в хранилище")
+        if db.transition_job(job["id"], JobState.FAILED, error="result lost"):
+            await _refund(bot, db, job, "recovery: result lost", RESULT_LOST_NOTICE)
+        return False
+
+
+async def _recover_job(bot: Bot, db: Database, job: Dict[str, Any]):
+    state = JobState(job["state"])
+
+    if state == JobState.SUCCEEDED:
+        await _deliver_stored(bot, db, job)
+        return
+
+    if state == JobState.RESERVED and media_store.exists(job["input_hash"]):
+        if not db.transition_job(job["id"], JobState.SUBMITTED):
+            return
+        try:
+            image_bytes = await _generate(db, job)
+        except Exception as e:
+            await _refund(bot, db, job, f"recovery: {e}")
+            return
+        output_hash = await asyncio.to_thread(media_store.put, image_bytes)
+        db.transition_job(job["id"], JobState.SUCCEEDED, output_hash=output_hash)
+        await _deliver(bot, db, job, image_bytes)
+        return
+
+    await _refund(bot, db, job, "interrupted by restart")
+
+
+async def _redeliver(bot: Bot, db: Database, job_id: int):
+    for attempt, delay in enumerate(REDELIVERY_DELAYS, 1):
+        await asyncio.sleep(delay)
+        job = db.get_job(job_id)
+        if job is None or job["state"] != JobState.SUCCEEDED.value:
+            return
+        try:
+            if await _deliver_stored(bot, db, job, REDELIVERED_CAPTION):
+                logger.info(f"Задание {job_id}: результат доставлен повторно (попытка {attempt})")
+            return
+        except Exception as e:
+            logger.warning(f"Задание {job_id}: повторная доставка не удалась (попытка {attempt}): {e}")
+    logger.error(f"Задание {job_id}: результат не доставлен, его отправит восстановление при перезапуске")
+
+
+def schedule_redelivery(bot: Bot, db: Database, job_id: int) -> bool:
+    """
+    Повторяет в фоне доставку результата задания, если оно в состоянии
+    succeeded (результат получен, но не отправлен).
+
+    Returns:
+        True, если доставка запланирована - пользователю не нужно
+        предлагать повторную платную генерацию
+    """
+    job = db.get_job(job_id)
+    if job is None or job["state"] != JobState.SUCCEEDED.value:
+        return False
+    task = asyncio.create_task(_redeliver(bot, db, job_id), name=f"redeliver_{job_id}")
+    _redeliveries.add(task)
+    task.add_done_callback(_redeliveries.discard)
+    return True
+
+
+async def recover_unfinished_jobs(bot: Bot, db: Database, jobs: List[Dict[str, Any]]):
+    """
+    Разбирает незавершенные задания (список берется из БД до начала polling).
+
+    Выполняется в фоне как генерация в работе: при остановке бота
+    дожидается или отменяется вместе с остальными генерациями.
+    """
+    if not jobs:
+        return
+    logger.info(f"🔁 Восстановление {len(jobs)} незавершенных генераций")
+    async with lifecycle.generation():
+        for job in jobs:
+            try:
+                await _recover_job(bot, db, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка восстановления задания {job['id']}: {e}")
@@ -0,0 +1,100 @@
+"""
+Жизненный цикл бота: корректная остановка с дожиданием генераций
+
+При SIGTERM aiogram останавливает polling и вызывает хуки dp.shutdown до
+закрытия сессии бота. В этом хуке менеджер перестает принимать новые
+генерации, ждет текущие до дедлайна, отменяет оставшиеся (их хэндлеры
+возвращают баланс), сбрасывает буферизованные записи и удаляет временные
+медиафайлы.
+"""
+import asyncio
+import inspect
+import os
+from contextlib import asynccontextmanager
+from typing import Callable, List, Set
+
+from config import SHUTDOWN_DRAIN_TIMEOUT, logger
+from metrics import GENERATIONS_IN_FLIGHT
+
+
+class LifecycleManager:
+    """Учет генераций в работе и временных файлов процесса"""
+
+    def __init__(self, drain_timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self._inflight: Set[asyncio.Task] = set()
+        self._temp_files: Set[str] = set()
+        self._flush_callbacks: List[Callable] = []
+
+    @asynccontextmanager
+    async def generation(self):
+        """Регистрирует текущую задачу как генерацию в работе"""
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        GENERATIONS_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            self._inflight.discard(task)
+            GENERATIONS_IN_FLIGHT.dec()
+
+    @property
+    def inflight_count(self) -> int:
+        return len(self._inflight)
+
+    def track_temp_file(self, path: str):
+        """Запоминает временный файл для удаления при остановке"""
+        self._temp_files.add(path)
+
+    def remove_temp_file(self, path: str):
+        """Удаляет временный файл и снимает его с учета"""
+        self._temp_files.discard(path)
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+    def register_flush(self, callback: Callable):
+        """
+        Регистрирует сброс буферизованных записей при остановке.
+
+        Вызывается после дожидания генераций; может быть sync или async.
+        """
+        self._flush_callbacks.append(callback)
+
+    async def shutdown(self):
+        """Хук dp.shutdown: дожидается генераций, возвращает баланс за отмененные"""
+        self.accepting = False
+        pending = {task for task in self._inflight if not task.done()}
+        if pending:
+            logger.info(
+                f"⏳ Остановка: ожидание {len(pending)} генераций "
+                f"(не более {self.drain_timeout:g} с)"
+            )
+            _, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+
+        if pending:
+            logger.warning(f"⛔ Отмена {len(pending)} генераций по дедлайну остановки")
+            for task in pending:
+                task.cancel()
+            # Хэндлеры обрабатывают CancelledError: возврат баланса и уведомление
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        for callback in self._flush_callbacks:
+            try:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Ошибка сброса данных при остановке: {e}")
+
+        removed = 0
+        for path in list(self._temp_files):
+            try:
+                self.remove_temp_file(path)
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить временный файл {path}: {e}")
+        logger.info(f"👋 Остановка завершена, удалено временных файлов: {removed}")
+
+
+lifecycle = LifecycleManager()
@@ -0,0 +1,140 @@
+"""
+Контентно-адресуемое хранилище медиа
+
+Входные и выходные изображения генераций хранятся по SHA-256 содержимого.
+Журнал generation_jobs ссылается на хэши, поэтому повторная доставка
+результата после сбоя берет байты отсюда и не вызывает Gemini повторно.
+
+Файлы нужны, пока задание не доставлено или не возвращено и пока на них
+ссылается сессия правок. Фоновая очистка (run_media_sweeper) удаляет
+файлы, к которым не обращались дольше MEDIA_STORE_TTL, кроме входов и
+результатов незавершенных заданий и открытых сессий правок. Повторная
+запись того же содержимого продлевает срок хранения файла.
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from typing import Optional, Set, Tuple
+
+from config import MEDIA_STORE_DIR, MEDIA_STORE_SWEEP_INTERVAL, MEDIA_STORE_TTL, logger
+from metrics import REGISTRY
+
+SWEPT_FILES = REGISTRY.counter(
+    "media_store_swept_files_total",
+    "Файлы хранилища медиа, удаленные по сроку хранения"
+)
+SWEPT_BYTES = REGISTRY.counter(
+    "media_store_swept_bytes_total",
+    "Место на диске, освобожденное очисткой хранилища медиа"
+)
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 содержимого в hex"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class MediaStore:
+    """Файлы вида <root>/<2 символа хэша>/<хэш>"""
+
+    def __init__(self, root: str = MEDIA_STORE_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: Optional[str]) -> bool:
+        return bool(digest) and os.path.exists(self.path(digest))
+
+    def put(self, data: bytes) -> str:
+        """
+        Сохраняет байты и возвращает их хэш.
+
+        Запись атомарна (временный файл + rename), повторная запись того же
+        содержимого только продлевает срок хранения файла. Блокирующий вызов:
+        через asyncio.to_thread.
+        """
+        digest = content_hash(data)
+        target = self.path(digest)
+        try:
+            os.utime(target)
+            return digest
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def delete(self, digest: str):
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def sweep(self, max_age: float, keep: Set[str]) -> Tuple[int, int]:
+        """
+        Удаляет файлы (в том числе брошенные временные), не изменявшиеся
+        дольше max_age секунд, кроме хэшей keep. Блокирующий вызов: через
+        asyncio.to_thread.
+
+        Returns:
+            (удалено файлов, освобождено байт)
+        """
+        if not os.path.isdir(self.root):
+            return 0, 0
+        deadline = time.time() - max_age
+        files = size = 0
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name in keep:
+                    continue
+                try:
+                    stat = entry.stat()
+                    if stat.st_mtime >= deadline:
+                        continue
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    continue
+                files += 1
+                size += stat.st_size
+        return files, size
+
+
+media_store = MediaStore()
+
+
+async def run_media_sweeper(db, interval: float = MEDIA_STORE_SWEEP_INTERVAL):
+    """Фоновая задача: периодически удаляет из хранилища медиа файлы, которые больше не нужны"""
+    # edit_sessions импортирует этот модуль (через source_uploads)
+    from edit_sessions import edit_sessions
+
+    if MEDIA_STORE_TTL <= 0:
+        return
+    while True:
+        try:
+            keep = edit_sessions.media_hashes()
+            for job in await asyncio.to_thread(db.get_unfinished_jobs):
+                keep.update(filter(None, (job["input_hash"], job["output_hash"])))
+            files, size = await asyncio.to_thread(media_store.sweep, MEDIA_STORE_TTL, keep)
+            if files:
+                SWEPT_FILES.inc(amount=files)
+                SWEPT_BYTES.inc(amount=size)
+                logger.info(f"🧹 Из хранилища медиа удалено файлов: {files} ({size / 1024 / 1024:.1f} МБ)")
+        except Exception as e:
+            logger.error(f"Ошибка очистки хранилища медиа: {e}")
+        await asyncio.sleep(interval)
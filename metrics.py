@@ -0,0 +1,408 @@
+"""
+Метрики бота в формате Prometheus
+
+Счетчики, gauge и гистограммы обновляются без блокировок: каждое обновление -
+это одна операция над списком или словарем, атомарная под GIL. Небольшие гонки
+между потоками при инкременте допустимы для метрик и не стоят цены мьютекса
+на горячем пути.
+"""
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import costs
+import tracing
+from config import logger
+
+# Бакеты по умолчанию (секунды): от быстрых кликов меню до долгих генераций
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+# Бакеты для размеров payload (байты): от 1 КБ до 16 МБ
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))
+
+
+def _escape_label(value: str) -> str:
+    """Экранирует значение метки по формату Prometheus: \\, \" и перевод строки"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Формирует блок меток вида {a="1",b="2"}"""
+    pairs = [
+        f'{name}="{_escape_label(str(value))}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """Базовый класс метрики с набором меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            # Метрика без меток видна в выдаче сразу, даже с нулевым значением
+            self._children[()] = self._new_child()
+
+    def _child(self, labels: Tuple[str, ...]):
+        child = self._children.get(labels)
+        if child is None:
+            # setdefault атомарен: при гонке оба потока получат один объект
+            child = self._children.setdefault(labels, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получено {labels}")
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for labels, child in list(self._children.items()):
+            lines.extend(self._render_child(labels, child))
+        return lines
+
+    def _render_child(self, labels, child) -> Iterable[str]:
+        yield f"{self.name}{_format_labels(self.labelnames, labels)} {child[0]}"
+
+
+class Counter(_Metric):
+    """Монотонно возрастающий счетчик"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return [0]
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._child(self._key(labels))[0] += amount
+
+
+class Gauge(_Metric):
+    """Значение, которое может расти и уменьшаться"""
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return [0]
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._child(self._key(labels))[0] += amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self._child(self._key(labels))[0] -= amount
+
+    def set(self, value: float, *labels: str):
+        self._child(self._key(labels))[0] = value
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными бакетами"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        # [счетчики по бакетам (+Inf последний), сумма, количество]
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value: float, *labels: str):
+        child = self._child(self._key(labels))
+        # Храним некумулятивные значения, накопление делается при выдаче
+        child[0][bisect_left(self.buckets, value)] += 1
+        child[1] += value
+        child[2] += 1
+
+    def _render_child(self, labels, child) -> Iterable[str]:
+        counts, total_sum, total_count = child
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            label_block = _format_labels(self.labelnames, labels, f'le="{le}"')
+            yield f"{self.name}_bucket{label_block} {cumulative}"
+        label_block = _format_labels(self.labelnames, labels)
+        yield f"{self.name}_sum{label_block} {total_sum}"
+        yield f"{self.name}_count{label_block} {total_count}"
+
+
+class Registry:
+    """Реестр метрик процесса"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Выдает все метрики в текстовом формате Prometheus"""
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    "bot_handler_duration_seconds",
+    "Время выполнения хэндлера",
+    ("handler", "event", "status")
+)
+UPDATES_IN_PROGRESS = REGISTRY.gauge(
+    "bot_updates_in_progress",
+    "Апдейты, принятые диспетчером и еще не обработанные (глубина очереди)"
+)
+GEMINI_LATENCY = REGISTRY.histogram(
+    "gemini_request_duration_seconds",
+    "Время запроса к Gemini API по исходу",
+    ("outcome",)
+)
+GEMINI_PAYLOAD_BYTES = REGISTRY.histogram(
+    "gemini_payload_bytes",
+    "Размер данных запроса и ответа Gemini API",
+    ("direction",),
+    buckets=SIZE_BUCKETS
+)
+GEMINI_TOKENS = REGISTRY.counter(
+    "gemini_tokens_total",
+    "Токены запросов к Gemini API по usageMetadata (input, output)",
+    ("direction",)
+)
+DB_QUERY_LATENCY = REGISTRY.histogram(
+    "db_query_duration_seconds",
+    "Время выполнения методов Database",
+    ("method",)
+)
+TELEGRAM_API_CALLS = REGISTRY.counter(
+    "telegram_api_calls_total",
+    "Вызовы Telegram Bot API",
+    ("method", "status")
+)
+TELEGRAM_RATE_LIMITED = REGISTRY.counter(
+    "telegram_api_rate_limited_total",
+    "Ответы 429 (flood control) от Telegram Bot API",
+    ("method",)
+)
+GENERATIONS_IN_FLIGHT = REGISTRY.gauge(
+    "generations_in_flight",
+    "Генерации, выполняющиеся прямо сейчас"
+)
+GENERATION_STAGE_LATENCY = REGISTRY.histogram(
+    "generation_stage_duration_seconds",
+    "Время этапов генерации (preprocess, queue, upload, model, encode, send) по исходу",
+    ("stage", "outcome")
+)
+DUPLICATE_GENERATIONS = REGISTRY.counter(
+    "duplicate_generations_total",
+    "Повторные запуски генерации, пока предыдущая еще идет (attached - тот же заказ, busy - другой)",
+    ("kind", "result")
+)
+PHOTO_QUALITY_CHECKS = REGISTRY.counter(
+    "photo_quality_checks_total",
+    "Проверки качества входного фото по итогу (ok, warn, reject)",
+    ("verdict",)
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "cache_lookups_total",
+    "Обращения к кэшам (hit/miss), доля попаданий считается в Prometheus",
+    ("cache", "result")
+)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    """Учитывает попадание или промах кэша"""
+    CACHE_LOOKUPS.inc(cache, "hit" if hit else "miss")
+
+
+def timed_db_method(func):
+    """Декоратор: замеряет время метода Database"""
+    name = func.__name__
+
+    span_name = f"db.{name}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with tracing.span(span_name):
+                return func(*args, **kwargs)
+        finally:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+def _handler_name(data: dict) -> str:
+    handler = data.get("handler")
+    callback = getattr(handler, "callback", None)
+    return getattr(callback, "__name__", "unknown")
+
+
+async def handler_metrics_middleware(handler, event, data):
+    """Middleware: гистограмма задержек по хэндлерам"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        return await handler(event, data)
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        HANDLER_LATENCY.observe(
+            time.perf_counter() - started,
+            _handler_name(data),
+            type(event).__name__,
+            status
+        )
+
+
+async def update_metrics_middleware(handler, event, data):
+    """Outer middleware апдейтов: считает апдейты в обработке"""
+    UPDATES_IN_PROGRESS.inc()
+    try:
+        return await handler(event, data)
+    finally:
+        UPDATES_IN_PROGRESS.dec()
+
+
+class TelegramMetricsMiddleware:
+    """Request middleware сессии бота: счетчики вызовов Bot API и 429"""
+
+    async def __call__(self, make_request, bot, method):
+        from aiogram.exceptions import TelegramRetryAfter
+
+        api_method = type(method).__name__
+        try:
+            response = await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_RATE_LIMITED.inc(api_method)
+            TELEGRAM_API_CALLS.inc(api_method, "429")
+            raise
+        except Exception:
+            TELEGRAM_API_CALLS.inc(api_method, "error")
+            raise
+        TELEGRAM_API_CALLS.inc(api_method, "ok")
+        return response
+
+
+class HealthState:
+    """Флаги живости и готовности для health-эндпоинтов"""
+
+    def __init__(self):
+        self.ready = False
+        self.started_at = time.time()
+
+    def mark_ready(self):
+        self.ready = True
+
+    def mark_not_ready(self):
+        self.ready = False
+
+
+health = HealthState()
+
+
+async def start_metrics_server(host: str, port: int):
+    """
+    Запускает HTTP-сервер с /metrics, /healthz и /readyz.
+
+    Args:
+        host: Адрес для прослушивания (по умолчанию только локальный)
+        port: Порт
+
+    Returns:
+        AppRunner, который нужно остановить через cleanup() при завершении
+    """
+    from aiohttp import web
+
+    async def metrics_view(request):
+        return web.Response(
+            text=REGISTRY.render(),
+            content_type="text/plain",
+            charset="utf-8",
+            headers={"X-Prometheus-Format": "0.0.4"}
+        )
+
+    async def health_view(request):
+        uptime = time.time() - health.started_at
+        return web.json_response({"status": "ok", "uptime_seconds": round(uptime, 1)})
+
+    async def ready_view(request):
+        if health.ready:
+            return web.json_response({"status": "ready"})
+        return web.json_response({"status": "starting"}, status=503)
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    app.router.add_get("/healthz", health_view)
+    app.router.add_get("/readyz", ready_view)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+def observe_gemini_call(
+    started: float,
+    outcome: str,
+    request_bytes: int = 0,
+    response_bytes: Optional[int] = None,
+    usage: Optional[costs.Usage] = None
+):
+    """Фиксирует задержку, размеры и токены одного запроса к Gemini (и для учета расходов)"""
+    latency = time.perf_counter() - started
+    GEMINI_LATENCY.observe(latency, outcome)
+    if request_bytes:
+        GEMINI_PAYLOAD_BYTES.observe(request_bytes, "request")
+    if response_bytes is not None:
+        GEMINI_PAYLOAD_BYTES.observe(response_bytes, "response")
+    if usage is not None:
+        GEMINI_TOKENS.inc("input", amount=usage.input_tokens)
+        GEMINI_TOKENS.inc("output", amount=usage.output_tokens)
+    costs.observe(outcome, latency, request_bytes, response_bytes, usage)
@@ -0,0 +1,58 @@
+"""
+Пользователи, журнал заданий генерации и журнал движений баланса
+"""
+
+
+def is_applied(ctx) -> bool:
+    return all(ctx.table_exists(table) for table in ("users", "generation_jobs", "balance_ledger"))
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                full_name TEXT,
+                balance INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Журнал заданий генерации: связывает списание с исходом
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generation_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                state TEXT NOT NULL,
+                cost INTEGER NOT NULL DEFAULT 0,
+                prompt TEXT,
+                input_hash TEXT,
+                output_hash TEXT,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_generation_jobs_state ON generation_jobs (state)'
+        )
+
+        # Журнал движений баланса
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                job_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id)'
+        )
@@ -0,0 +1,137 @@
+"""
+Генерации как ссылка на шаблон промпта и строка параметров, архив генераций
+
+Таблица generations прежнего формата (полный текст промпта в каждой
+строке) переименовывается в generations_legacy и переносится пачками:
+параметры из готового текста не восстановить, поэтому каждый различный
+текст становится шаблоном LEGACY (тексты повторяются), а правка
+отделяется в additions. Место, освобожденное старой таблицей,
+возвращает python migrator.py --vacuum.
+"""
+from config import logger
+from media_store import content_hash
+from prompt_templates import ADDITIONS_MARKER, LEGACY
+
+TABLES = (
+    "prompt_templates",
+    "generations",
+    "generation_drafts",
+    "generation_archive",
+    "generation_archive_users",
+)
+
+
+def is_applied(ctx) -> bool:
+    return (
+        all(ctx.table_exists(table) for table in TABLES)
+        and "prompt" not in ctx.columns("generations")
+        and not ctx.table_exists("generations_legacy")
+    )
+
+
+def _create_tables(cursor):
+    # Тексты шаблонов промптов; генерации ссылаются на них по id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS prompt_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            digest TEXT NOT NULL UNIQUE,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Подтвержденные генерации: шаблон, параметры анкеты и текст правки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            template_id INTEGER NOT NULL,
+            params TEXT NOT NULL DEFAULT '',
+            additions TEXT,
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (template_id) REFERENCES prompt_templates (id)
+        )
+    ''')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_generations_user ON generations (user_id)'
+    )
+
+    # Последняя неподтвержденная анкета пользователя (одна строка на пользователя)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_drafts (
+            user_id INTEGER PRIMARY KEY,
+            template_id INTEGER NOT NULL,
+            params TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Сжатые сегменты старых генераций (см. generation_archive)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            first_created TIMESTAMP,
+            last_created TIMESTAMP,
+            rows INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_archive_users (
+            user_id INTEGER NOT NULL,
+            segment_id INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            PRIMARY KEY (user_id, segment_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _legacy_template_id(cursor, text: str) -> int:
+    digest = content_hash(f"{LEGACY}\n{text}".encode())
+    cursor.execute(
+        'INSERT OR IGNORE INTO prompt_templates (name, digest, text) VALUES (?, ?, ?)',
+        (LEGACY, digest, text)
+    )
+    cursor.execute('SELECT id FROM prompt_templates WHERE digest = ?', (digest,))
+    return cursor.fetchone()[0]
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        if ctx.table_exists("generations") and "prompt" in ctx.columns("generations"):
+            cursor.execute('ALTER TABLE generations RENAME TO generations_legacy')
+        _create_tables(cursor)
+
+    if not ctx.table_exists("generations_legacy"):
+        return
+
+    template_ids = {}
+
+    def copy(cursor, rows):
+        generations = []
+        for generation_id, user_id, prompt, created_at in rows:
+            base, _, additions = (prompt or "").partition(ADDITIONS_MARKER)
+            if base not in template_ids:
+                template_ids[base] = _legacy_template_id(cursor, base)
+            generations.append((generation_id, user_id, template_ids[base], additions or None, created_at))
+        cursor.executemany(
+            '''INSERT INTO generations (id, user_id, template_id, additions, created_at)
+               VALUES (?, ?, ?, ?, ?)''',
+            generations
+        )
+
+    ctx.batched(
+        "copy_legacy",
+        '''SELECT id, user_id, prompt, created_at FROM generations_legacy
+           WHERE id > :after ORDER BY id LIMIT :limit''',
+        copy,
+        total_query='SELECT COUNT(*) FROM generations_legacy'
+    )
+    ctx.step("drop_legacy", lambda cursor: cursor.execute('DROP TABLE generations_legacy'))
+    logger.info("ℹ️ Место прежней таблицы generations вернет python migrator.py --vacuum (при остановленном боте)")
@@ -0,0 +1,108 @@
+"""
+Сводки для /stats и их заполнение по накопленным данным
+
+Бесплатные генерации и пополнения раньше не записывались, поэтому
+история по ним начинается с момента появления сводок.
+"""
+from collections import Counter
+
+from analytics import (
+    BALANCE,
+    DELIVERIES,
+    EDITS,
+    FAILURES,
+    GENERATIONS,
+    NEW_USERS,
+    REFUND_ERROR,
+    REFUNDS,
+    category,
+    refund_reason
+)
+from generation_archive import unpack_segment
+
+_UPSERT_SQL = '''
+    INSERT INTO stats_rollups (period, bucket, metric, dim, value) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (period, bucket, metric, dim) DO UPDATE SET value = value + excluded.value
+'''
+
+
+def is_applied(ctx) -> bool:
+    return ctx.table_exists("stats_rollups")
+
+
+def _store(cursor, events):
+    """Добавляет события (created_at, метрика, измерение) к строкам часа, дня и итога"""
+    counts = Counter()
+    for created_at, metric, dim in events:
+        if created_at:
+            counts[("hour", created_at[:13] + ":00", metric, dim)] += 1
+            counts[("day", created_at[:10], metric, dim)] += 1
+        counts[("total", "", metric, dim)] += 1
+    cursor.executemany(_UPSERT_SQL, [(*key, value) for key, value in counts.items()])
+
+
+def _generation_event(params, additions, created_at):
+    return created_at, EDITS if additions else GENERATIONS, category(params)
+
+
+def _job_events(rows):
+    for _, state, error, updated_at in rows:
+        if state == "delivered":
+            yield updated_at, DELIVERIES, ""
+            continue
+        reason = refund_reason(error)
+        yield updated_at, REFUNDS, reason
+        if reason == REFUND_ERROR:
+            yield updated_at, FAILURES, ""
+
+
+def _store_balance(cursor):
+    cursor.execute('SELECT COALESCE(SUM(balance), 0) FROM users')
+    balance = cursor.fetchone()[0]
+    if balance:
+        cursor.execute(_UPSERT_SQL, ("total", "", BALANCE, "", balance))
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_rollups (
+                period TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                dim TEXT NOT NULL DEFAULT '',
+                value INTEGER NOT NULL,
+                PRIMARY KEY (period, bucket, metric, dim)
+            ) WITHOUT ROWID
+        ''')
+
+    ctx.batched(
+        "users",
+        'SELECT user_id, created_at FROM users WHERE user_id > :after ORDER BY user_id LIMIT :limit',
+        lambda cursor, rows: _store(cursor, ((created_at, NEW_USERS, "") for _, created_at in rows)),
+        total_query='SELECT COUNT(*) FROM users'
+    )
+    # Сегмент архива - до GENERATION_ARCHIVE_SEGMENT_ROWS строк: по одному за транзакцию
+    ctx.batched(
+        "archived_generations",
+        'SELECT id, data FROM generation_archive WHERE id > :after ORDER BY id LIMIT :limit',
+        lambda cursor, rows: _store(cursor, (
+            _generation_event(params, additions, created_at)
+            for _, data in rows
+            for _, _, _, params, additions, _, created_at in unpack_segment(data)
+        )),
+        batch_size=1
+    )
+    ctx.batched(
+        "generations",
+        'SELECT id, params, additions, created_at FROM generations WHERE id > :after ORDER BY id LIMIT :limit',
+        lambda cursor, rows: _store(cursor, (_generation_event(*row[1:]) for row in rows)),
+        total_query='SELECT COUNT(*) FROM generations'
+    )
+    ctx.batched(
+        "jobs",
+        '''SELECT id, state, error, updated_at FROM generation_jobs
+           WHERE id > :after AND state IN ('delivered', 'refunded') ORDER BY id LIMIT :limit''',
+        lambda cursor, rows: _store(cursor, _job_events(rows))
+    )
+    ctx.step("balance", _store_balance)
@@ -0,0 +1,25 @@
+"""
+Пачки массового пополнения (/bulk_credit): batch_id в журнале баланса
+и таблица примененных пачек
+"""
+
+
+def is_applied(ctx) -> bool:
+    return ctx.table_exists("credit_batches") and "batch_id" in ctx.columns("balance_ledger")
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        if "batch_id" not in ctx.columns("balance_ledger"):
+            cursor.execute('ALTER TABLE balance_ledger ADD COLUMN batch_id TEXT')
+
+        # Примененные пачки массового пополнения (идемпотентность /bulk_credit)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS credit_batches (
+                batch_id TEXT PRIMARY KEY,
+                admin_id INTEGER,
+                rows INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
@@ -0,0 +1,33 @@
+"""
+Запросы к Gemini с токенами и стоимостью (учет расходов, см. costs)
+"""
+
+
+def is_applied(ctx) -> bool:
+    return ctx.table_exists("gemini_calls")
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gemini_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER,
+                user_id INTEGER,
+                kind TEXT,
+                category TEXT NOT NULL DEFAULT '',
+                model TEXT,
+                outcome TEXT NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                request_bytes INTEGER NOT NULL DEFAULT 0,
+                response_bytes INTEGER NOT NULL DEFAULT 0,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                image_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cost INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_gemini_calls_created ON gemini_calls (created_at)'
+        )
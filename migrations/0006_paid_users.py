@@ -0,0 +1,43 @@
+"""
+Признак платящего пользователя (users.paid) для приоритетного допуска
+генераций (см. scheduling)
+
+Пополнения через журнал баланса отмечены строками 'credit'. Пользователи,
+пополненные через /add_balance до появления журнала, таких строк не
+имеют: бесплатная генерация дает ровно одну генерацию, поэтому платящим
+считается и пользователь без записи о бесплатной генерации, у которого
+баланс вместе с историей генераций больше одной.
+"""
+
+_PAID_SQL = '''
+    UPDATE users SET paid = 1
+    WHERE user_id = ? AND (
+        EXISTS (SELECT 1 FROM balance_ledger l WHERE l.user_id = users.user_id AND l.reason = 'credit')
+        OR (
+            NOT EXISTS (
+                SELECT 1 FROM balance_ledger l WHERE l.user_id = users.user_id AND l.reason = 'free_trial'
+            )
+            AND balance
+                + (SELECT COUNT(*) FROM generations g WHERE g.user_id = users.user_id)
+                + (SELECT COALESCE(SUM(rows), 0) FROM generation_archive_users a WHERE a.user_id = users.user_id)
+                > 1
+        )
+    )
+'''
+
+
+def is_applied(ctx) -> bool:
+    return "paid" in ctx.columns("users")
+
+
+def upgrade(ctx):
+    with ctx.transaction() as cursor:
+        if "paid" not in ctx.columns("users"):
+            cursor.execute('ALTER TABLE users ADD COLUMN paid INTEGER NOT NULL DEFAULT 0')
+
+    ctx.batched(
+        "backfill",
+        'SELECT user_id FROM users WHERE user_id > :after ORDER BY user_id LIMIT :limit',
+        lambda cursor, rows: cursor.executemany(_PAID_SQL, rows),
+        total_query='SELECT COUNT(*) FROM users'
+    )
@@ -0,0 +1,363 @@
+"""
+Версионные миграции схемы БД
+
+Схема раньше создавалась через CREATE TABLE IF NOT EXISTS при каждом
+старте (Database._init_db), а изменения данных встраивались туда же и
+выполнялись одной транзакцией - на большой таблице generations это
+блокировало бы запись на минуты.
+
+Миграции - файлы migrations/NNNN_имя.py с функцией upgrade(ctx) и
+необязательной is_applied(ctx). Номер берется из имени файла; примененные
+версии записываются в таблицу schema_version, и каждая миграция
+выполняется один раз, по порядку номеров.
+
+Переносы данных идут пачками (MigrationContext.batched): каждая пачка -
+короткая транзакция, после которой прогресс сохраняется в
+schema_migration_progress, а писатели получают паузу
+MIGRATION_BATCH_PAUSE. Прерванная миграция продолжается с последней
+сохраненной пачки.
+
+Database применяет недостающие миграции при старте. Большую миграцию
+можно заранее выполнить на рабочей БД, не останавливая бота:
+
+    python migrator.py [--status] [--dry-run] [--batch-size N] [--pause S] [--vacuum]
+
+--dry-run выполняет миграции на копии БД и показывает, что и сколько
+строк было бы изменено. Построение индекса - одна инструкция SQLite и
+пачками не делится; миграции добавляют индексы до заполнения таблиц.
+"""
+import argparse
+import importlib.util
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Sequence, Set
+
+from config import DATABASE_PATH, MIGRATION_BATCH_PAUSE, MIGRATION_BATCH_SIZE, logger
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Как часто писать в лог прогресс пачек, секунды
+PROGRESS_LOG_INTERVAL = 5.0
+
+_MIGRATION_FILE_RE = re.compile(r"^(\d{4})_(\w+)\.py$")
+
+
+@dataclass
+class Migration:
+    """Файл миграции"""
+    version: int
+    name: str
+    path: str
+
+    def load(self):
+        spec = importlib.util.spec_from_file_location(f"migrations.m{self.version:04d}_{self.name}", self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+
+def discover(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    """Миграции по возрастанию номера (модули не импортируются)"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = _MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    migrations.sort(key=lambda migration: migration.version)
+    for previous, current in zip(migrations, migrations[1:]):
+        if previous.version == current.version:
+            raise ValueError(f"Две миграции с номером {current.version:04d}")
+    return migrations
+
+
+def latest_version(directory: str = MIGRATIONS_DIR) -> int:
+    migrations = discover(directory)
+    return migrations[-1].version if migrations else 0
+
+
+class MigrationContext:
+    """Подключение и вспомогательные методы, доступные миграции"""
+
+    def __init__(self, conn: sqlite3.Connection, version: int,
+                 batch_size: int = MIGRATION_BATCH_SIZE, pause: float = MIGRATION_BATCH_PAUSE):
+        self.conn = conn
+        self.version = version
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def table_exists(self, table: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        return row is not None
+
+    def columns(self, table: str) -> Set[str]:
+        return {column[1] for column in self.conn.execute(f'PRAGMA table_info({table})')}
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Короткая пишущая транзакция (BEGIN IMMEDIATE)"""
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def _progress(self, step: str):
+        row = self.conn.execute(
+            'SELECT position, rows_done FROM schema_migration_progress WHERE version = ? AND step = ?',
+            (self.version, step)
+        ).fetchone()
+        return row or (None, 0)
+
+    def _save_progress(self, cursor: sqlite3.Cursor, step: str, position: str, rows_done: int):
+        cursor.execute(
+            '''INSERT INTO schema_migration_progress (version, step, position, rows_done, updated_at)
+               VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+               ON CONFLICT (version, step) DO UPDATE SET
+                   position = excluded.position,
+                   rows_done = excluded.rows_done,
+                   updated_at = excluded.updated_at''',
+            (self.version, step, position, rows_done)
+        )
+
+    def step(self, step: str, apply: Callable[[sqlite3.Cursor], None]):
+        """Однократный шаг одной транзакцией; при повторном запуске пропускается"""
+        if self._progress(step)[0] == "done":
+            return
+        with self.transaction() as cursor:
+            apply(cursor)
+            self._save_progress(cursor, step, "done", 0)
+
+    def batched(
+        self,
+        step: str,
+        query: str,
+        apply: Callable[[sqlite3.Cursor, List[tuple]], None],
+        total_query: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        start: int = 0,
+    ) -> int:
+        """
+        Обрабатывает строки пачками с сохранением прогресса.
+
+        query - SELECT с параметрами :after и :limit, первая колонка -
+        целочисленный ключ, строки по возрастанию ключа, например
+        'SELECT id, ... FROM t WHERE id > :after ORDER BY id LIMIT :limit'.
+        apply(cursor, rows) записывает изменения пачки в той же транзакции.
+        total_query - необязательный COUNT(*) для процента в логе.
+
+        Returns:
+            сколько строк обработано шагом (с учетом прерванных запусков)
+        """
+        batch_size = batch_size or self.batch_size
+        position, rows_done = self._progress(step)
+        if position == "done":
+            return rows_done
+        after = start if position is None else int(position)
+        total = self.conn.execute(total_query).fetchone()[0] if total_query else None
+        logged_at = time.monotonic()
+        while True:
+            with self.transaction() as cursor:
+                rows = cursor.execute(query, {"after": after, "limit": batch_size}).fetchall()
+                if rows:
+                    apply(cursor, rows)
+                    after = rows[-1][0]
+                    rows_done += len(rows)
+                finished = len(rows) < batch_size
+                self._save_progress(cursor, step, "done" if finished else str(after), rows_done)
+            if finished:
+                break
+            if time.monotonic() - logged_at >= PROGRESS_LOG_INTERVAL:
+                logged_at = time.monotonic()
+                done = f"{rows_done}/{total} ({min(100, rows_done * 100 // total)}%)" if total else str(rows_done)
+                logger.info(f"⏳ Миграция {self.version:04d}, {step}: {done}")
+            if self.pause:
+                # Даем боту записать свое между пачками
+                time.sleep(self.pause)
+        logger.info(f"✅ Миграция {self.version:04d}, {step}: {rows_done} строк")
+        return rows_done
+
+
+def _ensure_tables(conn: sqlite3.Connection) -> bool:
+    """
+    Служебные таблицы миграций.
+
+    Returns:
+        True - schema_version создана сейчас в непустой БД (схема до версий)
+    """
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not existing:
+        # Страницы, освобожденные архивацией, возвращаются файловой системе;
+        # режим задается до первой таблицы и до перехода в WAL
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL: чтение (в том числе долгое, как /export) не блокирует запись.
+    # Режим сохраняется в файле БД
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migration_progress (
+            version INTEGER NOT NULL,
+            step TEXT NOT NULL,
+            position TEXT,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version, step)
+        )
+    ''')
+    return bool(existing) and "schema_version" not in existing
+
+
+def applied_versions(conn: sqlite3.Connection) -> Set[int]:
+    return {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+
+
+def migrate(
+    db_path: str = DATABASE_PATH,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+    pause: float = MIGRATION_BATCH_PAUSE,
+    migrations: Optional[Sequence[Migration]] = None,
+) -> List[Migration]:
+    """
+    Применяет недостающие миграции по порядку.
+
+    В БД, созданной до появления версий, миграция, изменения которой уже
+    есть в схеме (is_applied), только отмечается примененной.
+
+    Returns:
+        примененные миграции
+    """
+    migrations = discover() if migrations is None else migrations
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        unversioned = _ensure_tables(conn)
+        done = applied_versions(conn)
+        applied = []
+        for migration in migrations:
+            if migration.version in done:
+                continue
+            module = migration.load()
+            ctx = MigrationContext(conn, migration.version, batch_size, pause)
+            is_applied = getattr(module, "is_applied", None)
+            if unversioned and is_applied is not None and is_applied(ctx):
+                logger.info(f"✅ Миграция {migration.version:04d} {migration.name}: уже в схеме")
+            else:
+                logger.info(f"🔧 Миграция {migration.version:04d} {migration.name}...")
+                started = time.monotonic()
+                module.upgrade(ctx)
+                logger.info(f"✅ Миграция {migration.version:04d} {migration.name}: {time.monotonic() - started:.1f} с")
+                applied.append(migration)
+            with ctx.transaction() as cursor:
+                cursor.execute(
+                    'INSERT INTO schema_version (version, name) VALUES (?, ?)',
+                    (migration.version, migration.name)
+                )
+                cursor.execute('DELETE FROM schema_migration_progress WHERE version = ?', (migration.version,))
+        return applied
+    finally:
+        conn.close()
+
+
+def dry_run(db_path: str = DATABASE_PATH, batch_size: int = MIGRATION_BATCH_SIZE) -> List[Migration]:
+    """Выполняет миграции на временной копии БД; сама БД не меняется"""
+    fd, copy_path = tempfile.mkstemp(prefix="migration_dry_run_", suffix=".db")
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(copy_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        return migrate(copy_path, batch_size, pause=0)
+    finally:
+        for path in (copy_path, copy_path + "-wal", copy_path + "-shm"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def vacuum(db_path: str = DATABASE_PATH):
+    """
+    Пересобирает файл БД: возвращает место после миграций и включает
+    incremental_vacuum в БД, созданной без него. VACUUM блокирует БД на
+    все время работы - запускать, когда бот остановлен.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+def status(db_path: str = DATABASE_PATH) -> List[str]:
+    """Строки состояния миграций для вывода в консоль"""
+    lines = []
+    conn = sqlite3.connect(db_path)
+    try:
+        versioned = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        ).fetchone() is not None
+        applied = dict(
+            conn.execute('SELECT version, applied_at FROM schema_version')
+        ) if versioned else {}
+        progress = conn.execute(
+            'SELECT version, step, position, rows_done FROM schema_migration_progress ORDER BY version, step'
+        ).fetchall() if versioned else []
+    finally:
+        conn.close()
+    for migration in discover():
+        applied_at = applied.get(migration.version)
+        state = f"применена {applied_at}" if applied_at else "ожидает"
+        lines.append(f"{migration.version:04d} {migration.name}: {state}")
+        for version, step, position, rows_done in progress:
+            if version == migration.version:
+                lines.append(f"    {step}: {rows_done} строк{' (завершен)' if position == 'done' else ''}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы БД Fashion Bot")
+    parser.add_argument("--db", default=DATABASE_PATH, help="путь к БД")
+    parser.add_argument("--status", action="store_true", help="показать примененные и ожидающие миграции")
+    parser.add_argument("--dry-run", action="store_true", help="выполнить миграции на копии БД")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE, help="строк в пачке")
+    parser.add_argument("--pause", type=float, default=MIGRATION_BATCH_PAUSE, help="пауза между пачками, секунды")
+    parser.add_argument("--vacuum", action="store_true", help="после миграций пересобрать файл БД (бот остановлен)")
+    args = parser.parse_args()
+
+    if args.status:
+        print("\n".join(status(args.db)))
+        return
+    if args.dry_run:
+        applied = dry_run(args.db, args.batch_size)
+        print(f"Пробный запуск: было бы применено миграций - {len(applied)}")
+    else:
+        applied = migrate(args.db, args.batch_size, args.pause)
+        print(f"Применено миграций: {len(applied)}")
+    for migration in applied:
+        print(f"  {migration.version:04d} {migration.name}")
+    if args.vacuum and not args.dry_run:
+        vacuum(args.db)
+        print("Файл БД пересобран")
+
+
+if __name__ == "__main__":
+    main()
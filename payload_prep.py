@@ -0,0 +1,189 @@
+"""
+Подготовка запроса к Gemini, пока пользователь заполняет анкету
+
+После загрузки фото пользователь 20-60 секунд выбирает рост, локацию,
+возраст и т.д. - все это время фото просто лежит на диске. Подготовка
+запускается сразу в photo_handler: декодирование, нормализация (поворот по
+EXIF, RGB, ограничение стороны), хэш для журнала и base64-фрагмент JSON,
+а заодно прогрев соединения с Gemini и загрузка фото в File API (см.
+source_uploads). К моменту подтверждения остается склеить тело запроса
+с промптом.
+
+Подготовка привязана к пользователю: новое фото отменяет прежнюю, завершение
+или перезапуск сценария ее сбрасывают, а забытые записи истекают по TTL.
+"""
+import asyncio
+import io
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from config import GEMINI_INPUT_MAX_SIDE, PREPARED_PAYLOAD_TTL, logger
+from gemini_api import encode_image_part, ensure_connection
+from media_store import content_hash
+from metrics import record_cache_lookup
+from source_uploads import source_uploads
+import tracing
+
+
+@dataclass
+class PreparedPayload:
+    """Нормализованное входное фото и готовый фрагмент запроса"""
+    source_path: str
+    image_bytes: bytes
+    input_hash: str
+    image_part: bytes
+    width: int
+    height: int
+
+
+@dataclass
+class _Preparation:
+    source_path: str
+    task: asyncio.Task
+    created: float = field(default_factory=time.monotonic)
+
+
+def normalize_image(image_bytes: bytes, max_side: int = GEMINI_INPUT_MAX_SIDE):
+    """
+    Приводит фото к виду, в котором оно уходит в Gemini.
+
+    JPEG без поворота по EXIF и в пределах max_side возвращается как есть,
+    иначе фото поворачивается, приводится к RGB, уменьшается и
+    перекодируется. Функция CPU-bound: вызывать через asyncio.to_thread.
+
+    Returns:
+        (байты, ширина, высота)
+    """
+    from PIL import Image, ImageOps
+
+    img = Image.open(io.BytesIO(image_bytes))
+    orientation = img.getexif().get(0x0112, 1)
+    if img.format == "JPEG" and img.mode == "RGB" and orientation == 1 and max(img.size) <= max_side:
+        return image_bytes, img.width, img.height
+
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+    stream = io.BytesIO()
+    img.save(stream, format="JPEG", quality=92)
+    return stream.getvalue(), img.width, img.height
+
+
+def _prepare_sync(source_path: str) -> PreparedPayload:
+    with open(source_path, "rb") as f:
+        raw = f.read()
+    image_bytes, width, height = normalize_image(raw)
+    return PreparedPayload(
+        source_path=source_path,
+        image_bytes=image_bytes,
+        input_hash=content_hash(image_bytes),
+        image_part=encode_image_part(image_bytes),
+        width=width,
+        height=height
+    )
+
+
+def _log_failure(task: asyncio.Task):
+    # Забираем исключение, даже если результат так и не понадобится
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Ошибка фоновой подготовки запроса: {task.exception()}")
+
+
+class PayloadPreparer:
+    """Фоновые подготовки запросов, не более одной на пользователя"""
+
+    def __init__(self, ttl: float = PREPARED_PAYLOAD_TTL):
+        self.ttl = ttl
+        self._by_user: Dict[int, _Preparation] = {}
+
+    def start(self, user_id: int, source_path: str) -> asyncio.Task:
+        """Запускает подготовку фото пользователя, отменяя прежнюю"""
+        self.discard(user_id)
+        self._expire()
+        task = asyncio.create_task(self._prepare(source_path), name=f"prepare_payload_{user_id}")
+        task.add_done_callback(_log_failure)
+        self._by_user[user_id] = _Preparation(source_path, task)
+        return task
+
+    async def _prepare(self, source_path: str) -> PreparedPayload:
+        started = time.perf_counter()
+        with tracing.span("preprocess"):
+            prepared, _ = await asyncio.gather(
+                asyncio.to_thread(_prepare_sync, source_path),
+                ensure_connection()
+            )
+        source_uploads.ensure_uploaded(prepared.input_hash, prepared.image_bytes)
+        logger.debug(
+            f"Запрос подготовлен за {(time.perf_counter() - started) * 1000:.0f} мс: "
+            f"{prepared.width}x{prepared.height}, {len(prepared.image_part)} байт"
+        )
+        return prepared
+
+    async def get(self, user_id: int, source_path: str, timeout: Optional[float] = None) -> Optional[PreparedPayload]:
+        """
+        Результат подготовки для этого фото; если она еще идет - дожидается
+        не дольше timeout секунд.
+
+        Returns:
+            None, если подготовки нет, она для другого фото, завершилась
+            ошибкой или не успела - тогда запрос собирается обычным путем
+        """
+        preparation = self._by_user.get(user_id)
+        if preparation is None or preparation.source_path != source_path:
+            record_cache_lookup("prepared_payload", False)
+            return None
+        try:
+            # shield: ни отмена хэндлера, ни таймаут не отменяют подготовку для следующей правки
+            prepared = await asyncio.wait_for(asyncio.shield(preparation.task), timeout)
+        except TimeoutError:
+            logger.warning(f"Подготовка запроса не уложилась в {timeout:.0f} с, собираем запрос на месте")
+            record_cache_lookup("prepared_payload", False)
+            return None
+        except asyncio.CancelledError:
+            if preparation.task.cancelled():
+                record_cache_lookup("prepared_payload", False)
+                return None
+            raise
+        except Exception:
+            # Ошибка уже записана в лог колбэком задачи
+            record_cache_lookup("prepared_payload", False)
+            return None
+        record_cache_lookup("prepared_payload", True)
+        return prepared
+
+    def discard(self, user_id: int) -> int:
+        """
+        Сбрасывает подготовку пользователя (сценарий завершен или начат заново).
+
+        Returns:
+            сколько байт занимал готовый запрос (0 - подготовки не было или она не завершилась)
+        """
+        preparation = self._by_user.pop(user_id, None)
+        if preparation is None:
+            return 0
+        if not preparation.task.done():
+            preparation.task.cancel()
+            return 0
+        if preparation.task.cancelled() or preparation.task.exception() is not None:
+            return 0
+        prepared = preparation.task.result()
+        return len(prepared.image_bytes) + len(prepared.image_part)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for user_id in [uid for uid, p in self._by_user.items() if p.created < deadline]:
+            self.discard(user_id)
+
+    def cancel_all(self):
+        """Отменяет все подготовки (при остановке бота)"""
+        for user_id in list(self._by_user):
+            self.discard(user_id)
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+
+payload_preparer = PayloadPreparer()
@@ -0,0 +1,217 @@
+"""
+Сэмплирующий профилировщик обработки апдейтов и детектор блокировок event loop
+
+Фоновый поток периодически снимает стек потока event loop и приписывает его
+апдейту, чья задача сейчас выполняется. Стеки сохраняются только для апдейтов,
+попавших в выборку (доля PROFILER_SAMPLE_RATE) или оказавшихся медленнее
+PROFILER_SLOW_MS. Итог выгружается в collapsed-формате для flamegraph.pl /
+speedscope: «handler;file:func;file:func count».
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from config import (
+    PROFILER_ENABLED,
+    PROFILER_SAMPLE_RATE,
+    PROFILER_SLOW_MS,
+    PROFILER_INTERVAL_MS,
+    LOOP_STALL_MS,
+    logger
+)
+from metrics import REGISTRY
+
+LOOP_STALLS = REGISTRY.counter(
+    "event_loop_stalls_total",
+    "Случаи, когда event loop был заблокирован дольше порога"
+)
+
+# Ограничение глубины стека: глубже обычно только внутренности asyncio
+MAX_STACK_DEPTH = 64
+
+
+def _collapse_frame(frame) -> str:
+    """Преобразует стек кадра в строку «root;...;leaf»"""
+    names = []
+    depth = 0
+    while frame is not None and depth < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+        depth += 1
+    names.reverse()
+    return ";".join(names)
+
+
+class _UpdateProfile:
+    """Сэмплы одного апдейта"""
+
+    __slots__ = ("handler", "sampled", "started", "stacks")
+
+    def __init__(self, handler: str, sampled: bool):
+        self.handler = handler
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stacks: List[str] = []
+
+
+class Profiler:
+    """
+    Профилировщик пайплайна апдейтов.
+
+    Args:
+        sample_rate: Доля апдейтов, профилируемых всегда (0..1)
+        slow_threshold_ms: Апдейты медленнее порога сохраняются всегда
+        interval_ms: Период снятия стеков
+        stall_threshold_ms: Порог блокировки event loop
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.05,
+        slow_threshold_ms: float = 1000,
+        interval_ms: float = 5,
+        stall_threshold_ms: float = 100
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.stall_threshold = stall_threshold_ms / 1000
+
+        self.stacks: Counter = Counter()
+        self.profiled_updates = 0
+        self.stalls: Deque[Tuple[float, float, str]] = deque(maxlen=100)
+
+        self._active: Dict[asyncio.Task, _UpdateProfile] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Запускает поток сэмплирования и heartbeat в текущем event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._loop.call_soon(self._heartbeat)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"🔬 Профилировщик включен: выборка {self.sample_rate:.0%}, "
+            f"медленные > {self.slow_threshold * 1000:.0f} мс, "
+            f"блокировки loop > {self.stall_threshold * 1000:.0f} мс"
+        )
+
+    def stop(self):
+        """Останавливает поток сэмплирования"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _heartbeat(self):
+        self._last_beat = time.perf_counter()
+        if not self._stop.is_set():
+            self._loop.call_later(self.interval, self._heartbeat)
+
+    def _run(self):
+        stalled_since = None
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            # Детектор блокировок: heartbeat давно не выполнялся
+            lag = time.perf_counter() - self._last_beat
+            if lag > self.stall_threshold:
+                if stalled_since is None:
+                    stalled_since = self._last_beat
+                    stack = _collapse_frame(frame)
+                    self.stalls.append((time.time(), lag, stack))
+                    LOOP_STALLS.inc()
+                    logger.warning(
+                        f"⏳ Event loop заблокирован более {lag * 1000:.0f} мс: "
+                        f"{';'.join(stack.split(';')[-3:])}"
+                    )
+            else:
+                stalled_since = None
+
+            if not self._active:
+                continue
+            task = asyncio.current_task(self._loop)
+            record = self._active.get(task)
+            if record is not None:
+                record.stacks.append(_collapse_frame(frame))
+
+    async def middleware(self, handler, event, data):
+        """Inner middleware: профилирует выполнение хэндлера"""
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        record = _UpdateProfile(name, random.random() < self.sample_rate)
+        task = asyncio.current_task()
+        self._active[task] = record
+        try:
+            return await handler(event, data)
+        finally:
+            self._active.pop(task, None)
+            elapsed = time.perf_counter() - record.started
+            if record.sampled or elapsed >= self.slow_threshold:
+                self._merge(record)
+
+    def _merge(self, record: _UpdateProfile):
+        self.profiled_updates += 1
+        for stack in record.stacks:
+            self.stacks[f"{record.handler};{stack}"] += 1
+
+    def collapsed(self) -> str:
+        """Агрегированные стеки в collapsed-формате (flamegraph.pl, speedscope)"""
+        lines = [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+        for _, lag, stack in self.stalls:
+            lines.append(f"[loop-stall];{stack} {max(1, int(lag / self.interval))}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Краткая текстовая сводка для администратора"""
+        total = sum(self.stacks.values())
+        lines = [
+            f"Профилировано апдейтов: {self.profiled_updates}",
+            f"Сэмплов: {total}",
+            f"Блокировок event loop: {len(self.stalls)}",
+        ]
+        leaf_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        if leaf_counts:
+            lines.append("")
+            lines.append("Горячие функции:")
+            for leaf, count in leaf_counts.most_common(10):
+                lines.append(f"{count * 100 / total:5.1f}% {leaf}")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        """Записывает collapsed-стеки в файл"""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        logger.info(f"🔬 Профиль сохранен в {path}")
+
+    def reset(self):
+        """Сбрасывает накопленные данные"""
+        self.stacks.clear()
+        self.stalls.clear()
+        self.profiled_updates = 0
+
+
+# None, если профилирование выключено (PROFILER_ENABLED)
+profiler: Optional[Profiler] = Profiler(
+    sample_rate=PROFILER_SAMPLE_RATE,
+    slow_threshold_ms=PROFILER_SLOW_MS,
+    interval_ms=PROFILER_INTERVAL_MS,
+    stall_threshold_ms=LOOP_STALL_MS
+) if PROFILER_ENABLED else None
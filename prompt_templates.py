@@ -0,0 +1,180 @@
+"""
+Шаблоны промптов и компактная запись параметров генерации
+
+Промпт для Gemini - это 1-2 КБ английского текста, почти одинакового у
+всех генераций: различаются только выбранные пользователем параметры.
+Поэтому в БД хранится не текст, а ссылка на шаблон (таблица
+prompt_templates, текст шаблона хранится один раз) и строка параметров
+вида «g=WOMEN;h=170;loc=STUDIO;...» - несколько десятков байт. Промпт
+восстанавливается через render_prompt.
+
+Перечисления записываются именами членов, а не значениями: имена
+короче и не зависят от текстов кнопок.
+"""
+from typing import Any, Dict, Tuple
+from urllib.parse import quote, unquote
+
+from models import GenderType, LocationType, SizeType, LocationStyle, PoseType, ViewType
+
+FLAT_LAY = "flat_lay"
+WHITE_BG = "white_bg"
+MODEL = "model"
+# Промпты, сохраненные до появления шаблонов: текст целиком, без параметров
+LEGACY = "legacy"
+
+TEMPLATES: Dict[str, str] = {
+    FLAT_LAY: (
+        "Create a professional flat lay product photo with the following background setup: "
+        "A luxurious, bright white faux fur rug with a deep, shaggy texture as the main surface. "
+        "The background is a dark grey, slightly textured floor occupying the bottom third of the frame. "
+        "Include these decorative elements: "
+        "a cluster of realistic white and cream roses bordering the top edge, "
+        "a single vibrant orange and yellow maple leaf on the right side, "
+        "a smaller green maple leaf on the left side, "
+        "and a tiny potted green succulent plant in the top left corner. "
+        "Soft, diffused natural lighting that creates gentle shadows and emphasizes textures. "
+        "Perfectly centered composition with everything in sharp focus. "
+        "Seamlessly integrate the clothing item from the input photo onto this background, "
+        "making it look naturally placed on the white fur rug. "
+        "The clothing should be perfectly arranged, clean, and professionally presented. "
+        "Remove any wrinkles, creases, or folds from the original clothing photo. "
+        "Image aspect ratio: 4:3. "
+        "Ensure the final result looks like high-end e-commerce product photography."
+    ),
+    WHITE_BG: (
+        "Create a professional, high-quality product photograph on a pure white background. "
+        "Show the clothing item from {view_text} as a 3D product visualization. "
+        "The clothing must be perfectly ironed, without any wrinkles or creases. "
+        "The product should look like a 3D rendered object - clean, crisp, and professional. "
+        "The product should be the main focus, well-lit with soft shadows, "
+        "presented in a clean, commercial style suitable for an online store. "
+        "The background must be completely white (#FFFFFF). "
+        "Ensure the product looks professional and appealing, as if it's a 3D product visualization. "
+        "Image aspect ratio: 4:3. "
+        "If the clothing in the original photo is wrinkled or has folds, they must be completely removed in the final image. "
+        "Avoid excessive retouching, maintain natural fabric texture. "
+        "European appearance for any human elements."
+    ),
+    MODEL: (
+        "Generate a hyper-realistic, high-definition (4k), professional fashion photograph with 4:3 aspect ratio. "
+        "The image must feature **{model_details}**. "
+        "The clothing on the model must be perfectly ironed, smooth, without any wrinkles, creases or folds. "
+        "If the clothing in the original photo is wrinkled or has folds, they must be completely removed in the final image. "
+        "The model should be perfectly integrated with the clothing from the input image. "
+        "Scene: **{scene_details}**. "
+        "The model should be well-lit, and the final image should look like it was taken by a top fashion photographer. "
+        "Focus on natural-looking hands and realistic facial features (if visible). "
+        "Avoid excessive retouching - keep natural skin texture and appearance. "
+        "European facial features and appearance. "
+        "Image aspect ratio: 4:3. "
+        "Exclude any watermarks or text overlays."
+    ),
+}
+
+# Поле данных анкеты -> (код в строке параметров, перечисление или None для строк)
+PARAM_FIELDS = (
+    ("gender", "g", GenderType),
+    ("height", "h", None),
+    ("length", "l", None),
+    ("location", "loc", LocationType),
+    ("age", "a", None),
+    ("size", "sz", SizeType),
+    ("location_style", "st", LocationStyle),
+    ("pose", "p", PoseType),
+    ("view", "v", ViewType),
+    ("white_bg_view", "wv", None),
+)
+_FIELDS_BY_CODE = {code: (key, enum) for key, code, enum in PARAM_FIELDS}
+
+# Описание телосложения по размеру одежды
+BODY_TYPES = {
+    SizeType.SIZE_42_46: "Стройная фигура, худощавое телосложение.",
+    SizeType.SIZE_50_54: "Полная, но не сильно полная фигура, среднее телосложение, не худое и не очень толстое.",
+    SizeType.SIZE_58_64: "Полная фигура, крупное телосложение, крупные ноги и руки.",
+    SizeType.SIZE_64_68: "Очень полная фигура, гигантские размеры, очень толстое телосложение.",
+}
+
+# Разделитель, которым правка дописывается к промпту
+ADDITIONS_MARKER = "\n\nAdditional user requirements: "
+
+
+def template_for(data: Dict[str, Any]) -> str:
+    """Имя шаблона для данных анкеты"""
+    gender = data.get('gender', GenderType.FLAT_LAY)
+    if gender == GenderType.FLAT_LAY:
+        return FLAT_LAY
+    if gender == GenderType.WHITE_BG:
+        return WHITE_BG
+    return MODEL
+
+
+def encode_params(data: Dict[str, Any]) -> str:
+    """Компактная строка выбранных параметров анкеты"""
+    items = []
+    for key, code, enum in PARAM_FIELDS:
+        value = data.get(key)
+        if value is None:
+            continue
+        items.append(f"{code}={value.name if enum else quote(str(value), safe='-.')}")
+    return ";".join(items)
+
+
+def decode_params(params: str) -> Dict[str, Any]:
+    """Данные анкеты из строки encode_params"""
+    data = {}
+    for item in filter(None, params.split(";")):
+        code, _, value = item.partition("=")
+        key, enum = _FIELDS_BY_CODE[code]
+        data[key] = enum[value] if enum else unquote(value)
+    return data
+
+
+def _template_fields(data: Dict[str, Any]) -> Dict[str, str]:
+    """Значения подстановок шаблона"""
+    gender = data.get('gender', GenderType.FLAT_LAY)
+    if gender == GenderType.WHITE_BG:
+        return {"view_text": "back view" if data.get('white_bg_view', 'front') == "back" else "front view"}
+    if gender == GenderType.FLAT_LAY:
+        return {}
+
+    age = data.get('age', '25-35')
+    model_details = (
+        f"a professional, natural-looking model with European appearance, {gender.value} clothing, "
+        f"height {data.get('height', '170')} cm, age range {age}"
+    )
+    if gender != GenderType.KIDS:
+        model_details += f", wearing size {data.get('size', SizeType.SIZE_42_46).value}"
+    # Телосложение описывается, только если размер выбран явно
+    body_type = BODY_TYPES.get(data.get('size'))
+    if body_type:
+        model_details += f", {body_type}"
+
+    location = data.get('location', LocationType.STUDIO).value
+    location_style = data.get('location_style', LocationStyle.REGULAR).value
+    pose = data.get('pose', PoseType.STANDING).value
+    view = data.get('view', ViewType.FRONT).value
+    scene_details = f"in a {location} setting, with a {location_style} atmosphere. Pose: {pose}, View: {view}."
+    return {"model_details": model_details, "scene_details": scene_details}
+
+
+def render_prompt(template: str, text: str, params: str = "", additions: str = None) -> str:
+    """
+    Промпт по тексту шаблона и строке параметров.
+
+    template - имя шаблона: у LEGACY текст - уже готовый промпт.
+    """
+    prompt = text if template == LEGACY else text.format(**_template_fields(decode_params(params)))
+    if additions:
+        prompt += ADDITIONS_MARKER + additions
+    return prompt
+
+
+def describe_prompt(data: Dict[str, Any]) -> Tuple[str, str]:
+    """(имя шаблона, строка параметров) для записи генерации в БД"""
+    return template_for(data), encode_params(data)
+
+
+def build_prompt(data: Dict[str, Any]) -> str:
+    """Промпт для Gemini по данным анкеты"""
+    template = template_for(data)
+    return TEMPLATES[template].format(**_template_fields(data))
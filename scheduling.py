@@ -0,0 +1,208 @@
+"""
+Приоритетный допуск генераций к Gemini
+
+Все запросы конкурировали за емкость Gemini на равных: всплеск бесплатных
+генераций (gender_select_handler) задерживал оплаченные и правки.
+
+Генерация занимает слот на этапах upload и model (этап queue - ожидание
+слота). Слотов GENERATION_CONCURRENCY; каждый запрос относится к классу
+(priority_class): paid - генерации платящих пользователей, edit - их
+правки, trial - пользователи, ни разу не пополнявшие баланс.
+
+- Взвешенная справедливая очередь: запрос получает метку виртуального
+  времени max(V, метка прошлого запроса класса) + 1/вес, освободившийся
+  слот достается запросу с наименьшей меткой. При очередях во всех
+  классах слоты делятся пропорционально весам.
+- Старение: из метки вычитается время ожидания, деленное на
+  GENERATION_PRIORITY_AGING, - запрос низкого класса не ждет бесконечно
+  под непрерывным потоком оплаченных.
+- Резерв: часть слотов закреплена за классом, остальные общие. Запрос
+  класса допускается в свой резерв или в свободный общий слот, поэтому
+  trial не займет слоты, зарезервированные для paid.
+
+Классы задаются строкой «класс=вес:резерв» (GENERATION_PRIORITY_CLASSES).
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from config import (
+    GENERATION_CONCURRENCY,
+    GENERATION_PRIORITY_AGING,
+    GENERATION_PRIORITY_CLASSES
+)
+from metrics import REGISTRY
+
+PRIORITY_CLASSES = ("paid", "edit", "trial")
+
+QUEUE_WAIT = REGISTRY.histogram(
+    "generation_queue_wait_seconds",
+    "Ожидание слота Gemini по классу приоритета",
+    ("class",)
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "generation_queue_depth",
+    "Генерации, ожидающие слота Gemini, по классу приоритета",
+    ("class",)
+)
+SLOTS_IN_USE = REGISTRY.gauge(
+    "generation_slots_in_use",
+    "Занятые слоты Gemini по классу приоритета",
+    ("class",)
+)
+
+
+def priority_class(kind: str, paid: bool) -> str:
+    """Класс приоритета задания: kind - create/edit, paid - пользователь пополнял баланс"""
+    if not paid:
+        return "trial"
+    return "edit" if kind == "edit" else "paid"
+
+
+def parse_priority_classes(spec: str) -> Dict[str, Tuple[float, int]]:
+    """Разбирает строку вида «paid=6:2,edit=3:1,trial=1:0» в {класс: (вес, резерв)}"""
+    classes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        if name not in PRIORITY_CLASSES:
+            raise ValueError(f"Неизвестный класс в GENERATION_PRIORITY_CLASSES: {name}")
+        weight, _, reserved = value.partition(":")
+        classes[name] = (float(weight), int(reserved or 0))
+        if classes[name][0] <= 0 or classes[name][1] < 0:
+            raise ValueError(f"Класс {name}: вес должен быть положительным, резерв - неотрицательным")
+    missing = set(PRIORITY_CLASSES) - set(classes)
+    if missing:
+        raise ValueError(f"В GENERATION_PRIORITY_CLASSES не заданы классы: {', '.join(sorted(missing))}")
+    return classes
+
+
+class _Waiter:
+    __slots__ = ("tag", "enqueued", "future")
+
+    def __init__(self, tag: float, enqueued: float, future: asyncio.Future):
+        self.tag = tag
+        self.enqueued = enqueued
+        self.future = future
+
+
+class _Class:
+    __slots__ = ("name", "weight", "reserved", "running", "last_tag", "queue")
+
+    def __init__(self, name: str, weight: float, reserved: int):
+        self.name = name
+        self.weight = weight
+        self.reserved = reserved
+        self.running = 0
+        self.last_tag = 0.0
+        self.queue: Deque[_Waiter] = deque()
+
+
+class GenerationScheduler:
+    """
+    Слоты Gemini с приоритетами.
+
+    Args:
+        capacity: Всего слотов
+        classes: {класс: (вес, зарезервировано слотов)}
+        aging: Сколько секунд ожидания уменьшают метку на единицу
+    """
+
+    def __init__(
+        self,
+        capacity: int = GENERATION_CONCURRENCY,
+        classes: Optional[Dict[str, Tuple[float, int]]] = None,
+        aging: float = GENERATION_PRIORITY_AGING
+    ):
+        if classes is None:
+            classes = parse_priority_classes(GENERATION_PRIORITY_CLASSES)
+        reserved = sum(reserved for _, reserved in classes.values())
+        if reserved > capacity:
+            raise ValueError(f"Зарезервировано слотов ({reserved}) больше, чем GENERATION_CONCURRENCY ({capacity})")
+        self.capacity = capacity
+        self.aging = aging
+        self._classes = {name: _Class(name, weight, reserved) for name, (weight, reserved) in classes.items()}
+        self._shared = capacity - reserved
+        # Виртуальное время: метка последнего допущенного запроса
+        self._virtual = 0.0
+
+    def _shared_in_use(self) -> int:
+        return sum(max(0, cls.running - cls.reserved) for cls in self._classes.values())
+
+    def _admissible(self, cls: _Class) -> bool:
+        return cls.running < cls.reserved or self._shared_in_use() < self._shared
+
+    def _admit(self, cls: _Class, tag: float):
+        cls.running += 1
+        self._virtual = max(self._virtual, tag)
+        SLOTS_IN_USE.set(cls.running, cls.name)
+
+    @staticmethod
+    def _drop_cancelled(cls: _Class):
+        """Убирает из головы очереди ожидающих, отмененных до допуска"""
+        if cls.queue and cls.queue[0].future.done():
+            while cls.queue and cls.queue[0].future.done():
+                cls.queue.popleft()
+            QUEUE_DEPTH.set(len(cls.queue), cls.name)
+
+    def _dispatch(self):
+        """Отдает свободные слоты ожидающим с наименьшей меткой с учетом старения"""
+        now = time.monotonic()
+        while True:
+            best, best_key = None, None
+            for cls in self._classes.values():
+                self._drop_cancelled(cls)
+                if cls.queue and self._admissible(cls):
+                    waiter = cls.queue[0]
+                    key = waiter.tag - (now - waiter.enqueued) / self.aging
+                    if best is None or key < best_key:
+                        best, best_key = cls, key
+            if best is None:
+                return
+            waiter = best.queue.popleft()
+            QUEUE_DEPTH.set(len(best.queue), best.name)
+            self._admit(best, waiter.tag)
+            waiter.future.set_result(None)
+
+    async def acquire(self, name: str):
+        """Ждет слот для запроса класса name (освободить - release)"""
+        cls = self._classes[name]
+        tag = max(self._virtual, cls.last_tag) + 1 / cls.weight
+        cls.last_tag = tag
+        started = time.monotonic()
+        if not cls.queue and self._admissible(cls):
+            # Очереди класса нет, а другие классы на свободный слот не допускаются
+            self._admit(cls, tag)
+            QUEUE_WAIT.observe(0, name)
+            return
+
+        waiter = _Waiter(tag, started, asyncio.get_running_loop().create_future())
+        cls.queue.append(waiter)
+        QUEUE_DEPTH.set(len(cls.queue), name)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдан в момент отмены
+                self.release(name)
+            elif waiter in cls.queue:
+                # Если отмена и освобождение слота пришлись на один шаг цикла,
+                # _dispatch мог уже убрать ожидающего из очереди
+                cls.queue.remove(waiter)
+                QUEUE_DEPTH.set(len(cls.queue), name)
+            raise
+        finally:
+            QUEUE_WAIT.observe(time.monotonic() - started, name)
+
+    def release(self, name: str):
+        """Освобождает слот класса name"""
+        cls = self._classes[name]
+        cls.running -= 1
+        SLOTS_IN_USE.set(cls.running, name)
+        self._dispatch()
+
+
+# None, если допуск не ограничен (GENERATION_CONCURRENCY = 0)
+generation_scheduler: Optional[GenerationScheduler] = (
+    GenerationScheduler() if GENERATION_CONCURRENCY > 0 else None
+)
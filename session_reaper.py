@@ -0,0 +1,191 @@
+"""
+Очистка брошенных сценариев создания фото
+
+Пользователи часто бросают анкету ProductCreationStates на полпути. Данные
+FSM оставались в MemoryStorage навсегда, а временное фото из photo_handler
+удалялось, только если пользователь нажимал «Завершить» или начинал новое
+создание.
+
+Middleware отмечает время последнего апдейта каждого пользователя. Сроки
+истечения лежат в куче - по одной записи на пользователя: при извлечении
+записи, чей пользователь с тех пор был активен, она возвращается в кучу
+с новым сроком. Время простоя одинаково для всех, поэтому новая запись
+никогда не оказывается раньше уже лежащих, и задаче достаточно спать до
+срока вершины кучи - без периодического обхода всех пользователей.
+
+У истекшего сценария сбрасываются состояние FSM, подготовленный запрос и
+сессия правок, удаляется временное фото; пользователь получает сообщение
+(SESSION_EXPIRE_NOTIFY). Освобожденная память и место на диске
+учитываются в метриках.
+"""
+import asyncio
+import heapq
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+
+from config import SESSION_EXPIRE_NOTIFY, SESSION_IDLE_TTL, logger
+from edit_sessions import edit_sessions
+from inflight import inflight
+from keyboards import get_main_menu_keyboard
+from lifecycle import lifecycle
+from metrics import REGISTRY
+from payload_prep import payload_preparer
+
+EXPIRED_SESSIONS = REGISTRY.counter(
+    "creation_sessions_expired_total",
+    "Брошенные сценарии создания фото, очищенные по времени простоя"
+)
+RECLAIMED_BYTES = REGISTRY.counter(
+    "creation_sessions_reclaimed_bytes_total",
+    "Освобождено при очистке брошенных сценариев: memory - анкета и подготовленный запрос, disk - временное фото",
+    ("kind",)
+)
+TRACKED_USERS = REGISTRY.gauge(
+    "creation_sessions_tracked_users",
+    "Пользователи, чья активность отслеживается для очистки сценариев"
+)
+
+EXPIRED_NOTICE = (
+    "⌛ Создание фото отменено: долго не было действий.\n"
+    "Начать заново можно из главного меню."
+)
+
+
+def _approx_size(value) -> int:
+    """Примерный размер данных FSM в памяти"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_approx_size(key) + _approx_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_approx_size(item) for item in value)
+    return size
+
+
+class _Activity:
+    __slots__ = ("state", "chat_id", "last_seen")
+
+    def __init__(self, state: FSMContext, chat_id: int, last_seen: float):
+        self.state = state
+        self.chat_id = chat_id
+        self.last_seen = last_seen
+
+
+class SessionReaper:
+    """Сроки простоя пользователей и фоновая очистка истекших сценариев"""
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, notify: bool = SESSION_EXPIRE_NOTIFY):
+        self.idle_ttl = idle_ttl
+        self.notify = notify
+        self._activity: Dict[int, _Activity] = {}
+        # (срок, user_id); у пользователя не больше одной записи
+        self._deadlines: List[Tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+
+    def touch(self, user_id: int, chat_id: int, state: FSMContext, now: Optional[float] = None):
+        """Отмечает активность пользователя"""
+        if now is None:
+            now = time.monotonic()
+        activity = self._activity.get(user_id)
+        if activity is not None:
+            activity.state, activity.chat_id, activity.last_seen = state, chat_id, now
+            return
+        self._activity[user_id] = _Activity(state, chat_id, now)
+        heapq.heappush(self._deadlines, (now + self.idle_ttl, user_id))
+        TRACKED_USERS.set(len(self._activity))
+        self._wakeup.set()
+
+    async def middleware(self, handler, event, data):
+        """Inner middleware: активность отмечается до и после хэндлера (генерация идет долго)"""
+        user, chat, state = data.get("event_from_user"), data.get("event_chat"), data.get("state")
+        if user is None or chat is None or state is None:
+            return await handler(event, data)
+        self.touch(user.id, chat.id, state)
+        try:
+            return await handler(event, data)
+        finally:
+            self.touch(user.id, chat.id, state)
+
+    def pop_expired(self, now: Optional[float] = None) -> List[Tuple[int, _Activity]]:
+        """Снимает с учета пользователей, простаивающих дольше idle_ttl"""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, user_id = heapq.heappop(self._deadlines)
+            activity = self._activity[user_id]
+            deadline = activity.last_seen + self.idle_ttl
+            if deadline <= now and inflight.get(user_id) is not None:
+                deadline = now + self.idle_ttl  # ждет генерацию
+            if deadline > now:
+                # Был активен после постановки срока: запись возвращается с новым сроком
+                heapq.heappush(self._deadlines, (deadline, user_id))
+                continue
+            del self._activity[user_id]
+            expired.append((user_id, activity))
+        TRACKED_USERS.set(len(self._activity))
+        return expired
+
+    async def expire(self, bot: Bot, user_id: int, activity: _Activity) -> bool:
+        """
+        Очищает сценарий пользователя, если он не завершен.
+
+        Returns:
+            True, если было что очищать
+        """
+        state = await activity.state.get_state()
+        data = await activity.state.get_data()
+        temp_photo_path = data.get('temp_photo_path')
+        if (state is None and not data) or user_id in self._activity:
+            # Нечего очищать, или пользователь успел вернуться
+            return False
+
+        memory = _approx_size(data) + payload_preparer.discard(user_id)
+        edit_sessions.discard(user_id)
+        disk = 0
+        if temp_photo_path:
+            try:
+                disk = os.path.getsize(temp_photo_path)
+            except OSError:
+                pass
+            lifecycle.remove_temp_file(temp_photo_path)
+        await activity.state.clear()
+
+        EXPIRED_SESSIONS.inc()
+        RECLAIMED_BYTES.inc("memory", amount=memory)
+        RECLAIMED_BYTES.inc("disk", amount=disk)
+        logger.info(
+            f"⌛ Сценарий пользователя {user_id} очищен после простоя ({state or 'без состояния'}): "
+            f"память ~{memory} байт, диск {disk} байт"
+        )
+        if self.notify and state is not None:
+            try:
+                await bot.send_message(activity.chat_id, EXPIRED_NOTICE, reply_markup=get_main_menu_keyboard())
+            except Exception as e:
+                logger.debug(f"Не удалось уведомить пользователя {user_id} об очистке сценария: {e}")
+        return True
+
+    async def run(self, bot: Bot):
+        """Фоновая задача: спит до ближайшего срока и очищает истекшие сценарии"""
+        while True:
+            if not self._deadlines:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._deadlines[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            for user_id, activity in self.pop_expired():
+                try:
+                    await self.expire(bot, user_id, activity)
+                except Exception as e:
+                    logger.error(f"Ошибка очистки сценария пользователя {user_id}: {e}")
+
+
+# None, если очистка выключена (SESSION_IDLE_TTL = 0)
+session_reaper: Optional[SessionReaper] = SessionReaper() if SESSION_IDLE_TTL > 0 else None
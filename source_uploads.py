@@ -0,0 +1,172 @@
+"""
+Реестр исходных фото, загруженных через Gemini File API
+
+Каждая правка ("Внести изменения") раньше заново отправляла в Gemini
+исходное фото в base64, хотя оно не меняется. Теперь фото загружается один
+раз (в фоне, пока пользователь заполняет анкету), а запросы ссылаются на
+него по URI - несколько сотен байт вместо мегабайт.
+
+Файлы File API живут ограниченное время (expirationTime, около 48 часов):
+запись считается свежей до expirationTime минус запас, после чего фото
+загружается заново. Если Gemini все же не находит файл, запрос повторяется
+с изображением внутри запроса (см. is_stale_reference).
+
+Реестр не ограничен исходными фото: по хэшу из хранилища медиа ссылкой
+передаются и результаты прошлых шагов сессии правок (см. edit_sessions).
+"""
+import asyncio
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional
+
+from config import GEMINI_BACKEND, GEMINI_DEMO_MODE, GEMINI_FILE_API, GEMINI_FILE_REUPLOAD_MARGIN, logger
+from gemini_api import encode_image_part, file_image_part, upload_file
+from media_store import media_store
+from metrics import record_cache_lookup
+
+# Срок жизни файла, если API его не вернул
+DEFAULT_FILE_TTL = 47 * 3600
+
+
+@dataclass
+class UploadedSource:
+    """Загруженное исходное фото"""
+    name: str
+    uri: str
+    mime_type: str
+    expires_at: float  # unix time
+
+
+def parse_expiration(value: Optional[str]) -> float:
+    """Разбирает expirationTime (RFC 3339, до наносекунд) в unix time"""
+    if not value:
+        return time.time() + DEFAULT_FILE_TTL
+    # datetime понимает не больше 6 знаков дробной части
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value).replace("Z", "+00:00")
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return time.time() + DEFAULT_FILE_TTL
+
+
+def is_stale_reference(body: bytes, error: Exception) -> bool:
+    """Ошибка запроса со ссылкой на файл, которого уже нет (истек или удален)"""
+    if b'"fileData"' not in body:
+        return False
+    message = str(error)
+    return "код 403" in message or "код 404" in message
+
+
+class SourceUploadRegistry:
+    """Исходные фото по хэшу содержимого -> загруженные файлы"""
+
+    def __init__(self, reupload_margin: float = GEMINI_FILE_REUPLOAD_MARGIN):
+        self.reupload_margin = reupload_margin
+        self._files: Dict[str, UploadedSource] = {}
+        self._uploads: Dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return GEMINI_FILE_API and not GEMINI_DEMO_MODE and GEMINI_BACKEND != "demo"
+
+    def _fresh(self, input_hash: str) -> Optional[UploadedSource]:
+        uploaded = self._files.get(input_hash)
+        if uploaded is not None and uploaded.expires_at - self.reupload_margin <= time.time():
+            del self._files[input_hash]
+            return None
+        return uploaded
+
+    def part_for(self, input_hash: str) -> Optional[bytes]:
+        """
+        Фрагмент запроса со ссылкой на загруженное фото.
+
+        Returns:
+            None, если фото не загружено или файл скоро истечет
+        """
+        if not self.enabled:
+            return None
+        uploaded = self._fresh(input_hash)
+        record_cache_lookup("source_upload", uploaded is not None)
+        if uploaded is None:
+            return None
+        return file_image_part(uploaded.uri, uploaded.mime_type)
+
+    def ensure_uploaded(self, input_hash: str, image_bytes: bytes, mime_type: str = "image/jpeg"):
+        """Запускает фоновую загрузку, если свежего файла нет и загрузка еще не идет"""
+        if not self.enabled or self._fresh(input_hash) is not None or input_hash in self._uploads:
+            return
+        task = asyncio.create_task(
+            self._upload(input_hash, image_bytes, mime_type), name=f"source_upload_{input_hash[:12]}"
+        )
+        self._uploads[input_hash] = task
+        task.add_done_callback(lambda _: self._uploads.pop(input_hash, None))
+
+    async def _upload(self, input_hash: str, image_bytes: bytes, mime_type: str):
+        started = time.perf_counter()
+        try:
+            file = await upload_file(image_bytes, mime_type, display_name=input_hash[:32])
+        except Exception as e:
+            # Не критично: запросы продолжат отправлять фото целиком
+            logger.warning(f"Не удалось загрузить исходное фото в File API: {e}")
+            return
+        self._expire()
+        self._files[input_hash] = UploadedSource(
+            name=file.get("name", ""),
+            uri=file["uri"],
+            mime_type=file.get("mimeType", mime_type),
+            expires_at=parse_expiration(file.get("expirationTime"))
+        )
+        logger.info(
+            f"📤 Исходное фото загружено в File API за {(time.perf_counter() - started) * 1000:.0f} мс "
+            f"({len(image_bytes)} байт)"
+        )
+
+    async def part(
+        self,
+        digest: str,
+        image_bytes: Optional[bytes] = None,
+        inline_part: Optional[bytes] = None
+    ) -> bytes:
+        """
+        Фрагмент запроса для изображения из хранилища медиа.
+
+        Ссылка на файл, если он загружен; иначе base64 внутри запроса,
+        а загрузка запускается для следующих запросов. image_bytes и
+        inline_part (если уже есть) избавляют от чтения и кодирования.
+        """
+        file_part = self.part_for(digest)
+        if file_part is not None:
+            return file_part
+        if image_bytes is None:
+            image_bytes = await asyncio.to_thread(media_store.get, digest)
+        self.ensure_uploaded(digest, image_bytes)
+        if inline_part is not None:
+            return inline_part
+        return await asyncio.to_thread(encode_image_part, image_bytes)
+
+    def invalidate(self, input_hash: str):
+        """Забывает файл, который Gemini больше не находит"""
+        self._files.pop(input_hash, None)
+
+    def invalidate_referenced(self, body: bytes):
+        """Забывает все файлы, на которые ссылается тело отклоненного запроса"""
+        for input_hash in [h for h, f in self._files.items() if f.uri.encode('utf-8') in body]:
+            del self._files[input_hash]
+
+    def _expire(self):
+        now = time.time()
+        for input_hash in [h for h, f in self._files.items() if f.expires_at <= now]:
+            del self._files[input_hash]
+
+    def cancel_all(self):
+        """Отменяет незавершенные загрузки (при остановке бота)"""
+        for task in list(self._uploads.values()):
+            task.cancel()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+
+source_uploads = SourceUploadRegistry()
@@ -0,0 +1,89 @@
+"""
+Быстрый старт бота
+
+Замеряет фазы запуска и прогревает тяжелые зависимости в фоне, уже после того,
+как бот начал принимать апдейты: импорт Pillow (и NumPy для проверки
+качества фото), TLS-соединение с Gemini, шаблоны демо-бэкенда.
+"""
+import asyncio
+import time
+from typing import List, Tuple
+
+from config import GEMINI_BACKEND, GEMINI_DEMO_MODE, PHOTO_QUALITY_GATE, logger
+from metrics import REGISTRY
+
+# Момент импорта модуля: bot.py импортирует startup первым
+PROCESS_STARTED = time.perf_counter()
+
+STARTUP_SECONDS = REGISTRY.gauge(
+    "bot_startup_seconds",
+    "Время от старта процесса до готовности принимать апдейты"
+)
+
+
+class StartupTimer:
+    """Отметки фаз запуска относительно старта процесса"""
+
+    def __init__(self, started: float = PROCESS_STARTED):
+        self.started = started
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> float:
+        elapsed = time.perf_counter() - self.started
+        self.phases.append((phase, elapsed))
+        return elapsed
+
+    def report(self) -> str:
+        return ", ".join(f"{phase} {elapsed * 1000:.0f} мс" for phase, elapsed in self.phases)
+
+
+timer = StartupTimer()
+
+
+def _import_pillow():
+    """Импортирует Pillow и плагины форматов, нужные на горячем пути"""
+    from PIL import Image, JpegImagePlugin, PngImagePlugin  # noqa: F401
+
+    Image.preinit()
+    if PHOTO_QUALITY_GATE:
+        import numpy  # noqa: F401  (image_quality)
+
+
+async def _prewarm_pillow():
+    started = time.perf_counter()
+    await asyncio.to_thread(_import_pillow)
+    logger.info(f"🔥 Pillow прогрет за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+async def _prewarm_demo_backend():
+    if GEMINI_DEMO_MODE or GEMINI_BACKEND == "demo":
+        from demo_backend import demo_backend
+        await demo_backend.warm_up()
+
+
+async def prewarm():
+    """Параллельно прогревает зависимости; ошибки логируются и не мешают работе"""
+    from gemini_api import warm_up_connection
+
+    results = await asyncio.gather(
+        _prewarm_pillow(),
+        warm_up_connection(),
+        _prewarm_demo_backend(),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Ошибка фонового прогрева: {result}")
+    logger.info(f"🚀 Фоновый прогрев завершен через {timer.mark('prewarmed') * 1000:.0f} мс после старта")
+
+
+def start_prewarm() -> asyncio.Task:
+    """Запускает прогрев в фоне, не задерживая начало polling"""
+    return asyncio.create_task(prewarm(), name="prewarm")
+
+
+def mark_ready():
+    """Отмечает готовность принимать апдейты (хук dp.startup)"""
+    elapsed = timer.mark("polling")
+    STARTUP_SECONDS.set(elapsed)
+    logger.info(f"⏱️ Запуск: {timer.report()}")
@@ -0,0 +1,169 @@
+"""
+Надзор за генерациями: дедлайны, бюджеты этапов и отмена пользователем
+
+Раньше после "Начать генерацию" остановить генерацию было нельзя, хэндлер
+вручную отменял и дожидался progress_task (а на пути ошибки забывал это
+сделать), а зависший Gemini держал ресурсы до таймаута HTTP-запроса.
+
+Генерация выполняется внутри supervise_generation:
+
+- asyncio.TaskGroup владеет дочерними задачами (прогресс-бар): они
+  отменяются и дожидаются при любом выходе - успехе, ошибке или отмене;
+- общий дедлайн GENERATION_DEADLINE от списания до доставки;
+- у каждого этапа (preprocess, queue, upload, model, encode, send) свой
+  бюджет из GENERATION_STAGE_BUDGETS, время этапов пишется в метрики;
+- кнопка "Отменить" отменяет задачу хэндлера: идущий HTTP-запрос к Gemini
+  обрывается, хэндлер получает GenerationCancelled и возвращает баланс.
+
+Отмена возможна, пока результат не получен: этапы после model
+выполняются с cancellable=False (оплаченный результат доставляется).
+Отмена при остановке бота по-прежнему приходит как CancelledError.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Dict, List, Optional, TypeVar
+
+from config import GENERATION_DEADLINE, GENERATION_STAGE_BUDGETS
+from metrics import GENERATION_STAGE_LATENCY
+import tracing
+
+T = TypeVar("T")
+
+STAGES = ("preprocess", "queue", "upload", "model", "encode", "send")
+
+
+class GenerationCancelled(Exception):
+    """Генерация отменена пользователем"""
+
+    def __init__(self):
+        super().__init__("Генерация отменена пользователем")
+
+
+class GenerationTimeout(Exception):
+    """Этап или генерация целиком не уложились в отведенное время"""
+
+    def __init__(self, stage: Optional[str], budget: float, overall: bool = False):
+        self.stage = stage
+        self.budget = budget
+        self.overall = overall
+        if overall:
+            message = f"Генерация не уложилась в {budget:g} с (этап {stage or '-'})"
+        else:
+            message = f"Этап {stage} не уложился в {budget:g} с"
+        super().__init__(message)
+
+
+def parse_stage_budgets(spec: str) -> Dict[str, float]:
+    """Разбирает строку вида «model=75,send=30»"""
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        stage, _, value = item.partition("=")
+        if stage not in STAGES:
+            raise ValueError(f"Неизвестный этап в GENERATION_STAGE_BUDGETS: {stage}")
+        budgets[stage] = float(value)
+    return budgets
+
+
+STAGE_BUDGETS = parse_stage_budgets(GENERATION_STAGE_BUDGETS)
+
+
+class GenerationRun:
+    """Генерация под надзором: текущий этап, дочерние задачи, отмена"""
+
+    def __init__(self, budgets: Dict[str, float]):
+        self.task = asyncio.current_task()
+        self.budgets = budgets
+        self.stage_name: Optional[str] = None
+        self.cancellable = True
+        self.cancelled_by_user = False
+        self._group: Optional[asyncio.TaskGroup] = None
+        self._children: List[asyncio.Task] = []
+
+    def spawn(self, coro: Awaitable, name: Optional[str] = None) -> asyncio.Task:
+        """Дочерняя задача (например, прогресс-бар), живущая не дольше генерации"""
+        task = self._group.create_task(coro, name=name)
+        self._children.append(task)
+        return task
+
+    async def stop_children(self):
+        """Отменяет дочерние задачи и дожидается их завершения"""
+        children, self._children = self._children, []
+        for task in children:
+            task.cancel()
+        if children:
+            await asyncio.gather(*children, return_exceptions=True)
+
+    async def stage(self, name: str, awaitable: Awaitable[T], cancellable: bool = True) -> T:
+        """
+        Выполняет этап в пределах его бюджета.
+
+        Raises:
+            GenerationTimeout: бюджет этапа исчерпан
+        """
+        budget = self.budgets.get(name)
+        self.stage_name = name
+        self.cancellable = cancellable
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with tracing.span(name, budget=budget):
+                async with asyncio.timeout(budget):
+                    result = await awaitable
+            outcome = "ok"
+            return result
+        except TimeoutError as e:
+            outcome = "timeout"
+            raise GenerationTimeout(name, budget) from e
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            GENERATION_STAGE_LATENCY.observe(time.perf_counter() - started, name, outcome)
+
+    def cancel(self) -> bool:
+        """
+        Отменяет генерацию по запросу пользователя.
+
+        Returns:
+            False, если результат уже получен и доставляется
+        """
+        if not self.cancellable or self.task.done():
+            return False
+        if not self.cancelled_by_user:
+            self.cancelled_by_user = True
+            self.task.cancel()
+        return True
+
+
+@asynccontextmanager
+async def supervise_generation(deadline: float = GENERATION_DEADLINE, budgets: Dict[str, float] = None):
+    """
+    Выполняет тело как генерацию под надзором.
+
+    Raises:
+        GenerationCancelled: пользователь нажал "Отменить"
+        GenerationTimeout: истек общий дедлайн или бюджет этапа
+    """
+    run = GenerationRun(STAGE_BUDGETS if budgets is None else budgets)
+    try:
+        with tracing.span("generation"):
+            async with asyncio.timeout(deadline):
+                async with asyncio.TaskGroup() as group:
+                    run._group = group
+                    try:
+                        yield run
+                    finally:
+                        # Дочерние задачи не переживают генерацию ни при каком исходе
+                        for task in run._children:
+                            task.cancel()
+    except BaseExceptionGroup as errors:
+        # Дочерние задачи сами подавляют свои ошибки: в группе исключение тела
+        raise errors.exceptions[0] from None
+    except TimeoutError as e:
+        raise GenerationTimeout(run.stage_name, deadline, overall=True) from e
+    except asyncio.CancelledError:
+        # Отмена при остановке бота (в том числе одновременная) пробрасывается дальше
+        if run.cancelled_by_user and run.task.uncancel() == 0:
+            raise GenerationCancelled() from None
+        raise
@@ -0,0 +1,142 @@
+"""Допуск генераций по классам приоритета (scheduling.GenerationScheduler)"""
+import asyncio
+
+from scheduling import GenerationScheduler
+
+# Старение, которое за время теста не меняет порядок
+NO_AGING = 1e6
+
+
+def _classes(paid_reserved: int = 0):
+    return {"paid": (6.0, paid_reserved), "edit": (3.0, 0), "trial": (1.0, 0)}
+
+
+async def _acquired(scheduler: GenerationScheduler, name: str) -> bool:
+    """Получен ли слот класса name без ожидания (полученный слот остается занятым)"""
+    task = asyncio.create_task(scheduler.acquire(name))
+    await asyncio.sleep(0)
+    if task.done():
+        return True
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return False
+
+
+async def _grant_order(scheduler: GenerationScheduler, held: str, names, pause: float = 0) -> list:
+    """
+    Ставит в очередь запросы классов names (в этом порядке, с паузой pause
+    после каждого) при занятом слоте класса held и по одному освобождает
+    слоты. Возвращает порядок, в котором запросы получили слот.
+    """
+    order = []
+
+    async def waiter(name):
+        await scheduler.acquire(name)
+        order.append(name)
+
+    for name in names:
+        asyncio.create_task(waiter(name))
+        await asyncio.sleep(pause)
+    for _ in names:
+        scheduler.release(held)
+        granted = len(order) + 1
+        while len(order) < granted:
+            await asyncio.sleep(0)
+        held = order[-1]
+    scheduler.release(held)
+    return order
+
+
+def test_priority_order():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=1, classes=_classes(), aging=NO_AGING)
+        await scheduler.acquire("paid")
+        # Пришли в обратном порядке приоритета
+        return await _grant_order(scheduler, "paid", ["trial", "edit", "paid"])
+
+    assert asyncio.run(scenario()) == ["paid", "edit", "trial"]
+
+
+def test_weighted_share():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=1, classes=_classes(), aging=NO_AGING)
+        await scheduler.acquire("paid")
+        return await _grant_order(scheduler, "paid", ["trial"] * 4 + ["paid"] * 12)
+
+    order = asyncio.run(scenario())
+    # При вечной очереди paid trial получает слот пропорционально весу, а не после всех paid
+    assert order.index("trial") < 8
+    assert order[:14].count("trial") == 2
+
+
+def test_reserved_slots():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=2, classes=_classes(paid_reserved=1), aging=NO_AGING)
+        assert await _acquired(scheduler, "trial")
+        # Свободный слот зарезервирован за paid: trial и edit его не получают
+        assert not await _acquired(scheduler, "trial")
+        assert not await _acquired(scheduler, "edit")
+        assert await _acquired(scheduler, "paid")
+        # Освобожденный общий слот снова доступен всем
+        scheduler.release("trial")
+        assert await _acquired(scheduler, "edit")
+
+    asyncio.run(scenario())
+
+
+def test_aging_prevents_starvation():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=1, classes=_classes(), aging=0.01)
+        await scheduler.acquire("paid")
+        # trial ждет 0.1 с (10 единиц метки) - дольше, чем разница меток с paid
+        return await _grant_order(scheduler, "paid", ["trial", "paid"], pause=0.1)
+
+    assert asyncio.run(scenario()) == ["trial", "paid"]
+
+
+def test_cancel_during_release():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=1, classes=_classes(), aging=NO_AGING)
+        await scheduler.acquire("paid")
+        waiting = asyncio.create_task(scheduler.acquire("trial"))
+        await asyncio.sleep(0)
+
+        # Отмена и освобождение до того, как задача ожидающего получит управление
+        waiting.cancel()
+        scheduler.release("paid")
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+
+        # Слот свободен, а отмененный запрос не остался в очереди trial
+        assert await _acquired(scheduler, "trial")
+        scheduler.release("trial")
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_skipped():
+    async def scenario():
+        scheduler = GenerationScheduler(capacity=1, classes=_classes(), aging=NO_AGING)
+        await scheduler.acquire("paid")
+        cancelled = asyncio.create_task(scheduler.acquire("trial"))
+        waiting = asyncio.create_task(scheduler.acquire("trial"))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        scheduler.release("paid")
+        # Слот достается следующему ожидающему, а не отмененному
+        await asyncio.wait_for(waiting, 1)
+        try:
+            await cancelled
+        except asyncio.CancelledError:
+            pass
+        assert not await _acquired(scheduler, "paid")
+        scheduler.release("trial")
+        assert await _acquired(scheduler, "paid")
+
+    asyncio.run(scenario())
@@ -0,0 +1,136 @@
+"""
+Ограничение частоты апдейтов от одного пользователя
+
+Любой пользователь может засыпать бота нажатиями кнопок или фотографиями:
+каждый апдейт делает синхронные запросы к SQLite, часть - скачивание файла
+и работу PIL, и один такой чат замедляет всех остальных.
+
+У каждого пользователя своя корзина токенов (token bucket): она
+пополняется со скоростью THROTTLE_RATE до THROTTLE_BURST, а хэндлер
+списывает свою стоимость (HANDLER_COSTS). Дешевые переходы по меню стоят
+1, загрузка фото и запуск генерации - дороже. Апдейт без токенов
+отклоняется сразу, без обращения к БД; о превышении пользователь узнает
+не чаще раза в NOTICE_INTERVAL секунд.
+
+Корзины, простаивающие дольше THROTTLE_IDLE_TTL, удаляются: к этому
+времени они все равно полностью наполнены.
+"""
+import time
+from typing import Dict, Optional
+
+from aiogram.types import CallbackQuery
+
+from config import THROTTLE_ENABLED, THROTTLE_RATE, THROTTLE_BURST, THROTTLE_IDLE_TTL, logger
+from metrics import REGISTRY
+
+THROTTLED_UPDATES = REGISTRY.counter(
+    "throttled_updates_total",
+    "Апдейты, отклоненные ограничением частоты",
+    ("handler",)
+)
+
+# Стоимость хэндлеров в токенах; остальные стоят DEFAULT_COST
+HANDLER_COSTS: Dict[str, float] = {
+    "photo_handler": 4,  # скачивание фото, проверка качества, подготовка запроса
+    "confirmation_handler": 4,  # списание баланса и запуск генерации
+    "custom_prompt_handler": 4,
+    "create_photo_handler": 2,  # отправка примеров фото
+    "stats_handler": 2,
+    "costs_handler": 2,
+    "export_handler": 4,  # чтение таблиц целиком
+    "bulk_credit_handler": 4,
+}
+DEFAULT_COST = 1.0
+
+# Как часто напоминать пользователю об ограничении, секунды
+NOTICE_INTERVAL = 10.0
+THROTTLE_NOTICE = "⏳ Слишком много действий подряд. Подождите несколько секунд."
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.notified = float("-inf")
+
+
+class Throttler:
+    """Корзины токенов по пользователям"""
+
+    def __init__(
+        self,
+        rate: float = THROTTLE_RATE,
+        burst: float = THROTTLE_BURST,
+        idle_ttl: float = THROTTLE_IDLE_TTL
+    ):
+        self.rate = rate
+        self.burst = burst
+        # Раньше, чем корзина наполнится, удалять нельзя: это сбросило бы ограничение
+        self.idle_ttl = max(idle_ttl, burst / rate)
+        self._buckets: Dict[int, _Bucket] = {}
+        self._next_sweep = 0.0
+
+    def allow(self, user_id: int, cost: float = DEFAULT_COST, now: Optional[float] = None) -> bool:
+        """Списывает cost токенов, если их хватает"""
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens < cost:
+            return False
+        bucket.tokens -= cost
+        return True
+
+    def should_notify(self, user_id: int, now: Optional[float] = None) -> bool:
+        """Пора ли снова сообщить пользователю об ограничении"""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now - bucket.notified < NOTICE_INTERVAL:
+            return False
+        bucket.notified = now
+        return True
+
+    def _sweep(self, now: float):
+        deadline = now - self.idle_ttl
+        for user_id in [uid for uid, b in self._buckets.items() if b.updated < deadline]:
+            del self._buckets[user_id]
+        self._next_sweep = now + self.idle_ttl
+
+    async def middleware(self, handler, event, data):
+        """Inner middleware: хэндлер уже выбран, его стоимость известна"""
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        if self.allow(user.id, HANDLER_COSTS.get(name, DEFAULT_COST)):
+            return await handler(event, data)
+
+        THROTTLED_UPDATES.inc(name)
+        notify = self.should_notify(user.id)
+        if notify:
+            logger.info(f"Ограничение частоты: пользователь {user.id}, хэндлер {name}")
+        try:
+            if isinstance(event, CallbackQuery):
+                # На callback нужно ответить в любом случае, иначе кнопка "зависнет"
+                await event.answer(THROTTLE_NOTICE if notify else None)
+            elif notify:
+                await event.answer(THROTTLE_NOTICE)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить на отклоненный апдейт: {e}")
+        return None
+
+
+# None, если ограничение выключено (THROTTLE_ENABLED)
+throttler: Optional[Throttler] = Throttler() if THROTTLE_ENABLED else None
@@ -0,0 +1,256 @@
+"""
+Трассировка генераций и неблокирующее логирование
+
+Диагностика была только в виде строк logger.info/error, которые пишутся
+синхронно из потока event loop, и связать шаги одной генерации между
+хэндлерами было нельзя.
+
+Трасса - это сценарий пользователя от загрузки фото до доставки
+результата: photo_handler начинает ее (bind) и сохраняет trace_id в
+данных FSM, хэндлеры генерации и правок продолжают ту же трассу. Внутри
+трассы участки (span) - скачивание фото, подготовка запроса, запросы к
+БД, этапы генерации (upload, model, encode, send) - записываются с
+длительностью, исходом и ссылкой на родительский участок. Вне трассы
+span ничего не делает.
+
+Записи уходят JSON-строками через QueueHandler: в потоке event loop
+запись только кладется в очередь, сериализация и запись в файл или
+отправка коллектору (TRACE_EXPORT) выполняются фоновым потоком
+QueueListener. Обычные логи бота setup() тоже переводит на очередь и
+дописывает к строкам внутри трассы ее id.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import queue
+import time
+import urllib.request
+from contextlib import contextmanager
+from logging.handlers import BufferingHandler, QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+from config import TRACE_EXPORT, TRACE_FLUSH_INTERVAL, TRACE_BATCH_SIZE, logger
+
+trace_logger = logging.getLogger("fashion_bot.trace")
+trace_logger.propagate = False
+trace_logger.setLevel(logging.INFO)
+
+
+class _Trace:
+    __slots__ = ("trace_id", "attrs")
+
+    def __init__(self, trace_id: str, attrs: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.attrs = attrs
+
+
+class Span:
+    """Участок трассы"""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "status")
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.status = "ok"
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+_trace: contextvars.ContextVar[Optional[_Trace]] = contextvars.ContextVar("trace", default=None)
+_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+# Запущенные setup() слушатели очередей и прежние обработчики корневого логгера
+_listeners: List[QueueListener] = []
+_root_handlers: List[logging.Handler] = []
+_exporting = False
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+def bind(trace_id: Optional[str] = None, **attrs) -> str:
+    """
+    Делает трассу текущей до конца обработки апдейта (см. middleware).
+
+    Returns:
+        trace_id (новый, если не задан)
+    """
+    trace = _Trace(trace_id or new_trace_id(), attrs)
+    _trace.set(trace)
+    _span.set(None)
+    return trace.trace_id
+
+
+def annotate(**attrs):
+    """Добавляет атрибуты текущей трассе: они попадут во все следующие записи"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Записывает участок текущей трассы (вне трассы или без экспорта - ничего)"""
+    trace = _trace.get()
+    if trace is None or not _exporting:
+        yield None
+        return
+    parent = _span.get()
+    current = Span(trace, name, parent.span_id if parent is not None else None, attrs)
+    token = _span.set(current)
+    ts = time.time()
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "cancelled" if isinstance(e, asyncio.CancelledError) else type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        _span.reset(token)
+        trace_logger.info({
+            "ts": round(ts, 6),
+            "trace_id": trace.trace_id,
+            "span_id": current.span_id,
+            "parent_id": current.parent_id,
+            "name": name,
+            "duration_ms": round(duration * 1000, 3),
+            "status": current.status,
+            **trace.attrs,
+            **current.attrs,
+        })
+
+
+async def middleware(handler, event, data):
+    """Inner middleware: трасса, привязанная хэндлером, не переходит на следующие апдейты"""
+    trace_token = _trace.set(None)
+    span_token = _span.set(None)
+    try:
+        return await handler(event, data)
+    finally:
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+
+
+class _TraceQueueHandler(QueueHandler):
+    """Кладет запись в очередь как есть: в JSON ее превращает фоновый поток"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str, separators=(",", ":"))
+
+
+class CollectorHandler(BufferingHandler):
+    """Отправляет записи коллектору пачками NDJSON (POST) из фонового потока"""
+
+    def __init__(self, url: str, capacity: int = TRACE_BATCH_SIZE, flush_interval: float = TRACE_FLUSH_INTERVAL):
+        super().__init__(capacity)
+        self.url = url
+        self.flush_interval = flush_interval
+        self._flushed = time.monotonic()
+        self.setFormatter(_JsonFormatter())
+
+    def shouldFlush(self, record: logging.LogRecord) -> bool:
+        return super().shouldFlush(record) or time.monotonic() - self._flushed >= self.flush_interval
+
+    def flush(self):
+        self.acquire()
+        try:
+            records, self.buffer = self.buffer, []
+            self._flushed = time.monotonic()
+        finally:
+            self.release()
+        if not records:
+            return
+        body = "".join(self.format(record) + "\n" for record in records).encode()
+        request = urllib.request.Request(
+            self.url, data=body, method="POST", headers={"Content-Type": "application/x-ndjson"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+        except Exception as e:
+            logger.warning(f"Не удалось отправить {len(records)} записей трассировки: {e}")
+
+
+def _exporter(spec: str) -> logging.Handler:
+    """Обработчик по TRACE_EXPORT: «file:путь» или URL коллектора"""
+    if spec.startswith(("http://", "https://")):
+        return CollectorHandler(spec)
+    path = spec[len("file:"):] if spec.startswith("file:") else spec
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(_JsonFormatter())
+    return handler
+
+
+class _TraceLogFilter(logging.Filter):
+    """Дописывает id трассы к строкам логов, выполненным внутри нее"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = current_trace_id()
+        if trace_id is not None:
+            record.trace = f" [trace {trace_id}]"
+        return True
+
+
+def _start_listener(handler: QueueHandler, *handlers: logging.Handler) -> QueueListener:
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+def setup(export: str = TRACE_EXPORT):
+    """
+    Переводит логи бота на очередь с фоновым потоком записи и включает
+    экспорт трасс, если задан export. Вызывать один раз при запуске.
+    """
+    global _exporting
+    if _listeners:
+        return
+    root = logging.getLogger()
+    _root_handlers[:] = root.handlers
+    log_handler = QueueHandler(queue.SimpleQueue())
+    log_handler.addFilter(_TraceLogFilter())
+    root.handlers = [log_handler]
+    _start_listener(log_handler, *_root_handlers)
+
+    if export:
+        trace_handler = _TraceQueueHandler(queue.SimpleQueue())
+        trace_logger.addHandler(trace_handler)
+        _start_listener(trace_handler, _exporter(export))
+        _exporting = True
+        logger.info(f"🔎 Трассировка генераций: {export}")
+
+
+def shutdown():
+    """Дописывает очереди и возвращает логам синхронные обработчики"""
+    global _exporting
+    if not _listeners:
+        return
+    _exporting = False
+    trace_logger.handlers.clear()
+    logging.getLogger().handlers = list(_root_handlers)
+    listeners, _listeners[:] = list(_listeners), []
+    for listener in reversed(listeners):
+        listener.stop()
+        for handler in listener.handlers:
+            if handler not in _root_handlers:
+                handler.close()
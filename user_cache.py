@@ -0,0 +1,87 @@
+"""
+Кэш состояния пользователей перед Database
+
+Один сценарий создания фото несколько раз читает баланс пользователя
+(create_photo, выбор категории, подтверждение, правка, пополнение), и
+каждое чтение открывало новое подключение к SQLite, а при отсутствии
+пользователя еще и вставляло строку.
+
+Кэш - ограниченный LRU компактных записей (баланс, признак платящего
+пользователя и число генераций).
+Database читает через него (read-through) и обновляет его после каждой
+своей записи (write-through), поэтому на горячем пути чтения не доходят
+до БД. Изменения в обход Database (например, /add_balance) сбрасывают
+запись пользователя.
+"""
+from collections import OrderedDict
+from typing import Optional
+
+from config import USER_CACHE_SIZE
+from metrics import record_cache_lookup
+
+
+class UserState:
+    """Состояние пользователя; generations загружается по требованию"""
+    __slots__ = ("balance", "paid", "generations")
+
+    def __init__(self, balance: int, paid: bool = False, generations: Optional[int] = None):
+        self.balance = balance
+        self.paid = paid  # пополнял баланс (users.paid)
+        self.generations = generations
+
+    @property
+    def free_trial_available(self) -> bool:
+        """Бесплатная генерация: ни одной генерации и нулевой баланс"""
+        return self.generations == 0 and self.balance == 0
+
+
+class UserStateCache:
+    """LRU состояний пользователей"""
+
+    def __init__(self, max_users: int = USER_CACHE_SIZE):
+        self.max_users = max_users
+        self._states: "OrderedDict[int, UserState]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[UserState]:
+        state = self._states.get(user_id)
+        record_cache_lookup("user_state", state is not None)
+        if state is not None:
+            self._states.move_to_end(user_id)
+        return state
+
+    def put(self, user_id: int, state: UserState):
+        if self.max_users <= 0:
+            return
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_users:
+            self._states.popitem(last=False)
+
+    def set_balance(self, user_id: int, balance: int, paid: bool = False):
+        """Баланс записан в БД: обновляет запись, если она есть; paid - баланс пополнен"""
+        state = self._states.get(user_id)
+        if state is not None:
+            state.balance = balance
+            state.paid = state.paid or paid
+
+    def adjust_balance(self, user_id: int, delta: int):
+        """Баланс изменен в БД на delta"""
+        state = self._states.get(user_id)
+        if state is not None:
+            state.balance += delta
+
+    def add_generation(self, user_id: int):
+        """В БД добавлена генерация"""
+        state = self._states.get(user_id)
+        if state is not None and state.generations is not None:
+            state.generations += 1
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Сбрасывает запись пользователя (или весь кэш, если user_id не задан)"""
+        if user_id is None:
+            self._states.clear()
+        else:
+            self._states.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._states)